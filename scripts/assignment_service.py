@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Work-Assignment Service for Expert Labelling
+
+This script runs a small local HTTP service that hands out the next N queue
+items to each expert, instead of every client downloading the full image list
+and choosing items itself. Items are leased: a leased item is not handed to
+anyone else until it is completed, released or the lease times out. An expert
+is never given an item they have already been assigned (each expert gets
+scheduler heaps without their seen items), and towns are kept in balance
+through the labelling scheduler's coverage bonus.
+
+Assignment works from the scheduler's in-memory indexed heaps (O(log n) per
+item); leases and completions are persisted to SQLite so the service can be
+restarted without losing state.
+
+Usage:
+    python scripts/assignment_service.py [options]
+
+Endpoints:
+    POST /assign    {"expertId": "EX001", "n": 10}                -> leased items
+    POST /complete  {"expertId": "EX001", "itemId": "...", "label": {...}}
+    POST /release   {"expertId": "EX001", "itemId": "..."}
+    GET  /stats
+
+Options:
+    --queue-file FILE        Classification queue (default: data/classification_queue.json)
+    --classifications FILE   Classifications export used to seed label counts
+    --db FILE                SQLite state file (default: data/assignments.db)
+    --host HOST              Host to bind (default: 127.0.0.1)
+    --port INT               Port to listen on (default: 8765)
+    --lease-seconds INT      Lease timeout in seconds (default: 900)
+    --max-batch INT          Maximum items per assign request (default: 50)
+    --target-labels INT      Labels wanted per item (default: 3)
+    --max-labels INT         Items with this many labels are no longer assigned (default: 5)
+    --town-target INT        Labelled items wanted per town (default: 50)
+"""
+
+import os
+import json
+import argparse
+import heapq
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from classification_store import load_classifications, normalize_image_id
+from labeling_scheduler import QUEUE_FILE, LabelingScheduler, load_queue_items
+
+# Base directories
+BASE_DIR = "data"
+DB_FILE = os.path.join(BASE_DIR, "assignments.db")
+
+# Queue item fields sent to clients (the rest of the queue item stays server-side)
+CLIENT_FIELDS = ("town", "filename", "cropped_image", "original_image", "composite_image",
+                 "box", "confidence", "distance_hint")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    item_id TEXT PRIMARY KEY,
+    expert_id TEXT NOT NULL,
+    leased_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    expert_id TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    assigned_at REAL NOT NULL,
+    PRIMARY KEY (expert_id, item_id)
+);
+CREATE TABLE IF NOT EXISTS completions (
+    expert_id TEXT NOT NULL,
+    item_id TEXT NOT NULL,
+    completed_at REAL NOT NULL,
+    label TEXT,
+    PRIMARY KEY (expert_id, item_id)
+);
+"""
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Serve labelling work to experts with leases")
+
+    parser.add_argument("--queue-file", type=str, default=QUEUE_FILE,
+                        help=f"Classification queue (default: {QUEUE_FILE})")
+    parser.add_argument("--classifications", type=str,
+                        help="Classifications export used to seed label counts")
+    parser.add_argument("--db", type=str, default=DB_FILE,
+                        help=f"SQLite state file (default: {DB_FILE})")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Host to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on (default: 8765)")
+    parser.add_argument("--lease-seconds", type=int, default=900,
+                        help="Lease timeout in seconds (default: 900)")
+    parser.add_argument("--max-batch", type=int, default=50,
+                        help="Maximum items per assign request (default: 50)")
+    parser.add_argument("--target-labels", type=int, default=3,
+                        help="Labels wanted per item (default: 3)")
+    parser.add_argument("--max-labels", type=int, default=5,
+                        help="Items with this many labels are no longer assigned (default: 5)")
+    parser.add_argument("--town-target", type=int, default=50,
+                        help="Labelled items wanted per town (default: 50)")
+
+    return parser.parse_args()
+
+class AssignmentService:
+    """Lease-based work assignment over a LabelingScheduler, persisted to SQLite."""
+
+    def __init__(self, scheduler, db_path=DB_FILE, lease_seconds=900, max_batch=50):
+        self.scheduler = scheduler
+        self.lease_seconds = lease_seconds
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+
+        self.leases = {}                  # item id -> (expert id, expires_at)
+        self.expiry_heap = []             # (expires_at, item id), stale entries skipped lazily
+        self.seen = defaultdict(set)      # expert id -> item ids ever assigned to them
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._restore()
+
+    def _restore(self):
+        """Replay persisted completions, assignments and live leases into the in-memory index."""
+        for expert_id, item_id, label in self.conn.execute(
+                "SELECT expert_id, item_id, label FROM completions ORDER BY completed_at"):
+            record = json.loads(label) if label else {}
+            record.update({"imageId": item_id, "expertId": expert_id})
+            self.scheduler.add_label(record)
+
+        for expert_id, item_id in self.conn.execute("SELECT expert_id, item_id FROM assignments"):
+            self.seen[expert_id].add(item_id)
+
+        now = time.time()
+        for item_id, expert_id, expires_at in self.conn.execute(
+                "SELECT item_id, expert_id, expires_at FROM leases").fetchall():
+            if expires_at <= now or item_id not in self.scheduler.items:
+                self.conn.execute("DELETE FROM leases WHERE item_id = ?", (item_id,))
+                continue
+            self.scheduler.take(item_id)
+            self._lease(item_id, expert_id, expires_at)
+        self.conn.commit()
+
+    def _town(self, item_id):
+        return self.scheduler.items[item_id].get('town', 'unknown')
+
+    def _lease(self, item_id, expert_id, expires_at):
+        self.leases[item_id] = (expert_id, expires_at)
+        heapq.heappush(self.expiry_heap, (expires_at, item_id))
+        self.scheduler.town_pending[self._town(item_id)] += 1
+
+    def _end_lease(self, item_id):
+        """Drop a lease and return the item to the schedule."""
+        self.leases.pop(item_id, None)
+        self.scheduler.town_pending[self._town(item_id)] -= 1
+        self.scheduler.push(item_id)
+
+    def expire_leases(self, now=None):
+        """Return timed-out leases to the schedule. Returns the number expired."""
+        now = now or time.time()
+        expired = []
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires_at, item_id = heapq.heappop(self.expiry_heap)
+            lease = self.leases.get(item_id)
+            if lease and lease[1] == expires_at:
+                self._end_lease(item_id)
+                expired.append((item_id,))
+
+        if expired:
+            with self.conn:
+                self.conn.executemany("DELETE FROM leases WHERE item_id = ?", expired)
+        return len(expired)
+
+    def assign(self, expert_id, n):
+        """Lease up to n items to an expert. Returns the client view of each item."""
+        n = max(0, min(int(n), self.max_batch))
+        with self.lock:
+            now = time.time()
+            self.expire_leases(now)
+            expires_at = now + self.lease_seconds
+            seen = self.seen[expert_id]
+            self.scheduler.add_expert(expert_id, seen)
+
+            assigned = []
+            for _ in range(n):
+                entry = self.scheduler.pop_next(expert_id)
+                if entry is None:
+                    break
+                item_id, priority = entry
+                self._lease(item_id, expert_id, expires_at)
+                seen.add(item_id)
+                self.scheduler.exclude(expert_id, item_id)
+                assigned.append((item_id, priority))
+
+            if assigned:
+                with self.conn:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO leases (item_id, expert_id, leased_at, expires_at) "
+                        "VALUES (?, ?, ?, ?)", [(item_id, expert_id, now, expires_at) for item_id, _ in assigned])
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO assignments (expert_id, item_id, assigned_at) VALUES (?, ?, ?)",
+                        [(expert_id, item_id, now) for item_id, _ in assigned])
+
+        items = []
+        for item_id, priority in assigned:
+            item = self.scheduler.items[item_id]
+            view = {field: item[field] for field in CLIENT_FIELDS if field in item}
+            view.update({"itemId": item_id, "priority": round(priority, 4), "leaseExpires": expires_at})
+            items.append(view)
+        return items
+
+    def complete(self, expert_id, item_id, label=None):
+        """Record a finished label and return the item to the schedule if it needs more labels."""
+        item_id = normalize_image_id(item_id)
+        with self.lock:
+            if item_id not in self.scheduler.items:
+                return False
+
+            lease = self.leases.get(item_id)
+            if lease and lease[0] == expert_id:
+                self.leases.pop(item_id)
+                self.scheduler.town_pending[self._town(item_id)] -= 1
+
+            record = dict(label or {})
+            record.update({"imageId": item_id, "expertId": expert_id})
+            self.scheduler.add_label(record)
+            self.seen[expert_id].add(item_id)
+            self.scheduler.exclude(expert_id, item_id)
+            if item_id not in self.leases:
+                self.scheduler.push(item_id)
+
+            with self.conn:
+                self.conn.execute("DELETE FROM leases WHERE item_id = ? AND expert_id = ?", (item_id, expert_id))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO completions (expert_id, item_id, completed_at, label) VALUES (?, ?, ?, ?)",
+                    (expert_id, item_id, time.time(), json.dumps(label) if label else None))
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO assignments (expert_id, item_id, assigned_at) VALUES (?, ?, ?)",
+                    (expert_id, item_id, time.time()))
+        return True
+
+    def release(self, expert_id, item_id):
+        """Give a leased item back before its lease expires."""
+        item_id = normalize_image_id(item_id)
+        with self.lock:
+            lease = self.leases.get(item_id)
+            if not lease or lease[0] != expert_id:
+                return False
+            self._end_lease(item_id)
+            with self.conn:
+                self.conn.execute("DELETE FROM leases WHERE item_id = ?", (item_id,))
+        return True
+
+    def stats(self):
+        with self.lock:
+            self.expire_leases()
+            pending_by_town = {town: count for town, count in self.scheduler.town_pending.items() if count}
+            return {
+                "items": len(self.scheduler.items),
+                "scheduled": len(self.scheduler),
+                "active_leases": len(self.leases),
+                "experts": len(self.seen),
+                "labelled_by_town": dict(self.scheduler.town_labelled),
+                "leased_by_town": pending_by_town
+            }
+
+    def close(self):
+        self.conn.close()
+
+class AssignmentRequestHandler(BaseHTTPRequestHandler):
+    """JSON-over-HTTP front end for an AssignmentService."""
+
+    service = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.service.stats())
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except Exception as e:
+            self._send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+        if not isinstance(body, dict):
+            self._send_json(400, {"error": "Request body must be a JSON object"})
+            return
+
+        expert_id = body.get("expertId")
+        if not expert_id:
+            self._send_json(400, {"error": "expertId is required"})
+            return
+
+        path = self.path.rstrip("/")
+        if path == "/assign":
+            self._send_json(200, {"items": self.service.assign(expert_id, body.get("n", 10))})
+        elif path == "/complete":
+            label = body.get("label")
+            if label is not None and not isinstance(label, dict):
+                self._send_json(400, {"error": "label must be a JSON object"})
+                return
+            ok = self.service.complete(expert_id, body.get("itemId", ""), label)
+            self._send_json(200 if ok else 404, {"ok": ok})
+        elif path == "/release":
+            ok = self.service.release(expert_id, body.get("itemId", ""))
+            self._send_json(200 if ok else 409, {"ok": ok})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def log_message(self, format, *args):
+        # Per-request access logs would dominate the cost of an assignment
+        pass
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    queue_items = load_queue_items(args.queue_file)
+    if not queue_items:
+        print("No items in classification queue. Exiting.")
+        return
+
+    scheduler = LabelingScheduler(queue_items, target_labels=args.target_labels,
+                                  max_labels=args.max_labels, town_target=args.town_target)
+    if args.classifications:
+        records = load_classifications(args.classifications)
+        matched = scheduler.add_labels(sorted(records, key=lambda r: r.get("timestamp", "")))
+        print(f"Seeded {matched} existing labels from {args.classifications}")
+
+    service = AssignmentService(scheduler, args.db, args.lease_seconds, args.max_batch)
+    AssignmentRequestHandler.service = service
+
+    server = ThreadingHTTPServer((args.host, args.port), AssignmentRequestHandler)
+    print(f"Serving {len(scheduler.items)} items on http://{args.host}:{args.port} "
+          f"(lease timeout {args.lease_seconds}s, state in {args.db})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.")
+    finally:
+        server.server_close()
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Incremental Classification Aggregation Store
+
+This script ingests expert classifications (as exported to
+data/classifications/classifications.json) into a local SQLite store and keeps
+per-image, per-town, per-category and per-expert counters up to date. Only
+records newer than the stored timestamp watermark are processed on each run, so
+progress and agreement reports stay fast as new labels arrive.
+
+Usage:
+    python scripts/classification_store.py [options]
+
+Options:
+    --classifications FILE   Classifications export to ingest (default: data/classifications/classifications.json)
+    --db FILE                SQLite store path (default: data/classification_stats.db)
+    --report TYPE            Report to print after ingesting: progress, agreement, experts or none (default: progress)
+    --field NAME             Label field used for agreement tallies (default: primaryCategory)
+    --top INT                Number of rows to show in the agreement report (default: 20)
+    --rebuild                Drop the store and ingest the full history again
+"""
+
+import os
+import json
+import argparse
+import sqlite3
+import time
+
+# Base directories
+BASE_DIR = "data"
+CLASSIFICATIONS_FILE = os.path.join(BASE_DIR, "classifications", "classifications.json")
+DB_FILE = os.path.join(BASE_DIR, "classification_stats.db")
+
+# Label fields that get per-image agreement tallies
+AGREEMENT_FIELDS = ("primaryCategory", "specificFlag", "displayContext")
+
+# Prefixes added to filenames by the various image pipelines
+IMAGE_ID_PREFIXES = ("masked_", "composite_")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS labels (
+    image_id TEXT NOT NULL,
+    expert_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    town TEXT,
+    primary_category TEXT,
+    specific_flag TEXT,
+    display_context TEXT,
+    confidence INTEGER,
+    PRIMARY KEY (image_id, expert_id, timestamp)
+);
+CREATE INDEX IF NOT EXISTS idx_labels_timestamp ON labels (timestamp);
+CREATE TABLE IF NOT EXISTS image_counts (
+    image_id TEXT PRIMARY KEY,
+    town TEXT,
+    labels INTEGER NOT NULL DEFAULT 0,
+    confidence_sum INTEGER NOT NULL DEFAULT 0,
+    first_seen TEXT,
+    last_seen TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_image_counts_town ON image_counts (town);
+CREATE TABLE IF NOT EXISTS image_label_counts (
+    image_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (image_id, field, value)
+);
+CREATE TABLE IF NOT EXISTS image_agreement (
+    image_id TEXT NOT NULL,
+    field TEXT NOT NULL,
+    votes INTEGER NOT NULL DEFAULT 0,
+    agreeing_pairs INTEGER NOT NULL DEFAULT 0,
+    total_pairs INTEGER NOT NULL DEFAULT 0,
+    top_value TEXT,
+    top_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (image_id, field)
+);
+CREATE INDEX IF NOT EXISTS idx_image_agreement_field ON image_agreement (field, total_pairs);
+CREATE TABLE IF NOT EXISTS town_counts (
+    town TEXT PRIMARY KEY,
+    labels INTEGER NOT NULL DEFAULT 0,
+    images INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS category_counts (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (field, value)
+);
+CREATE TABLE IF NOT EXISTS expert_counts (
+    expert_id TEXT PRIMARY KEY,
+    labels INTEGER NOT NULL DEFAULT 0,
+    images INTEGER NOT NULL DEFAULT 0,
+    confidence_sum INTEGER NOT NULL DEFAULT 0,
+    first_seen TEXT,
+    last_seen TEXT
+);
+"""
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Incrementally aggregate expert classifications")
+
+    parser.add_argument("--classifications", type=str, default=CLASSIFICATIONS_FILE,
+                        help=f"Classifications export to ingest (default: {CLASSIFICATIONS_FILE})")
+    parser.add_argument("--db", type=str, default=DB_FILE,
+                        help=f"SQLite store path (default: {DB_FILE})")
+    parser.add_argument("--report", type=str, default="progress",
+                        choices=["progress", "agreement", "experts", "none"],
+                        help="Report to print after ingesting (default: progress)")
+    parser.add_argument("--field", type=str, default="primaryCategory", choices=AGREEMENT_FIELDS,
+                        help="Label field used for agreement tallies (default: primaryCategory)")
+    parser.add_argument("--top", type=int, default=20,
+                        help="Number of rows to show in the agreement report (default: 20)")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Drop the store and ingest the full history again")
+
+    return parser.parse_args()
+
+def normalize_image_id(image_id):
+    """Strip pipeline prefixes so labels on masked/composite files count for the same item."""
+    for prefix in IMAGE_ID_PREFIXES:
+        if image_id.startswith(prefix):
+            return image_id[len(prefix):]
+    return image_id
+
+def load_classifications(classifications_file):
+    """Load the flat array of classification records."""
+    try:
+        with open(classifications_file, 'r') as f:
+            records = json.load(f)
+    except Exception as e:
+        print(f"Error loading classifications: {e}")
+        return []
+
+    if isinstance(records, dict):
+        records = records.get("classifications", [])
+    return records
+
+class ClassificationStore:
+    """SQLite-backed counters over expert classifications, updated incrementally."""
+
+    def __init__(self, db_path=DB_FILE):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def reset(self):
+        """Remove all stored labels and counters."""
+        with self.conn:
+            for table in ("meta", "labels", "image_counts", "image_label_counts", "image_agreement",
+                          "town_counts", "category_counts", "expert_counts"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    @property
+    def watermark(self):
+        """Timestamp of the newest ingested label ('' if the store is empty)."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        return row[0] if row else ""
+
+    def ingest(self, records):
+        """
+        Ingest classification records newer than the watermark.
+
+        Records with a timestamp equal to the watermark are re-checked against
+        the labels table, so labels sharing the newest timestamp are not lost
+        between runs. Records without a timestamp are skipped. Returns the
+        number of new labels added.
+        """
+        watermark = self.watermark
+        candidates = [r for r in records
+                      if r.get("imageId") and r.get("timestamp") and r["timestamp"] >= watermark]
+        candidates.sort(key=lambda r: r["timestamp"])
+
+        added = 0
+        newest = watermark
+        with self.conn:
+            for record in candidates:
+                if self._add_label(record):
+                    added += 1
+                newest = max(newest, record["timestamp"])
+
+            if newest != watermark:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('watermark', ?)", (newest,))
+
+        return added
+
+    def _add_label(self, record):
+        """Insert one label and update every counter it touches. Returns False for duplicates."""
+        image_id = normalize_image_id(record["imageId"])
+        expert_id = record.get("expertId") or "anonymous"
+        timestamp = record["timestamp"]
+        town = record.get("town", "")
+        confidence = int(record.get("confidence") or 0)
+
+        cursor = self.conn.execute(
+            "INSERT OR IGNORE INTO labels (image_id, expert_id, timestamp, town, primary_category, "
+            "specific_flag, display_context, confidence) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (image_id, expert_id, timestamp, town, record.get("primaryCategory", ""),
+             record.get("specificFlag", ""), record.get("displayContext", ""), confidence))
+        if cursor.rowcount == 0:
+            return False
+
+        # Per-image counters (a new image also counts towards its town)
+        row = self.conn.execute("SELECT labels FROM image_counts WHERE image_id = ?", (image_id,)).fetchone()
+        new_image = row is None
+        if new_image:
+            self.conn.execute(
+                "INSERT INTO image_counts (image_id, town, labels, confidence_sum, first_seen, last_seen) "
+                "VALUES (?, ?, 1, ?, ?, ?)", (image_id, town, confidence, timestamp, timestamp))
+        else:
+            self.conn.execute(
+                "UPDATE image_counts SET labels = labels + 1, confidence_sum = confidence_sum + ?, "
+                "last_seen = ? WHERE image_id = ?", (confidence, timestamp, image_id))
+
+        # Per-town counters
+        self.conn.execute(
+            "INSERT INTO town_counts (town, labels, images) VALUES (?, 1, ?) "
+            "ON CONFLICT(town) DO UPDATE SET labels = labels + 1, images = images + excluded.images",
+            (town, 1 if new_image else 0))
+
+        # Per-expert counters (images = distinct images this expert has labelled)
+        expert_seen = self.conn.execute(
+            "SELECT COUNT(*) FROM labels WHERE image_id = ? AND expert_id = ?",
+            (image_id, expert_id)).fetchone()[0]
+        self.conn.execute(
+            "INSERT INTO expert_counts (expert_id, labels, images, confidence_sum, first_seen, last_seen) "
+            "VALUES (?, 1, 1, ?, ?, ?) "
+            "ON CONFLICT(expert_id) DO UPDATE SET labels = labels + 1, images = images + excluded.images, "
+            "confidence_sum = confidence_sum + excluded.confidence_sum, last_seen = excluded.last_seen",
+            (expert_id, confidence, timestamp, timestamp))
+        if expert_seen > 1:
+            self.conn.execute("UPDATE expert_counts SET images = images - 1 WHERE expert_id = ?", (expert_id,))
+
+        # Per-category counters and agreement tallies
+        for field in AGREEMENT_FIELDS:
+            value = record.get(field) or ""
+            if not value:
+                continue
+
+            self.conn.execute(
+                "INSERT INTO category_counts (field, value, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(field, value) DO UPDATE SET count = count + 1", (field, value))
+            self._update_agreement(image_id, field, value)
+
+        return True
+
+    def _update_agreement(self, image_id, field, value):
+        """
+        Update the pairwise agreement tally for one new vote.
+
+        A new vote for a value that already has k votes agrees with those k
+        votes and forms a pair with each of the n existing votes, so both
+        tallies update in constant time.
+        """
+        row = self.conn.execute(
+            "SELECT count FROM image_label_counts WHERE image_id = ? AND field = ? AND value = ?",
+            (image_id, field, value)).fetchone()
+        same_votes = row[0] if row else 0
+
+        self.conn.execute(
+            "INSERT INTO image_label_counts (image_id, field, value, count) VALUES (?, ?, ?, 1) "
+            "ON CONFLICT(image_id, field, value) DO UPDATE SET count = count + 1",
+            (image_id, field, value))
+
+        row = self.conn.execute(
+            "SELECT votes, top_count FROM image_agreement WHERE image_id = ? AND field = ?",
+            (image_id, field)).fetchone()
+        if row is None:
+            self.conn.execute(
+                "INSERT INTO image_agreement (image_id, field, votes, agreeing_pairs, total_pairs, "
+                "top_value, top_count) VALUES (?, ?, 1, 0, 0, ?, 1)", (image_id, field, value))
+            return
+
+        votes, top_count = row
+        if same_votes + 1 > top_count:
+            self.conn.execute(
+                "UPDATE image_agreement SET top_value = ?, top_count = ? WHERE image_id = ? AND field = ?",
+                (value, same_votes + 1, image_id, field))
+        self.conn.execute(
+            "UPDATE image_agreement SET votes = votes + 1, agreeing_pairs = agreeing_pairs + ?, "
+            "total_pairs = total_pairs + ? WHERE image_id = ? AND field = ?",
+            (same_votes, votes, image_id, field))
+
+    def progress_report(self):
+        """Per-town label and image counts."""
+        rows = self.conn.execute(
+            "SELECT town, images, labels FROM town_counts ORDER BY labels DESC").fetchall()
+        totals = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(labels), 0) FROM image_counts").fetchone()
+        multi = self.conn.execute("SELECT COUNT(*) FROM image_counts WHERE labels > 1").fetchone()[0]
+
+        return {
+            "images_labelled": totals[0],
+            "total_labels": totals[1],
+            "images_with_multiple_labels": multi,
+            "towns": [{"town": town, "images": images, "labels": labels} for town, images, labels in rows]
+        }
+
+    def agreement_report(self, field="primaryCategory", top=20):
+        """Overall and per-image pairwise agreement for a label field."""
+        totals = self.conn.execute(
+            "SELECT COALESCE(SUM(agreeing_pairs), 0), COALESCE(SUM(total_pairs), 0), COUNT(*) "
+            "FROM image_agreement WHERE field = ? AND total_pairs > 0", (field,)).fetchone()
+        agreeing_pairs, total_pairs, images = totals
+
+        # Images with the lowest agreement first - these are the ones worth another look
+        rows = self.conn.execute(
+            "SELECT image_id, votes, top_value, top_count, "
+            "CAST(agreeing_pairs AS REAL) / total_pairs AS agreement "
+            "FROM image_agreement WHERE field = ? AND total_pairs > 0 "
+            "ORDER BY agreement ASC, votes DESC LIMIT ?", (field, top)).fetchall()
+
+        categories = self.conn.execute(
+            "SELECT value, count FROM category_counts WHERE field = ? ORDER BY count DESC",
+            (field,)).fetchall()
+
+        return {
+            "field": field,
+            "images_with_multiple_votes": images,
+            "pairwise_agreement": agreeing_pairs / total_pairs if total_pairs else None,
+            "categories": [{"value": value, "count": count} for value, count in categories],
+            "lowest_agreement": [
+                {"image_id": image_id, "votes": votes, "top_value": top_value,
+                 "top_count": top_count, "agreement": agreement}
+                for image_id, votes, top_value, top_count, agreement in rows
+            ]
+        }
+
+    def expert_report(self):
+        """Per-expert label counts and mean self-reported confidence."""
+        rows = self.conn.execute(
+            "SELECT expert_id, labels, images, confidence_sum, first_seen, last_seen "
+            "FROM expert_counts ORDER BY labels DESC").fetchall()
+
+        return [
+            {"expert_id": expert_id, "labels": labels, "images": images,
+             "mean_confidence": confidence_sum / labels if labels else 0,
+             "first_seen": first_seen, "last_seen": last_seen}
+            for expert_id, labels, images, confidence_sum, first_seen, last_seen in rows
+        ]
+
+def print_progress_report(report):
+    """Print the per-town progress report."""
+    print(f"\nImages labelled: {report['images_labelled']}")
+    print(f"Total labels: {report['total_labels']}")
+    print(f"Images with multiple labels: {report['images_with_multiple_labels']}")
+
+    print("\nLabels by town:")
+    for row in report["towns"]:
+        print(f"  {row['town']}: {row['labels']} labels on {row['images']} images")
+
+def print_agreement_report(report):
+    """Print the agreement report for one label field."""
+    print(f"\nAgreement on {report['field']}:")
+    print(f"Images with multiple votes: {report['images_with_multiple_votes']}")
+    if report["pairwise_agreement"] is None:
+        print("Pairwise agreement: n/a (no image has more than one vote yet)")
+    else:
+        print(f"Pairwise agreement: {report['pairwise_agreement']:.1%}")
+
+    print("\nVotes by category:")
+    for row in report["categories"]:
+        print(f"  {row['value']}: {row['count']}")
+
+    if report["lowest_agreement"]:
+        print("\nLowest agreement images:")
+        for row in report["lowest_agreement"]:
+            print(f"  {row['image_id']}: {row['agreement']:.0%} agreement over {row['votes']} votes "
+                  f"(top: {row['top_value']} x{row['top_count']})")
+
+def print_expert_report(report):
+    """Print the per-expert report."""
+    print("\nLabels by expert:")
+    for row in report:
+        print(f"  {row['expert_id']}: {row['labels']} labels on {row['images']} images, "
+              f"mean confidence {row['mean_confidence']:.2f} (last active {row['last_seen']})")
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    store = ClassificationStore(args.db)
+    try:
+        if args.rebuild:
+            print(f"Rebuilding store: {args.db}")
+            store.reset()
+
+        records = load_classifications(args.classifications)
+        start = time.perf_counter()
+        added = store.ingest(records)
+        elapsed = time.perf_counter() - start
+        print(f"Ingested {added} new labels in {elapsed * 1000:.1f} ms (watermark: {store.watermark or 'none'})")
+
+        start = time.perf_counter()
+        if args.report == "progress":
+            print_progress_report(store.progress_report())
+        elif args.report == "agreement":
+            print_agreement_report(store.agreement_report(args.field, args.top))
+        elif args.report == "experts":
+            print_expert_report(store.expert_report())
+        if args.report != "none":
+            print(f"\nReport built in {(time.perf_counter() - start) * 1000:.1f} ms")
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
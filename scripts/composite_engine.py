@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Side-by-Side Composite Engine
+
+Shared implementation of the "Cropped View | Original Context" composites used
+by prepare_images_for_classification.py, sample_cropped_for_public.py and
+generate_missing_composites.py.
+
+- Layout presets name the sizing rules each pipeline stage uses.
+- Canvases of the same size are reused from a small pool.
+- Context images are shrunk with reduce() before the final resample, and JPEG
+  originals can be decoded at reduced size (draft) under the faster policies.
+- Fonts, label text sprites and dash masks are rendered once and cached.
+- Dashed boxes are drawn with four masked pastes instead of one line per dash.
+
+Layered output is the alternative to baked composites: each original gets one
+shared context image per height (render_context), and each box carries only
+its crop plus its box scaled into the context frame (scale_box), so the
+client draws the highlight itself.
+
+Derivatives are bounded-size renditions (long edge 320/640/1280 px by default)
+written next to a published image, described as srcset-ready entries.
+
+Encoding profiles name how output images are written: format (JPEG, WebP,
+AVIF when Pillow supports it), quality, progressive scans, optimized tables,
+chroma subsampling and metadata stripping. "legacy" keeps the previous
+per-call settings. Profiles that change the format also change the file
+extension (encoded_path).
+
+Running this file directly benchmarks composite throughput against the
+previous per-script implementation, or with --encoding-report, re-encodes
+existing output images under every profile and reports the bytes each saves.
+
+Usage:
+    python scripts/composite_engine.py [options]
+
+Options:
+    --count INT              Number of composites per run (default: 100)
+    --original FILE          Benchmark with a real original image (default: synthetic 4000x3000)
+    --crop-size WxH          Size of the cropped view (default: 320x280)
+    --preset NAME            Layout preset to benchmark (default: crop-height)
+    --encoding-report DIR    Report bytes per encoding profile for up to --count images under DIR
+"""
+
+import io
+import os
+import math
+import argparse
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageChops, ImageStat, features
+
+# Composite geometry
+GUTTER = 20  # Space between the cropped view and the context
+LABEL_HEIGHT = 30  # Label band under both views
+LABEL_FONT_SIZE = 16
+BACKGROUND = (255, 255, 255)
+SEPARATOR_COLOR = (200, 200, 200)
+LABEL_COLOR = (0, 0, 0)
+BOX_COLOR = "red"
+BOX_WIDTH = 2
+DASH_LENGTH = 6
+DASH_GAP = 3
+JPEG_QUALITY = 85
+CONTEXT_HEIGHT = 600  # Default height of shared context images (layered output)
+DERIVATIVE_SIZES = (320, 640, 1280)  # Long-edge sizes of responsive renditions
+
+# Named layouts:
+#   context_height  cap on the composite height (None: use the crop's height)
+#   scale_crop      scale the crop to the composite height
+#   upscale_context resize the context even when it is not taller than the target
+LAYOUT_PRESETS = {
+    # Context scaled to the crop's height (publishing and missing-composite repair)
+    "crop-height": {"context_height": None, "scale_crop": False, "upscale_context": True},
+    # At least the crop's height, up to 600 px of context (classification preprocessing)
+    "context-600": {"context_height": 600, "scale_crop": True, "upscale_context": False},
+}
+
+# Resampling policies, from best looking to fastest:
+#   filter        final resampling filter
+#   reducing_gap  reduce() by integer factors first while at least this much larger than the target
+#   draft         let JPEG originals decode at a reduced DCT scale
+RESAMPLING_POLICIES = {
+    "quality": {"filter": Image.LANCZOS, "reducing_gap": 3.0, "draft": False},
+    "balanced": {"filter": Image.LANCZOS, "reducing_gap": 2.0, "draft": True},
+    "speed": {"filter": Image.BILINEAR, "reducing_gap": 1.5, "draft": True},
+}
+DEFAULT_POLICY = "quality"
+
+# Encoding profiles:
+#   format       output format (None: from the file extension, as before)
+#   quality      encoder quality (None: the caller's quality)
+#   progressive  progressive JPEG scans
+#   optimize     optimized Huffman tables (JPEG) / slowest, smallest method (WebP)
+#   subsampling  JPEG chroma subsampling (None: Pillow's default)
+#   strip        drop EXIF, ICC and XMP metadata
+ENCODING_PROFILES = {
+    # Plain save() with the caller's quality, as written before profiles existed
+    "legacy": {"format": None, "quality": None, "progressive": False, "optimize": False,
+               "subsampling": None, "strip": False},
+    "jpeg": {"format": "JPEG", "quality": 82, "progressive": True, "optimize": True,
+             "subsampling": "4:2:0", "strip": True},
+    # Full-resolution chroma keeps thin red box lines and small flag details crisp
+    "jpeg-hq": {"format": "JPEG", "quality": 90, "progressive": True, "optimize": True,
+                "subsampling": "4:4:4", "strip": True},
+    "webp": {"format": "WEBP", "quality": 80, "progressive": False, "optimize": True,
+             "subsampling": None, "strip": True},
+    "avif": {"format": "AVIF", "quality": 60, "progressive": False, "optimize": False,
+             "subsampling": None, "strip": True},
+}
+DEFAULT_ENCODING = "legacy"
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "AVIF": ".avif"}
+
+class CanvasPool:
+    """
+    Reusable blank canvases, keyed by size.
+
+    The pool holds at most max_bytes of canvases in total; when a released
+    canvas would take it past that, the least recently used sizes are
+    dropped first. Sizes that repeat (fixed layouts and context heights)
+    stay pooled, one-off sizes age out.
+    """
+
+    def __init__(self, max_per_size=4, max_bytes=64 * 1024 * 1024):
+        self.max_per_size = max_per_size
+        self.max_bytes = max_bytes
+        self._free = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _canvas_bytes(size):
+        return size[0] * size[1] * 3
+
+    def acquire(self, size, color=BACKGROUND):
+        with self._lock:
+            free = self._free.get(size)
+            canvas = free.pop() if free else None
+            if canvas is not None:
+                self._bytes -= self._canvas_bytes(size)
+                if not free:
+                    del self._free[size]
+        if canvas is None:
+            return Image.new("RGB", size, color)
+        canvas.paste(color, (0, 0) + size)
+        return canvas
+
+    def release(self, canvas):
+        nbytes = self._canvas_bytes(canvas.size)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            free = self._free.setdefault(canvas.size, [])
+            self._free.move_to_end(canvas.size)
+            if len(free) >= self.max_per_size:
+                return
+            free.append(canvas)
+            self._bytes += nbytes
+            # Evict least recently used sizes until the pool fits again
+            while self._bytes > self.max_bytes:
+                size, evicted = next(iter(self._free.items()))
+                evicted.pop()
+                self._bytes -= self._canvas_bytes(size)
+                if not evicted:
+                    del self._free[size]
+
+_canvas_pool = CanvasPool()
+
+@lru_cache(maxsize=32)
+def load_font(size):
+    """Arial at the given size, or Pillow's default font if it is not installed."""
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=64)
+def text_sprite(text, size=LABEL_FONT_SIZE, fill=LABEL_COLOR, background=BACKGROUND):
+    """Text rendered once onto a tight background tile, for pasting."""
+    font = load_font(size)
+    _, _, right, bottom = ImageDraw.Draw(Image.new("RGB", (1, 1))).textbbox((0, 0), text, font=font)
+    sprite = Image.new("RGB", (max(1, right), max(1, bottom)), background)
+    ImageDraw.Draw(sprite).text((0, 0), text, fill=fill, font=font)
+    return sprite
+
+@lru_cache(maxsize=1024)
+def dash_mask(length, width):
+    """Horizontal dash pattern mask ('L', length x width) matching the per-segment dashes."""
+    period = DASH_LENGTH + DASH_GAP
+    row = bytes(255 if i % period <= DASH_LENGTH else 0 for i in range(length))
+    return Image.frombytes("L", (length, width), row * width)
+
+def draw_dashed_box(image, box, width=BOX_WIDTH, color=BOX_COLOR):
+    """Draw a dashed rectangle with one masked paste per side."""
+    x0, y0, x1, y1 = (int(c) for c in box)
+    if x1 <= x0 or y1 <= y0:
+        return image
+
+    offset = width // 2
+    horizontal = dash_mask(x1 - x0 + 1, width)
+    vertical = dash_mask(y1 - y0 + 1, width).transpose(Image.TRANSPOSE)
+
+    for y in (y0, y1):
+        image.paste(color, (x0, y - offset, x0 + horizontal.width, y - offset + width), horizontal)
+    for x in (x0, x1):
+        image.paste(color, (x - offset, y0, x - offset + width, y0 + vertical.height), vertical)
+    return image
+
+def resample(image, size, policy=DEFAULT_POLICY):
+    """Resize with a policy; large shrinks go through reduce() before the final filter."""
+    settings = RESAMPLING_POLICIES[policy]
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    return image.resize(size, settings["filter"], reducing_gap=settings["reducing_gap"])
+
+def composite_height(layout, crop_height, original_height):
+    """Height of both views in a composite."""
+    if layout["context_height"] is None:
+        return crop_height
+    return max(crop_height, min(layout["context_height"], original_height))
+
+def compose_side_by_side(cropped_img, original_img, box=None, preset="crop-height",
+                         policy=DEFAULT_POLICY, original_size=None):
+    """
+    Build a side-by-side composite of a crop and its original context.
+
+    Args:
+        cropped_img: Cropped view (PIL Image)
+        original_img: Original image, possibly already decoded at reduced size
+        box: Bounding box [x1, y1, x2, y2] to mark in the context, or None
+        preset: Name in LAYOUT_PRESETS
+        policy: Name in RESAMPLING_POLICIES
+        original_size: Full size of the original (the box's coordinate space),
+            if original_img was decoded smaller
+
+    Returns:
+        Composite image from the canvas pool (pass it to release_composite when done)
+    """
+    layout = LAYOUT_PRESETS[preset]
+    crop_width, crop_height = cropped_img.size
+    orig_width, orig_height = original_size or original_img.size
+
+    target_height = composite_height(layout, crop_height, orig_height)
+
+    # Scale cropped image if needed
+    if layout["scale_crop"] and crop_height != target_height:
+        cropped_img = resample(cropped_img, (int(crop_width * (target_height / crop_height)), target_height), policy)
+        crop_width, crop_height = cropped_img.size
+
+    # Scale original image proportionally, maintaining aspect ratio
+    if layout["upscale_context"] or orig_height > target_height:
+        new_orig_width, new_orig_height = int(orig_width * (target_height / orig_height)), target_height
+        context = resample(original_img, (new_orig_width, new_orig_height), policy)
+    else:
+        # Use original image without resizing
+        context = original_img
+        new_orig_width, new_orig_height = context.size
+
+    canvas = _canvas_pool.acquire((crop_width + new_orig_width + GUTTER, crop_height + LABEL_HEIGHT))
+    canvas.paste(cropped_img, (0, 0))
+    canvas.paste(context, (crop_width + GUTTER, 0))
+
+    # Separator line and labels
+    ImageDraw.Draw(canvas).line([(crop_width + 10, 0), (crop_width + 10, crop_height)],
+                                fill=SEPARATOR_COLOR, width=1)
+    canvas.paste(text_sprite("Cropped View"), (10, crop_height + 5))
+    canvas.paste(text_sprite("Original Context"), (crop_width + 30, crop_height + 5))
+
+    # Mark the bounding box in the original context view
+    if box:
+        x0, y0, x1, y1 = scale_box(box, (orig_width, orig_height), (new_orig_width, new_orig_height))
+        draw_dashed_box(canvas, [x0 + crop_width + GUTTER, y0, x1 + crop_width + GUTTER, y1])
+
+    return canvas
+
+def context_filename(image_name, height=CONTEXT_HEIGHT, encoding=DEFAULT_ENCODING):
+    """File name of an original's shared context image at a given height."""
+    return encoded_path(f"context_{os.path.splitext(os.path.basename(image_name))[0]}_{height}.jpg", encoding)
+
+def render_context(original_img, height=CONTEXT_HEIGHT, policy=DEFAULT_POLICY, original_size=None):
+    """
+    Shared context image of an original, at most height pixels tall (never enlarged).
+
+    original_size is the original's full size if original_img was decoded smaller.
+    """
+    orig_width, orig_height = original_size or original_img.size
+    if orig_height <= height and original_img.size == (orig_width, orig_height):
+        return original_img if original_img.mode == "RGB" else original_img.convert("RGB")
+    height = min(height, orig_height)
+    return resample(original_img, (max(1, int(orig_width * height / orig_height)), height), policy)
+
+def scale_box(box, original_size, context_size):
+    """Box coordinates scaled from the original's pixel space into a context image."""
+    scale_x = context_size[0] / original_size[0]
+    scale_y = context_size[1] / original_size[1]
+    return [int(box[0] * scale_x), int(box[1] * scale_y), int(box[2] * scale_x), int(box[3] * scale_y)]
+
+def parse_sizes(text):
+    """Parse a comma-separated list of pixel sizes ("320,640,1280")."""
+    return tuple(sorted(int(size) for size in text.split(",") if size.strip()))
+
+def derivative_path(path, size, encoding=DEFAULT_ENCODING):
+    """Path of an image's rendition with the given long edge."""
+    return encoded_path(f"{os.path.splitext(path)[0]}_{size}w.jpg", encoding)
+
+def write_derivatives(path, sizes=DERIVATIVE_SIZES, policy=DEFAULT_POLICY, quality=JPEG_QUALITY,
+                      encoding=DEFAULT_ENCODING):
+    """
+    Write bounded-size renditions of an image file next to it.
+
+    Only sizes smaller than the image's long edge are written (never enlarged);
+    each is resampled from the next larger rendition rather than from the
+    full-size image.
+
+    Returns:
+        Renditions sorted by width, the full-size file last, as
+        [{"path", "width", "height"}, ...]
+    """
+    with Image.open(path) as image:
+        full_size = image.size
+        long_edge = max(full_size)
+        current = image
+        renditions = []
+        for size in sorted(sizes, reverse=True):
+            if size >= long_edge:
+                continue
+            scale = size / long_edge
+            target = (max(1, round(full_size[0] * scale)), max(1, round(full_size[1] * scale)))
+            current = resample(current, target, policy)
+            rendition_path = save_image(current, derivative_path(path, size, encoding), encoding, quality)
+            renditions.append({"path": rendition_path, "width": target[0], "height": target[1]})
+
+    renditions.reverse()
+    renditions.append({"path": path, "width": full_size[0], "height": full_size[1]})
+    return renditions
+
+def encoding_available(encoding):
+    """Whether this Pillow build can write an encoding profile's format."""
+    image_format = ENCODING_PROFILES[encoding]["format"]
+    return image_format in (None, "JPEG") or bool(features.check(image_format.lower()))
+
+def available_encodings():
+    """Names of the encoding profiles this Pillow build can write."""
+    return [name for name in ENCODING_PROFILES if encoding_available(name)]
+
+def encoded_path(path, encoding=DEFAULT_ENCODING):
+    """Path with the extension of an encoding profile's format (unchanged for legacy)."""
+    image_format = ENCODING_PROFILES[encoding]["format"]
+    if image_format is None:
+        return path
+    return os.path.splitext(path)[0] + FORMAT_EXTENSIONS[image_format]
+
+def encode_image(image, fp, encoding=DEFAULT_ENCODING, quality=None, image_format=None):
+    """
+    Write an image to a path or file object under an encoding profile.
+
+    The profile's quality wins over the caller's; legacy uses the caller's
+    quality (or Pillow's default when None) and nothing else, as before.
+    """
+    profile = ENCODING_PROFILES[encoding]
+    image_format = profile["format"] or image_format
+    quality = profile["quality"] if profile["quality"] is not None else quality
+
+    params = {}
+    if quality is not None:
+        params["quality"] = quality
+    if image_format == "JPEG":
+        params["progressive"] = profile["progressive"]
+        params["optimize"] = profile["optimize"]
+        if profile["subsampling"]:
+            params["subsampling"] = profile["subsampling"]
+    elif image_format == "WEBP" and profile["optimize"]:
+        params["method"] = 6
+    if profile["strip"]:
+        params.update(exif=b"", icc_profile=None, xmp=b"")
+
+    if profile["format"] and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.save(fp, image_format, **params)
+
+def save_image(image, path, encoding=DEFAULT_ENCODING, quality=None):
+    """
+    Save an image under an encoding profile.
+
+    Returns:
+        The path written: path with the profile's extension (see encoded_path)
+    """
+    path = encoded_path(path, encoding)
+    encode_image(image, path, encoding, quality)
+    return path
+
+def encoding_report(paths, encodings=None):
+    """
+    Re-encode images under each encoding profile.
+
+    Every image is decoded once and encoded in memory under each profile;
+    PSNR against the decoded image shows what the saving costs in fidelity.
+
+    Returns:
+        (source_bytes, {encoding: {"bytes", "seconds", "psnr"}}) where
+        source_bytes is the size of the files as they are now
+    """
+    encodings = encodings or available_encodings()
+    results = {name: {"bytes": 0, "seconds": 0.0, "psnr": 0.0} for name in encodings}
+    source_bytes = 0
+    for path in paths:
+        source_bytes += os.path.getsize(path)
+        with Image.open(path) as image:
+            image = image.convert("RGB")
+        for name in encodings:
+            output = io.BytesIO()
+            start = time.perf_counter()
+            encode_image(image, output, name, image_format="JPEG")
+            results[name]["seconds"] += time.perf_counter() - start
+            results[name]["bytes"] += output.tell()
+
+            output.seek(0)
+            with Image.open(output) as decoded:
+                diff = ImageStat.Stat(ImageChops.difference(image, decoded.convert("RGB")))
+            mse = sum(rms ** 2 for rms in diff.rms) / len(diff.rms)
+            results[name]["psnr"] += 100.0 if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+    for result in results.values():
+        result["psnr"] /= max(1, len(paths))
+    return source_bytes, results
+
+def release_composite(canvas):
+    """Return a composite's canvas to the pool once it has been saved."""
+    _canvas_pool.release(canvas)
+
+def open_original(source, crop_height, preset="crop-height", policy=DEFAULT_POLICY):
+    """
+    Open an original for compositing, decoding JPEGs at reduced size when the policy allows.
+
+    Returns:
+        (image, full_size)
+    """
+    original_img = Image.open(source)
+    full_size = original_img.size
+    if RESAMPLING_POLICIES[policy]["draft"]:
+        height = composite_height(LAYOUT_PRESETS[preset], crop_height, full_size[1])
+        original_img.draft("RGB", (int(full_size[0] * height / full_size[1]), height))
+    return original_img, full_size
+
+def create_side_by_side_image(cropped, original, box, output_path, preset="crop-height",
+                              policy=DEFAULT_POLICY, original_size=None, quality=JPEG_QUALITY,
+                              encoding=DEFAULT_ENCODING):
+    """
+    Create and save a side-by-side composite.
+
+    cropped and original may be paths or PIL Images; see compose_side_by_side
+    for the other arguments. The composite is written to
+    encoded_path(output_path, encoding).
+
+    Returns:
+        True if successful, False otherwise
+    """
+    try:
+        cropped_img = Image.open(cropped) if isinstance(cropped, str) else cropped
+        if isinstance(original, str):
+            original_img, original_size = open_original(original, cropped_img.height, preset, policy)
+        else:
+            original_img = original
+
+        composite = compose_side_by_side(cropped_img, original_img, box, preset, policy, original_size)
+        try:
+            save_image(composite, output_path, encoding, quality)
+        finally:
+            release_composite(composite)
+        return True
+    except Exception as e:
+        print(f"Error creating side-by-side image for {output_path}: {e}")
+        return False
+
+def legacy_side_by_side(cropped_img, original_img, box):
+    """The previous per-script implementation (crop-height layout), kept for benchmarking."""
+    crop_width, crop_height = cropped_img.size
+    orig_width, orig_height = original_img.size
+    new_orig_height = crop_height
+    new_orig_width = int(orig_width * (new_orig_height / orig_height))
+    resized_orig = original_img.resize((new_orig_width, new_orig_height), Image.LANCZOS)
+
+    composite = Image.new('RGB', (crop_width + new_orig_width + 20, crop_height + 30), (255, 255, 255))
+    composite.paste(cropped_img, (0, 0))
+    composite.paste(resized_orig, (crop_width + 20, 0))
+    draw = ImageDraw.Draw(composite)
+    draw.line([(crop_width + 10, 0), (crop_width + 10, crop_height)], fill=(200, 200, 200), width=1)
+    try:
+        font = ImageFont.truetype("arial.ttf", 16)
+    except:
+        font = ImageFont.load_default()
+    draw.text((10, crop_height + 5), "Cropped View", fill=(0, 0, 0), font=font)
+    draw.text((crop_width + 30, crop_height + 5), "Original Context", fill=(0, 0, 0), font=font)
+
+    scale = new_orig_height / orig_height
+    x0, y0, x1, y1 = [int(c * scale) for c in box]
+    x0 += crop_width + 20
+    x1 += crop_width + 20
+    for x in range(int(x0), int(x1), DASH_LENGTH + DASH_GAP):
+        end_x = min(x + DASH_LENGTH, x1)
+        draw.line([(x, y0), (end_x, y0)], fill="red", width=2)
+        draw.line([(x, y1), (end_x, y1)], fill="red", width=2)
+    for y in range(int(y0), int(y1), DASH_LENGTH + DASH_GAP):
+        end_y = min(y + DASH_LENGTH, y1)
+        draw.line([(x0, y), (x0, end_y)], fill="red", width=2)
+        draw.line([(x1, y), (x1, end_y)], fill="red", width=2)
+    return composite
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark side-by-side composite throughput")
+
+    parser.add_argument("--count", type=int, default=100,
+                        help="Number of composites per run (default: 100)")
+    parser.add_argument("--original", type=str,
+                        help="Benchmark with a real original image (default: synthetic 4000x3000)")
+    parser.add_argument("--crop-size", type=str, default="320x280",
+                        help="Size of the cropped view (default: 320x280)")
+    parser.add_argument("--preset", type=str, default="crop-height", choices=sorted(LAYOUT_PRESETS),
+                        help="Layout preset to benchmark (default: crop-height)")
+    parser.add_argument("--encoding-report", type=str, metavar="DIR",
+                        help="Report bytes per encoding profile for up to --count images under DIR")
+
+    return parser.parse_args()
+
+def print_encoding_report(directory, count):
+    """Re-encode up to count images under a directory with every profile and print the savings."""
+    paths = []
+    for root, _, files in sorted(os.walk(directory)):
+        paths.extend(os.path.join(root, name) for name in sorted(files)
+                     if os.path.splitext(name)[1].lower() in (".jpg", ".jpeg", ".png", ".webp", ".avif"))
+    paths = paths[:count]
+    if not paths:
+        print(f"No images found under {directory}")
+        return
+
+    unavailable = [name for name in ENCODING_PROFILES if not encoding_available(name)]
+    print(f"Encoding report for {len(paths)} images under {directory}"
+          + (f" (not supported by this Pillow: {', '.join(unavailable)})" if unavailable else ""))
+    source_bytes, results = encoding_report(paths)
+
+    print(f"  {'current':<8} {source_bytes / 1024:10.1f} KB")
+    for name, result in results.items():
+        saved = source_bytes - result["bytes"]
+        print(f"  {name:<8} {result['bytes'] / 1024:10.1f} KB  saved {saved / 1024:10.1f} KB "
+              f"({saved / source_bytes:6.1%})  {result['psnr']:5.1f} dB PSNR  "
+              f"{result['seconds'] / len(paths) * 1000:6.1f} ms/image")
+
+def main():
+    """Benchmark the engine's policies against the previous implementation."""
+    args = parse_arguments()
+
+    if args.encoding_report:
+        print_encoding_report(args.encoding_report, args.count)
+        return
+
+    crop_size = tuple(int(v) for v in args.crop_size.lower().split("x"))
+    if args.original:
+        with Image.open(args.original) as image:
+            original_bytes = io.BytesIO()
+            image.convert("RGB").save(original_bytes, "JPEG", quality=90)
+    else:
+        noise = Image.effect_noise((4000, 3000), 60)
+        synthetic = Image.merge("RGB", (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(Image.FLIP_TOP_BOTTOM)))
+        original_bytes = io.BytesIO()
+        synthetic.save(original_bytes, "JPEG", quality=90)
+    cropped_img = Image.new("RGB", crop_size, (120, 140, 90))
+    box = [1800, 1200, 2100, 1500]
+
+    print(f"Benchmarking {args.count} composites ({args.preset}, crop {crop_size[0]}x{crop_size[1]})")
+
+    def run(build):
+        start = time.perf_counter()
+        total_bytes = 0
+        for _ in range(args.count):
+            original_bytes.seek(0)
+            output = io.BytesIO()
+            build(original_bytes, output)
+            total_bytes += output.tell()
+        elapsed = time.perf_counter() - start
+        return args.count / elapsed, total_bytes / args.count
+
+    def legacy(source, output):
+        legacy_side_by_side(cropped_img, Image.open(source), box).save(output, "JPEG", quality=JPEG_QUALITY)
+
+    baseline_rate, baseline_size = run(legacy)
+    print(f"  {'legacy':<10} {baseline_rate:7.1f} composites/s  {baseline_size / 1024:6.1f} KB avg")
+
+    for policy in RESAMPLING_POLICIES:
+        def engine(source, output):
+            original_img, full_size = open_original(source, crop_size[1], args.preset, policy)
+            composite = compose_side_by_side(cropped_img, original_img, box, args.preset, policy, full_size)
+            composite.save(output, "JPEG", quality=JPEG_QUALITY)
+            release_composite(composite)
+
+        rate, size = run(engine)
+        print(f"  {policy:<10} {rate:7.1f} composites/s  {size / 1024:6.1f} KB avg  ({rate / baseline_rate:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,11 @@ import platform
 import time
 import webbrowser
 import sys
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from detection_index import open_town_index, get_detections
+from composite_engine import DEFAULT_ENCODING, available_encodings, encoded_path, save_image
 
 # Base directories
 BASE_DIR = "data"
@@ -21,6 +26,19 @@ BOX_EXPANSION = 20  # Number of pixels to expand the box in each direction
 # Manual overrides for specific images (if needed)
 MANUAL_OVERRIDES = {}
 
+# Per-town record of what each masked image was rendered from
+MANIFEST_NAME = ".masked_manifest.json"
+
+# Style shared by rendered masked images and view-time overlays
+OVERLAY_STYLE = {
+    "box_color": "red",
+    "box_width": 2,
+    "dash_length": 5,
+    "space_length": 5,
+    "label_color": "blue",
+    "label_offset": 15
+}
+
 # Function to draw dashed rectangle
 def draw_dashed_rectangle(draw, box, color, width=1, dash_length=5, space_length=5):
     """Draw a dashed rectangle on the image."""
@@ -49,8 +67,8 @@ def draw_dashed_rectangle(draw, box, color, width=1, dash_length=5, space_length
         end = max(y - dash_length, y0)
         draw.line([(x0, y), (x0, end)], fill=color, width=width)
 
-def create_masked_image(image_path, detections, output_path):
-    """Create a masked image with bounding boxes and confidence scores."""
+def create_masked_image(image_path, detections, output_path, verbose=False, encoding=DEFAULT_ENCODING):
+    """Create a masked image with bounding boxes and confidence scores, saved under an encoding profile."""
     try:
         # Check if there's a manual override for this image
         town_name = os.path.basename(os.path.dirname(image_path))
@@ -77,7 +95,8 @@ def create_masked_image(image_path, detections, output_path):
             box = [float(coord) for coord in box]
             
             # Print original box coordinates for debugging (console only)
-            print(f"Original box: {box}")
+            if verbose:
+                print(f"Original box: {box}")
             
             # Expand the box by BOX_EXPANSION pixels in each direction
             expanded_box = [
@@ -95,48 +114,282 @@ def create_masked_image(image_path, detections, output_path):
             draw.text((expanded_box[0], text_y_pos), f"Conf: {confidence:.2f}", fill="blue")
         
         # Save the masked image
-        image.save(output_path)
+        save_image(image, output_path, encoding)
         return True
     except Exception as e:
         print(f"Error processing {image_path}: {str(e)}")
         return False
 
-def process_town_images(town):
-    """Process images for a single town."""
-    print(f"\nProcessing town: {town}")
-    
-    # Load bounding box metadata - updated path
+def masked_output_name(image_name, overlay=False, encoding=DEFAULT_ENCODING):
+    """Filename of the masked image (with the encoding's extension), or of its vector overlay in overlay mode."""
+    if overlay:
+        return f"masked_{os.path.splitext(image_name)[0]}.json"
+    return encoded_path(f"masked_{image_name}", encoding)
+
+def build_overlay(image_size, detections):
+    """
+    Build the vector overlay for an image: expanded boxes and their labels.
+
+    Coordinates are in source image pixels; image_size lets viewers scale the
+    overlay to whatever size the image is displayed at.
+    """
+    boxes = []
+    for detection in detections:
+        box = [float(coord) for coord in detection['box']]
+        expanded_box = [
+            box[0] - BOX_EXPANSION,
+            box[1] - BOX_EXPANSION,
+            box[2] + BOX_EXPANSION,
+            box[3] + BOX_EXPANSION
+        ]
+        boxes.append({
+            "box": expanded_box,
+            "confidence": detection['confidence'],
+            "label": f"Conf: {detection['confidence']:.2f}"
+        })
+
+    return {"size": list(image_size), "style": OVERLAY_STYLE, "boxes": boxes}
+
+def create_overlay(image_path, detections, output_path, verbose=False):
+    """Write a compact vector overlay (JSON) instead of a re-encoded masked copy."""
+    try:
+        town_name = os.path.basename(os.path.dirname(image_path))
+        image_name = os.path.basename(image_path)
+        if town_name in MANUAL_OVERRIDES and image_name in MANUAL_OVERRIDES[town_name]:
+            detections = MANUAL_OVERRIDES[town_name][image_name]
+
+        # Only the header is read to get the size - no pixel decode
+        with Image.open(image_path) as image:
+            image_size = image.size
+
+        overlay = build_overlay(image_size, detections)
+        overlay["source"] = image_name
+        with open(output_path, 'w') as f:
+            json.dump(overlay, f)
+        if verbose:
+            print(f"Overlay with {len(detections)} boxes: {output_path}")
+        return True
+    except Exception as e:
+        print(f"Error creating overlay for {image_path}: {str(e)}")
+        return False
+
+def load_overlay(overlay_path):
+    """Load a vector overlay, returning None if it is missing or unreadable."""
+    try:
+        with open(overlay_path, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+def apply_overlay(image, overlay):
+    """
+    Draw an overlay onto an image (in place) at the image's current size.
+
+    Used at display time to show the masked view without a stored masked copy.
+    """
+    style = dict(OVERLAY_STYLE, **overlay.get("style", {}))
+    source_width, source_height = overlay.get("size") or image.size
+    scale_x = image.width / source_width
+    scale_y = image.height / source_height
+
+    draw = ImageDraw.Draw(image)
+    for entry in overlay["boxes"]:
+        x0, y0, x1, y1 = entry["box"]
+        scaled_box = [x0 * scale_x, y0 * scale_y, x1 * scale_x, y1 * scale_y]
+        draw_dashed_rectangle(draw, scaled_box, style["box_color"], width=style["box_width"],
+                              dash_length=style["dash_length"], space_length=style["space_length"])
+        draw.text((scaled_box[0], scaled_box[1] - style["label_offset"]), entry["label"],
+                  fill=style["label_color"])
+    return image
+
+def render_with_overlay(image_path, overlay, output_path, encoding=DEFAULT_ENCODING):
+    """Composite an overlay over the original image and save it under an encoding profile (for external viewers).
+
+    Returns:
+        Path written (with the encoding's extension)
+    """
+    with Image.open(image_path) as source:
+        image = source.convert("RGB")
+    apply_overlay(image, overlay)
+    return save_image(image, output_path, encoding)
+
+def detection_fingerprint(image_path, detections, encoding=DEFAULT_ENCODING):
+    """Fingerprint of everything a masked image depends on: the source file, its detections and the encoding."""
+    stat = os.stat(image_path)
+    digest = hashlib.sha1(json.dumps(detections, sort_keys=True).encode("utf-8")).hexdigest()
+    fingerprint = f"{digest}:{stat.st_mtime_ns}:{stat.st_size}"
+    # Legacy fingerprints stay as they were, so existing manifests remain valid
+    return fingerprint if encoding == DEFAULT_ENCODING else f"{fingerprint}:{encoding}"
+
+def load_manifest(town_output_dir):
+    """Load the masked image manifest for a town (empty if missing or unreadable)."""
+    try:
+        with open(os.path.join(town_output_dir, MANIFEST_NAME), 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_manifest(town_output_dir, manifest):
+    """Write the masked image manifest for a town."""
+    manifest_path = os.path.join(town_output_dir, MANIFEST_NAME)
+    with open(manifest_path + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def is_up_to_date(output_path, fingerprint, manifest_entry, dependency_mtime):
+    """
+    Check whether a masked image can be reused.
+
+    The manifest fingerprint is authoritative, so editing one image's boxes in
+    the town JSON only invalidates that image. Outputs created before the
+    manifest existed fall back to an mtime comparison.
+    """
+    if not os.path.exists(output_path):
+        return False
+    if manifest_entry is not None:
+        return manifest_entry == fingerprint
+    return os.path.getmtime(output_path) >= dependency_mtime
+
+def plan_town_tasks(town, force=False, limit=None, verbose=False, overlay=False, encoding=DEFAULT_ENCODING):
+    """
+    Work out which masked images of a town need rendering.
+
+    Returns:
+        (tasks, manifest, skipped) where each task is a tuple of
+        (town, output_name, input_path, detections, output_path, fingerprint, encoding),
+        or None if the town's bounding box data could not be loaded
+    """
     town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
     bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
     try:
         with open(bbox_file, 'r') as f:
             bbox_data = json.load(f)
-        print(f"Loaded bounding box data for {town}")
+        if verbose:
+            print(f"Loaded bounding box data for {town}")
     except Exception as e:
         print(f"Error loading bounding box data for {town}: {e}")
-        return
-    
+        return None
+
     # Create output directory for this town
     town_output_dir = os.path.join(OUTPUT_DIR, town)
     os.makedirs(town_output_dir, exist_ok=True)
-    
+    manifest = load_manifest(town_output_dir)
+
     # Get list of images in the town directory
     images = [f for f in os.listdir(town_dir) if f.endswith(('.jpg', '.jpeg', '.png'))]
-    
-    print(f"Found {len(images)} images in {town}")
-    
-    # Process each image
-    for image_name in tqdm(images, desc=f"Processing {town}"):
+    if verbose:
+        print(f"Found {len(images)} images in {town}")
+    if limit:
+        images = [img for img in images if img in bbox_data][:limit]
+
+    tasks = []
+    skipped = 0
+    for image_name in images:
+        if image_name not in bbox_data:
+            if verbose:
+                print(f"No bounding box data found for {image_name}")
+            continue
+
         input_path = os.path.join(town_dir, image_name)
-        output_path = os.path.join(town_output_dir, f"masked_{image_name}")
-        
-        if image_name in bbox_data:
-            detections = bbox_data[image_name]
-            success = create_masked_image(input_path, detections, output_path)
-            if success:
-                print(f"Created masked image: {output_path}")
+        output_name = masked_output_name(image_name, overlay, encoding)
+        output_path = os.path.join(town_output_dir, output_name)
+        detections = bbox_data[image_name]
+        if town in MANUAL_OVERRIDES and image_name in MANUAL_OVERRIDES[town]:
+            detections = MANUAL_OVERRIDES[town][image_name]
+
+        fingerprint = detection_fingerprint(input_path, detections, DEFAULT_ENCODING if overlay else encoding)
+        dependency_mtime = max(os.path.getmtime(input_path), os.path.getmtime(bbox_file))
+        if not force and is_up_to_date(output_path, fingerprint, manifest.get(output_name), dependency_mtime):
+            manifest[output_name] = fingerprint
+            skipped += 1
+            continue
+
+        tasks.append((town, output_name, input_path, detections, output_path, fingerprint, encoding))
+
+    return tasks, manifest, skipped
+
+def _render_task(task, verbose=False):
+    """Render one masked image or overlay task (top-level so it can run in a worker process)."""
+    town, output_name, input_path, detections, output_path, fingerprint, encoding = task
+    if output_name.endswith(".json"):
+        success = create_overlay(input_path, detections, output_path, verbose=verbose)
+    else:
+        success = create_masked_image(input_path, detections, output_path, verbose=verbose, encoding=encoding)
+    return town, output_name, fingerprint, success
+
+def _render_task_quiet(task):
+    return _render_task(task)
+
+def _render_task_verbose(task):
+    return _render_task(task, verbose=True)
+
+def render_tasks(tasks, workers=1, verbose=False, desc="Rendering masked images"):
+    """
+    Render masked image tasks, in a process pool when workers > 1.
+
+    Returns:
+        List of (town, image_name, fingerprint, success) tuples
+    """
+    worker = _render_task_verbose if verbose else _render_task_quiet
+    if workers <= 1 or len(tasks) <= 1:
+        return [worker(task) for task in tqdm(tasks, desc=desc)]
+
+    chunksize = max(1, min(32, len(tasks) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(tqdm(executor.map(worker, tasks, chunksize=chunksize), total=len(tasks), desc=desc))
+
+def record_results(results, manifests, verbose=False):
+    """Update town manifests with successfully rendered images and save them."""
+    created = 0
+    failed = 0
+    for town, output_name, fingerprint, success in results:
+        if success:
+            manifests[town][output_name] = fingerprint
+            created += 1
+            if verbose:
+                print(f"Created masked image: {os.path.join(OUTPUT_DIR, town, output_name)}")
         else:
-            print(f"No bounding box data found for {image_name}")
+            manifests[town].pop(output_name, None)
+            failed += 1
+
+    for town, manifest in manifests.items():
+        save_manifest(os.path.join(OUTPUT_DIR, town), manifest)
+
+    return created, failed
+
+def process_towns(towns, workers=1, force=False, verbose=False, limit=None, overlay=False,
+                  encoding=DEFAULT_ENCODING):
+    """
+    Render masked images for several towns in one pool, skipping up-to-date outputs.
+
+    Returns:
+        Dictionary with 'created', 'skipped' and 'failed' counts
+    """
+    all_tasks = []
+    manifests = {}
+    skipped = 0
+    for town in tqdm(towns, desc="Checking towns"):
+        planned = plan_town_tasks(town, force=force, limit=limit, verbose=verbose, overlay=overlay,
+                                  encoding=encoding)
+        if planned is None:
+            continue
+        tasks, manifest, town_skipped = planned
+        all_tasks.extend(tasks)
+        manifests[town] = manifest
+        skipped += town_skipped
+
+    print(f"{len(all_tasks)} masked images to render, {skipped} already up to date")
+    results = render_tasks(all_tasks, workers=workers, verbose=verbose)
+    created, failed = record_results(results, manifests, verbose=verbose)
+
+    print(f"Created {created} masked images ({failed} failed, {skipped} skipped)")
+    return {"created": created, "skipped": skipped, "failed": failed}
+
+def process_town_images(town, workers=1, force=False, verbose=False, overlay=False, encoding=DEFAULT_ENCODING):
+    """Process images for a single town."""
+    print(f"\nProcessing town: {town}")
+    return process_towns([town], workers=workers, force=force, verbose=verbose, overlay=overlay,
+                         encoding=encoding)
 
 def analyze_bounding_boxes():
     """Analyze the JSON files to count images with multiple bounding boxes."""
@@ -241,23 +494,23 @@ def find_images_with_multiple_boxes(min_boxes=2):
     # Process each town
     for town in tqdm(towns, desc="Scanning towns"):
         town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-        bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
         
         try:
-            with open(bbox_file, 'r') as f:
-                bbox_data = json.load(f)
+            # Box counts come from the detection index, so no JSON is parsed here
+            index = open_town_index(town)
+            if index is None:
+                continue
             
             # Find images with multiple bounding boxes
-            for image_name, detections in bbox_data.items():
-                if len(detections) >= min_boxes:
-                    image_path = os.path.join(town_dir, image_name)
-                    if os.path.exists(image_path):
-                        multi_box_images.append({
-                            'town': town,
-                            'image_name': image_name,
-                            'path': image_path,
-                            'box_count': len(detections)
-                        })
+            for image_name, box_count in index.iter_box_counts(min_boxes):
+                image_path = os.path.join(town_dir, image_name)
+                if os.path.exists(image_path):
+                    multi_box_images.append({
+                        'town': town,
+                        'image_name': image_name,
+                        'path': image_path,
+                        'box_count': box_count
+                    })
             
         except Exception as e:
             print(f"Error scanning {town}: {e}")
@@ -268,7 +521,7 @@ def find_images_with_multiple_boxes(min_boxes=2):
     print(f"Found {len(multi_box_images)} images with at least {min_boxes} bounding boxes")
     return multi_box_images
 
-def save_image_paths_to_file(images, output_file="image_paths.txt"):
+def save_image_paths_to_file(images, output_file="image_paths.txt", encoding=DEFAULT_ENCODING):
     """Save a list of image paths to a file for manual viewing."""
     with open(output_file, 'w') as f:
         f.write("# Image Paths for Manual Viewing\n")
@@ -280,7 +533,7 @@ def save_image_paths_to_file(images, output_file="image_paths.txt"):
             
             # Calculate masked image path
             town_output_dir = os.path.join(OUTPUT_DIR, img['town'])
-            masked_path = os.path.join(town_output_dir, f"masked_{img['image_name']}")
+            masked_path = os.path.join(town_output_dir, masked_output_name(img['image_name'], encoding=encoding))
             
             if os.path.exists(masked_path):
                 f.write(f"Masked: {os.path.abspath(masked_path)}\n")
@@ -293,12 +546,14 @@ def save_image_paths_to_file(images, output_file="image_paths.txt"):
     print("You can open this file and copy-paste paths to your file explorer")
     return os.path.abspath(output_file)
 
-def manual_viewer(min_boxes=2, vscode_mode=False):
+def manual_viewer(min_boxes=2, vscode_mode=False, overlay=False, encoding=DEFAULT_ENCODING):
     """Interactive viewer for images with multiple bounding boxes.
     
     Args:
         min_boxes: Minimum number of boxes required (default: 2)
         vscode_mode: If True, save paths to file instead of trying to open directly
+        overlay: If True, store vector overlays and composite them when viewing
+        encoding: Encoding profile of the masked images (and overlay previews)
     """
     # Find all images with multiple boxes
     multi_box_images = find_images_with_multiple_boxes(min_boxes)
@@ -314,7 +569,7 @@ def manual_viewer(min_boxes=2, vscode_mode=False):
     # In VS Code mode, just save paths and exit
     if vscode_mode:
         paths_file = os.path.join(viewer_dir, "image_paths.txt")
-        save_image_paths_to_file(multi_box_images, paths_file)
+        save_image_paths_to_file(multi_box_images, paths_file, encoding=encoding)
         
         # Process all images to create masked versions
         print("\nCreating masked versions of all images...")
@@ -326,18 +581,13 @@ def manual_viewer(min_boxes=2, vscode_mode=False):
             # Create masked version
             town_output_dir = os.path.join(OUTPUT_DIR, town)
             os.makedirs(town_output_dir, exist_ok=True)
-            masked_path = os.path.join(town_output_dir, f"masked_{image_name}")
+            masked_path = os.path.join(town_output_dir, masked_output_name(image_name, encoding=encoding))
             
             if not os.path.exists(masked_path):
-                # Load bounding box data
-                bbox_file = os.path.join(TRUE_POSITIVE_DIR, town, f"true_positive_bboxes_hf_{town}.json")
                 try:
-                    with open(bbox_file, 'r') as f:
-                        bbox_data = json.load(f)
-                    
-                    # Create masked image
-                    detections = bbox_data[image_name]
-                    create_masked_image(image_path, detections, masked_path)
+                    # Look up this image's boxes in the detection index
+                    detections = get_detections(town, image_name)
+                    create_masked_image(image_path, detections, masked_path, encoding=encoding)
                 except Exception as e:
                     print(f"Error creating masked image for {town}/{image_name}: {e}")
         
@@ -369,21 +619,22 @@ def manual_viewer(min_boxes=2, vscode_mode=False):
         image_path = image_info['path']
         box_count = image_info['box_count']
         
-        # Create masked version if it doesn't exist
+        # Create masked version (or its overlay) if it doesn't exist
         town_output_dir = os.path.join(OUTPUT_DIR, town)
         os.makedirs(town_output_dir, exist_ok=True)
-        masked_path = os.path.join(town_output_dir, f"masked_{image_name}")
+        masked_path = os.path.join(town_output_dir, masked_output_name(image_name, encoding=encoding))
+        overlay_path = os.path.join(town_output_dir, masked_output_name(image_name, overlay=True))
+        if overlay:
+            masked_path = overlay_path
         
         if not os.path.exists(masked_path):
-            # Load bounding box data
-            bbox_file = os.path.join(TRUE_POSITIVE_DIR, town, f"true_positive_bboxes_hf_{town}.json")
             try:
-                with open(bbox_file, 'r') as f:
-                    bbox_data = json.load(f)
-                
-                # Create masked image
-                detections = bbox_data[image_name]
-                create_masked_image(image_path, detections, masked_path)
+                # Look up this image's boxes in the detection index
+                detections = get_detections(town, image_name)
+                if overlay:
+                    create_overlay(image_path, detections, masked_path)
+                else:
+                    create_masked_image(image_path, detections, masked_path, encoding=encoding)
                 print(f"Created masked image: {masked_path}")
             except Exception as e:
                 print(f"Error creating masked image: {e}")
@@ -410,19 +661,24 @@ def manual_viewer(min_boxes=2, vscode_mode=False):
                 print(f"Failed to open image automatically.")
                 print(f"Try opening it manually at: {os.path.abspath(image_path)}")
         elif cmd == 'm':
-            print(f"Opening masked image: {masked_path}")
-            success = open_file(masked_path)
+            view_path = masked_path
+            if overlay:
+                # Composite the overlay over the original only for this view
+                try:
+                    view_path = render_with_overlay(image_path, load_overlay(overlay_path),
+                                                    os.path.join(viewer_dir, "masked_preview.jpg"), encoding)
+                except Exception as e:
+                    print(f"Error compositing overlay: {e}")
+                    continue
+            print(f"Opening masked image: {view_path}")
+            success = open_file(view_path)
             if not success:
                 print(f"Failed to open image automatically.")
                 print(f"Try opening it manually at: {os.path.abspath(masked_path)}")
         elif cmd == 'i':
-            # Load bounding box data to show detailed info
-            bbox_file = os.path.join(TRUE_POSITIVE_DIR, town, f"true_positive_bboxes_hf_{town}.json")
+            # Look up detailed box info in the detection index
             try:
-                with open(bbox_file, 'r') as f:
-                    bbox_data = json.load(f)
-                
-                detections = bbox_data[image_name]
+                detections = get_detections(town, image_name)
                 print("\nDetailed bounding box information:")
                 for i, detection in enumerate(detections):
                     box = detection['box']
@@ -438,7 +694,7 @@ def manual_viewer(min_boxes=2, vscode_mode=False):
                 else:
                     # Restart viewer with new filter
                     print(f"Restarting viewer with minimum {new_min} boxes...")
-                    return manual_viewer(new_min, vscode_mode=vscode_mode)
+                    return manual_viewer(new_min, vscode_mode=vscode_mode, overlay=overlay, encoding=encoding)
             except ValueError:
                 print("Please enter a valid number")
         elif cmd == 'o':
@@ -462,6 +718,11 @@ def main():
     parser.add_argument('--viewer', action='store_true', help='Launch interactive viewer for images with multiple boxes')
     parser.add_argument('--min-boxes', type=int, default=2, help='Minimum number of boxes for viewer (default: 2)')
     parser.add_argument('--vscode', action='store_true', help='VS Code terminal mode: save paths to file instead of opening directly')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes for rendering (default: number of CPUs, 1 = serial)')
+    parser.add_argument('--force', action='store_true', help='Re-render masked images even if they are up to date')
+    parser.add_argument('--verbose', action='store_true', help='Print per-box and per-image progress')
+    parser.add_argument('--overlay', action='store_true', help='Store compact vector overlays (masked_*.json) instead of re-encoded masked copies')
+    parser.add_argument('--encoding', type=str, default=DEFAULT_ENCODING, choices=available_encodings(), help=f'Encoding profile for masked images (default: {DEFAULT_ENCODING})')
     args = parser.parse_args()
     
     # Create base output directory
@@ -475,7 +736,8 @@ def main():
     
     # Launch manual viewer if requested
     if args.viewer:
-        manual_viewer(args.min_boxes, vscode_mode=in_vscode)
+        manual_viewer(args.min_boxes, vscode_mode=in_vscode, overlay=args.overlay and not in_vscode,
+                      encoding=args.encoding)
         return
     
     # Analyze bounding box data if requested
@@ -497,7 +759,7 @@ def main():
             
         town_output_dir = os.path.join(OUTPUT_DIR, town)
         os.makedirs(town_output_dir, exist_ok=True)
-        output_path = os.path.join(town_output_dir, f"masked_{image_name}")
+        output_path = os.path.join(town_output_dir, masked_output_name(image_name, args.overlay, args.encoding))
         
         # Check if we have a manual override
         if town in MANUAL_OVERRIDES and image_name in MANUAL_OVERRIDES[town]:
@@ -518,7 +780,10 @@ def main():
                 print(f"Error loading bounding box data: {e}")
                 return
         
-        success = create_masked_image(input_path, detections, output_path)
+        if args.overlay:
+            success = create_overlay(input_path, detections, output_path)
+        else:
+            success = create_masked_image(input_path, detections, output_path, encoding=args.encoding)
         if success:
             print(f"Created masked image: {output_path}")
         return
@@ -546,70 +811,24 @@ def main():
         # Process the test town with limited images
         print(f"TEST MODE: Processing town '{test_town}' with limit of {args.limit} images")
         
-        # Modify process_town_images for test mode
-        test_process_town(test_town, limit=args.limit)
+        test_process_town(test_town, limit=args.limit, workers=args.workers, force=args.force, overlay=args.overlay,
+                          encoding=args.encoding)
         
         print(f"Test completed. Check the output directory: {os.path.join(OUTPUT_DIR, test_town)}")
     else:
-        # Normal mode - process all towns
+        # Normal mode - process all towns in a single pool
         towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) 
                 if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
         
         print(f"Found {len(towns)} towns to process")
-        
-        # Process each town
-        for town in tqdm(towns, desc="Processing towns"):
-            process_town_images(town)
+        process_towns(towns, workers=args.workers, force=args.force, verbose=args.verbose, overlay=args.overlay,
+                      encoding=args.encoding)
 
-def test_process_town(town, limit=5):
+def test_process_town(town, limit=5, workers=1, force=False, overlay=False, encoding=DEFAULT_ENCODING):
     """Process a limited number of images from a town for testing."""
     print(f"\nTEST: Processing town: {town}")
-    
-    # Load bounding box metadata - updated path
-    town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-    bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
-    try:
-        with open(bbox_file, 'r') as f:
-            bbox_data = json.load(f)
-        print(f"Loaded bounding box data for {town}")
-        
-        # Print a sample of the data structure
-        sample_image = next(iter(bbox_data))
-        print(f"\nSample data structure for image '{sample_image}':")
-        print(json.dumps(bbox_data[sample_image][:1], indent=2))
-    except Exception as e:
-        print(f"Error loading bounding box data for {town}: {e}")
-        return
-    
-    # Create output directory for this town
-    town_output_dir = os.path.join(OUTPUT_DIR, town)
-    os.makedirs(town_output_dir, exist_ok=True)
-    
-    # Get list of images in the town directory
-    all_images = [f for f in os.listdir(town_dir) if f.endswith(('.jpg', '.jpeg', '.png'))]
-    
-    # Filter to only images that have bounding box data
-    images_with_data = [img for img in all_images if img in bbox_data]
-    
-    if not images_with_data:
-        print(f"No images with bounding box data found for {town}")
-        return
-    
-    # Limit the number of images to process
-    test_images = images_with_data[:min(limit, len(images_with_data))]
-    
-    print(f"TEST: Found {len(all_images)} total images, {len(images_with_data)} with bounding box data")
-    print(f"TEST: Processing {len(test_images)} images")
-    
-    # Process each test image
-    for image_name in tqdm(test_images, desc=f"Processing test images for {town}"):
-        input_path = os.path.join(town_dir, image_name)
-        output_path = os.path.join(town_output_dir, f"masked_{image_name}")
-        
-        detections = bbox_data[image_name]
-        success = create_masked_image(input_path, detections, output_path)
-        if success:
-            print(f"Created masked image: {output_path}")
+    return process_towns([town], workers=workers, force=force, verbose=True, limit=limit, overlay=overlay,
+                         encoding=encoding)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Memory-Mapped Detection Index
+
+This script builds a compact binary index of each town's bounding box JSON
+(true_positive_bboxes_hf_{TOWN}.json) so interactive tools can look up one
+image's detections without parsing the whole file. Each index holds an
+open-addressing hash table from image name to record offset and is read
+through mmap, so a lookup touches only a few pages.
+
+Indexes are rebuilt automatically when the source JSON changes (checked at
+most every few seconds per town).
+
+File layout (little-endian):
+    header   magic, version, slot count, record count, max boxes, source mtime/size, records offset
+    slots    (name hash, record offset, box count) per slot, empty slots have offset 0
+    records  name length, UTF-8 name, box count, then (x0, y0, x1, y1, confidence) doubles per box
+
+Usage:
+    python scripts/detection_index.py [options]
+
+Options:
+    --town TOWN              Build the index for one town only (default: all towns)
+    --force                  Rebuild even if the index is up to date
+    --lookup IMAGE           Print the detections of one image (requires --town)
+"""
+
+import os
+import json
+import argparse
+import hashlib
+import mmap
+import struct
+import threading
+import time
+
+# Base directories
+BASE_DIR = "data"
+TRUE_POSITIVE_DIR = os.path.join(BASE_DIR, "true_positive_images")
+INDEX_DIR = os.path.join(BASE_DIR, "detection_index")
+
+MAGIC = b"FDIX"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIIQQQ")
+SLOT = struct.Struct("<QQII")
+NAME_HEADER = struct.Struct("<H")
+BOX_COUNT = struct.Struct("<I")
+BOX = struct.Struct("<5d")
+
+# Opened indexes, keyed by town: (index, time of its last freshness check),
+# shared by viewer worker threads
+_open_indexes = {}
+_open_lock = threading.Lock()
+
+# Seconds between checks that an opened index still matches its JSON
+FRESHNESS_INTERVAL = 2.0
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Build memory-mapped detection indexes")
+
+    parser.add_argument("--town", type=str,
+                        help="Build the index for one town only (default: all towns)")
+    parser.add_argument("--force", action="store_true",
+                        help="Rebuild even if the index is up to date")
+    parser.add_argument("--lookup", type=str,
+                        help="Print the detections of one image (requires --town)")
+
+    return parser.parse_args()
+
+def bbox_file_for(town):
+    return os.path.join(TRUE_POSITIVE_DIR, town, f"true_positive_bboxes_hf_{town}.json")
+
+def index_file_for(town):
+    return os.path.join(INDEX_DIR, f"{town}.idx")
+
+def name_hash(name):
+    """64-bit hash of an image name (never 0, which marks an empty slot)."""
+    value = int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little")
+    return value or 1
+
+def build_index(bbox_file, index_path):
+    """
+    Build a binary index from a town's bounding box JSON.
+
+    Returns:
+        Number of images indexed
+    """
+    with open(bbox_file, 'r') as f:
+        bbox_data = json.load(f)
+    stat = os.stat(bbox_file)
+
+    # Power-of-two table at most half full keeps probe sequences short
+    n_slots = 8
+    while n_slots < 2 * len(bbox_data):
+        n_slots *= 2
+    records_offset = HEADER.size + n_slots * SLOT.size
+
+    slots = [None] * n_slots
+    records = bytearray()
+    max_boxes = 0
+    for image_name, detections in bbox_data.items():
+        offset = records_offset + len(records)
+        encoded = image_name.encode("utf-8")
+        records += NAME_HEADER.pack(len(encoded)) + encoded + BOX_COUNT.pack(len(detections))
+        for detection in detections:
+            records += BOX.pack(*[float(coord) for coord in detection['box']], float(detection['confidence']))
+        max_boxes = max(max_boxes, len(detections))
+
+        hashed = name_hash(image_name)
+        slot = hashed & (n_slots - 1)
+        while slots[slot] is not None:
+            slot = (slot + 1) & (n_slots - 1)
+        slots[slot] = (hashed, offset, len(detections))
+
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n_slots, len(bbox_data), max_boxes,
+                            stat.st_mtime_ns, stat.st_size, records_offset))
+        empty = SLOT.pack(0, 0, 0, 0)
+        f.write(b"".join(SLOT.pack(*entry, 0) if entry else empty for entry in slots))
+        f.write(records)
+    os.replace(tmp_path, index_path)
+
+    return len(bbox_data)
+
+def is_index_current(bbox_file, index_path):
+    """Check whether an index was built from the current version of its JSON file."""
+    try:
+        stat = os.stat(bbox_file)
+        with open(index_path, 'rb') as f:
+            header = HEADER.unpack(f.read(HEADER.size))
+    except (OSError, struct.error):
+        return False
+
+    magic, version, _, _, _, source_mtime, source_size, _ = header
+    return (magic == MAGIC and version == VERSION and
+            source_mtime == stat.st_mtime_ns and source_size == stat.st_size)
+
+class DetectionIndex:
+    """Read-only, memory-mapped view of one town's detection index."""
+
+    def __init__(self, index_path):
+        self.path = index_path
+        self._file = open(index_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.n_slots, self.n_records, self.max_boxes,
+         self.source_mtime, self.source_size, self.records_offset) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"Not a detection index (version {VERSION}): {index_path}")
+
+    def __len__(self):
+        return self.n_records
+
+    def __contains__(self, image_name):
+        return self._find(image_name) is not None
+
+    def is_current(self, bbox_file):
+        """Check whether this index was built from the current version of its JSON file."""
+        try:
+            stat = os.stat(bbox_file)
+        except OSError:
+            return False
+        return self.source_mtime == stat.st_mtime_ns and self.source_size == stat.st_size
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _read_name(self, offset):
+        (length,) = NAME_HEADER.unpack_from(self._map, offset)
+        start = offset + NAME_HEADER.size
+        return self._map[start:start + length].decode("utf-8"), start + length
+
+    def _find(self, image_name):
+        """Return the record offset for an image name, or None."""
+        hashed = name_hash(image_name)
+        mask = self.n_slots - 1
+        slot = hashed & mask
+        while True:
+            slot_hash, offset, _, _ = SLOT.unpack_from(self._map, HEADER.size + slot * SLOT.size)
+            if offset == 0:
+                return None
+            if slot_hash == hashed and self._read_name(offset)[0] == image_name:
+                return offset
+            slot = (slot + 1) & mask
+
+    def _read_detections(self, offset):
+        _, position = self._read_name(offset)
+        (count,) = BOX_COUNT.unpack_from(self._map, position)
+        position += BOX_COUNT.size
+
+        detections = []
+        for x0, y0, x1, y1, confidence in BOX.iter_unpack(self._map[position:position + count * BOX.size]):
+            detections.append({'box': [x0, y0, x1, y1], 'confidence': confidence})
+        return detections
+
+    def get(self, image_name, default=None):
+        """Detections for one image in the same format as the bbox JSON."""
+        offset = self._find(image_name)
+        if offset is None:
+            return default
+        return self._read_detections(offset)
+
+    def box_count(self, image_name):
+        offset = self._find(image_name)
+        if offset is None:
+            return 0
+        _, position = self._read_name(offset)
+        return BOX_COUNT.unpack_from(self._map, position)[0]
+
+    def iter_box_counts(self, min_boxes=0, max_boxes=None):
+        """
+        Yield (image_name, box_count) for images in a box count range.
+
+        Box counts are stored in the slot table, so images outside the range
+        are skipped without reading their records.
+        """
+        table = self._map[HEADER.size:self.records_offset]
+        for _, offset, count, _ in SLOT.iter_unpack(table):
+            if offset == 0 or count < min_boxes or (max_boxes is not None and count > max_boxes):
+                continue
+            yield self._read_name(offset)[0], count
+
+def open_town_index(town, rebuild=True):
+    """
+    Open (building or refreshing if needed) the detection index for a town.
+
+    An opened index is checked against its JSON at most every
+    FRESHNESS_INTERVAL seconds. A stale index is replaced rather than closed,
+    so threads still reading it keep a valid mapping; it is released once
+    nothing refers to it. (Rebuilds replace the index file atomically, so the
+    old mapping stays intact.)
+
+    Returns:
+        DetectionIndex, or None if the town has no bounding box data
+    """
+    cached = _open_indexes.get(town)
+    if cached is not None and time.monotonic() - cached[1] < FRESHNESS_INTERVAL:
+        return cached[0]
+
+    bbox_file = bbox_file_for(town)
+    index_path = index_file_for(town)
+
+    with _open_lock:
+        now = time.monotonic()
+        cached = _open_indexes.get(town)
+        if cached is not None:
+            index, checked_at = cached
+            # Another thread may have checked it while this one waited for the lock
+            if now - checked_at < FRESHNESS_INTERVAL:
+                return index
+            if index.is_current(bbox_file):
+                _open_indexes[town] = (index, now)
+                return index
+
+        if not os.path.exists(bbox_file):
+            _open_indexes.pop(town, None)
+            return None
+        if rebuild and not is_index_current(bbox_file, index_path):
+            build_index(bbox_file, index_path)
+
+        index = DetectionIndex(index_path)
+        _open_indexes[town] = (index, now)
+        return index
+
+def get_detections(town, image_name):
+    """Detections for one image, read through the town's index."""
+    index = open_town_index(town)
+    if index is None:
+        return None
+    return index.get(image_name)
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    if args.lookup:
+        if not args.town:
+            print("--lookup requires --town")
+            return
+        start = time.perf_counter()
+        detections = get_detections(args.town, args.lookup)
+        elapsed = time.perf_counter() - start
+        if detections is None:
+            print(f"No bounding box data found for {args.town}/{args.lookup}")
+            return
+        for i, detection in enumerate(detections):
+            print(f"  Box {i+1}: {detection['box']}, Confidence: {detection['confidence']:.2f}")
+        print(f"Lookup took {elapsed * 1e6:.0f} us (including opening the index)")
+        return
+
+    if args.town:
+        towns = [args.town]
+    else:
+        towns = [d for d in os.listdir(TRUE_POSITIVE_DIR)
+                 if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
+
+    built = 0
+    for town in sorted(towns):
+        bbox_file = bbox_file_for(town)
+        index_path = index_file_for(town)
+        if not os.path.exists(bbox_file):
+            print(f"No bounding box data for {town}, skipping")
+            continue
+        if not args.force and is_index_current(bbox_file, index_path):
+            continue
+        try:
+            count = build_index(bbox_file, index_path)
+            built += 1
+            print(f"Indexed {count} images for {town}: {index_path}")
+        except Exception as e:
+            print(f"Error indexing {town}: {e}")
+
+    print(f"\nBuilt {built} indexes ({len(towns) - built} already up to date or skipped)")
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,23 @@ const projectRoot = path.resolve(__dirname, '..');
 const imagesDir = path.join(projectRoot, 'public', 'images');
 const staticDir = path.join(projectRoot, 'public', 'static');
 
+// Layered output: shared context image and box position per crop (written by sample_cropped_for_public.py --layered)
+const layerManifestPath = path.join(imagesDir, 'layers.json');
+const layers = fs.existsSync(layerManifestPath)
+  ? JSON.parse(fs.readFileSync(layerManifestPath, 'utf8'))
+  : {};
+
+// Responsive renditions per published image (written by sample_cropped_for_public.py --derivatives)
+const renditionManifestPath = path.join(imagesDir, 'derivatives.json');
+const renditions = fs.existsSync(renditionManifestPath)
+  ? JSON.parse(fs.readFileSync(renditionManifestPath, 'utf8'))
+  : {};
+
+// srcset attribute for a list of {src, width, height} renditions
+function toSrcset(entries) {
+  return entries.map(entry => `${entry.src} ${entry.width}w`).join(', ');
+}
+
 // Function to get all images recursively
 function getAllImages(dir) {
   let results = [];
@@ -26,7 +43,7 @@ function getAllImages(dir) {
         // If it's a directory (town folder), get images inside
         const nestedImages = getAllImages(itemPath);
         results = results.concat(nestedImages);
-      } else if (stat.isFile() && /\.(jpg|jpeg|png|gif)$/i.test(item)) {
+      } else if (stat.isFile() && /\.(jpg|jpeg|png|gif|webp|avif)$/i.test(item)) {
         // If it's an image file
         const town = path.basename(dir); // Get the town name from directory
         const relativePath = itemPath.replace(path.join(projectRoot, 'public'), '');
@@ -43,11 +60,40 @@ function getAllImages(dir) {
           filename: item
         };
         
-        // Check if this is a boxed image (has _box{number}.jpg in filename but not _boxed.jpg)
+        // Shared context images are drawn behind their crops, and renditions
+        // (name_320w.jpg) are reached through srcset; neither is listed on its own
+        if (item.startsWith('context_') || /_\d+w\.(jpg|webp|avif)$/i.test(item)) {
+          continue;
+        }
+        
+        // srcset-ready renditions; the full-size entry gives the intrinsic size
+        if (renditions[item]) {
+          const full = renditions[item][renditions[item].length - 1];
+          imageInfo.srcset = toSrcset(renditions[item]);
+          imageInfo.renditions = renditions[item];
+          imageInfo.width = full.width;
+          imageInfo.height = full.height;
+        }
+        
+        // Layered crops carry their context image and box instead of a composite
+        if (layers[item]) {
+          imageInfo.context_image = layers[item].context_image;
+          imageInfo.context_size = layers[item].context_size;
+          imageInfo.context_box = layers[item].context_box;
+          imageInfo.has_context = true;
+          
+          const contextFilename = layers[item].context_image.split('/').pop();
+          if (renditions[contextFilename]) {
+            imageInfo.context_srcset = toSrcset(renditions[contextFilename]);
+            imageInfo.context_renditions = renditions[contextFilename];
+          }
+        }
+        
+        // Check if this is a boxed image (has _box{number}.jpg/.webp/.avif in filename but not _boxed.jpg)
         // Skip adding composite info for files that are already composite files
-        if (!item.startsWith('composite_')) {
+        else if (!item.startsWith('composite_')) {
           const isBoxed = item.includes('_boxed');
-          const isBoxed2 = /_box\d+\.jpg$/.test(item); // Matches _box0.jpg, _box1.jpg etc.
+          const isBoxed2 = /_box\d+\.(jpg|webp|avif)$/.test(item); // Matches _box0.jpg, _box1.webp etc.
           const needsComposite = !isBoxed && isBoxed2;
           
           if (needsComposite) {
@@ -57,6 +103,9 @@ function getAllImages(dir) {
             
             // Add composite information
             imageInfo.composite_image = compositePath;
+            if (renditions[compositeFilename]) {
+              imageInfo.composite_srcset = toSrcset(renditions[compositeFilename]);
+            }
             imageInfo.has_composite = true;
             
             // Debug info
@@ -6,20 +6,32 @@ This script identifies images with the largest number of bounding boxes,
 creates visualizations with dashed lines and confidence scores, and
 saves them in a format suitable for academic documentation.
 
+Candidates are ranked by box count through the per-town detection indexes
+(see detection_index.py), so only the selected images' detections are read.
+Figures are rendered in parallel worker processes with the Agg backend, and
+every panel is resampled to its final pixel footprint (from the GridSpec
+layout and --dpi) before plotting. --renderer pillow composes the panel grids
+directly with Pillow and skips matplotlib altogether.
+
 Usage:
-    python generate_example_visualizations.py --num-examples 5 --output-dir figures
+    python generate_example_visualizations.py --num-examples 5 --output-dir figures [--workers N] [--renderer pillow]
 """
 
 import os
-import json
 import argparse
-from PIL import Image, ImageDraw, ImageFont
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageDraw, ImageFont, ImageChops
 import numpy as np
 from collections import defaultdict
+import matplotlib
+matplotlib.use("Agg")  # Figures are only saved to disk, also from worker processes
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 
+from detection_index import open_town_index
+
 # Base directories (same as in prepare_images_for_classification.py)
 BASE_DIR = "data"
 TRUE_POSITIVE_DIR = os.path.join(BASE_DIR, "true_positive_images")
@@ -35,42 +47,75 @@ def parse_arguments():
                         help="DPI for output figures")
     parser.add_argument("--include-cropped", action="store_true", default=True,
                         help="Include cropped versions of selected boxes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of figure rendering processes (default: CPU count)")
+    parser.add_argument("--renderer", type=str, default="matplotlib", choices=["matplotlib", "pillow"],
+                        help="Figure renderer: matplotlib, or pillow to compose the panel grids directly")
     return parser.parse_args()
 
+def top_images_by_box_count(town, k, min_boxes):
+    """
+    The k images of a town with the most boxes (at least min_boxes), most first.
+    
+    Box counts come from the town's detection index; a bounded heap keeps only
+    the current top k, and image files are checked only when they would enter it.
+    
+    Returns:
+        List of (box_count, image_name)
+    """
+    index = open_town_index(town)
+    if index is None:
+        return []
+    
+    town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
+    heap = []  # (box_count, -scan_order, image_name), smallest on top
+    for order, (image_name, box_count) in enumerate(index.iter_box_counts(min_boxes)):
+        entry = (box_count, -order, image_name)
+        if len(heap) == k and entry <= heap[0]:
+            continue
+        if not os.path.exists(os.path.join(town_dir, image_name)):
+            continue
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heapreplace(heap, entry)
+    
+    return [(box_count, image_name) for box_count, _, image_name in sorted(heap, reverse=True)]
+
+def load_example(town, image_name, box_count):
+    """Example record for one image, with its detections read from the index."""
+    return {
+        'town': town,
+        'image_name': image_name,
+        'path': os.path.join(TRUE_POSITIVE_DIR, town, image_name),
+        'box_count': box_count,
+        'detections': open_town_index(town).get(image_name)
+    }
+
 def find_extreme_examples(num_examples=5):
     """Find images with the largest number of bounding boxes."""
     towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) 
              if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
     
-    # Collect all images with their box counts
-    all_images = []
-    
+    # Per-town top k, merged into the overall top k
+    candidates = []
     for town in towns:
-        town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-        bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
-        
         try:
-            with open(bbox_file, 'r') as f:
-                bbox_data = json.load(f)
-            
-            for image_name, detections in bbox_data.items():
-                box_count = len(detections)
-                if box_count > 10:  # Only consider images with many boxes
-                    image_path = os.path.join(town_dir, image_name)
-                    if os.path.exists(image_path):
-                        all_images.append({
-                            'town': town,
-                            'image_name': image_name,
-                            'path': image_path,
-                            'box_count': box_count,
-                            'detections': detections
-                        })
+            # Only consider images with many boxes
+            for box_count, image_name in top_images_by_box_count(town, num_examples, min_boxes=11):
+                candidates.append((box_count, town, image_name))
         except Exception as e:
             print(f"Error scanning {town}: {e}")
     
-    # Sort by box count (descending) and get the top examples
-    all_images.sort(key=lambda x: x['box_count'], reverse=True)
-    return all_images[:num_examples]
+    top = heapq.nlargest(num_examples, candidates, key=lambda x: x[0])
+    return [load_example(town, image_name, box_count) for box_count, town, image_name in top]
+
+def load_annotated_example(example):
+    """Load an example's original image and a copy with all its boxes drawn."""
+    original_image = Image.open(example['path'])
+    original_image.load()
+    annotated_image = draw_boxes_with_confidence(original_image.copy(), example['detections'], line_width=2)
+    return original_image, annotated_image
 
 def draw_boxes_with_confidence(image, detections, line_width=1):
     """Draw bounding boxes with dashed lines and confidence scores."""
@@ -152,19 +197,122 @@ def create_crop_with_context(image, box, padding=50):
     
     return cropped_img, relative_box
 
-def generate_figure(example, args, figure_index):
-    """Generate an academic-quality figure of the example image with annotations."""
+def downsample_to_fit(image, width, height):
+    """
+    Shrink an image to fit within width x height pixels, keeping its aspect ratio.
+    
+    Large integer factors are taken with reduce() before the final Lanczos
+    resample. Images that already fit are returned unchanged.
+    """
+    scale = min(width / image.width, height / image.height)
+    if scale >= 1:
+        return image
+    
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    factor = min(image.width // target[0], image.height // target[1])
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image.resize(target, Image.LANCZOS)
+
+def render_grid_matplotlib(rows, suptitle, figsize, output_path, dpi, height_ratios=None):
+    """
+    Render a grid of titled image panels with matplotlib.
+    
+    The layout is settled first, then each image is resampled to its panel's
+    final pixel footprint at the output DPI, so imshow never receives pixels
+    that cannot reach the saved figure.
+    """
+    fig = plt.figure(figsize=figsize)
+    gs = gridspec.GridSpec(len(rows), max(len(row) for row in rows), height_ratios=height_ratios)
+    
+    panels = []
+    for r, row in enumerate(rows):
+        for c, (title, image) in enumerate(row):
+            ax = fig.add_subplot(gs[r, c])
+            ax.set_title(title)
+            ax.axis('off')
+            panels.append((ax, image))
+    
+    # Add overall figure title
+    fig.suptitle(suptitle, fontsize=16, y=0.98)
+    fig.tight_layout(rect=[0, 0, 1, 0.96])
+    
+    fig_width, fig_height = fig.get_size_inches()
+    for ax, image in panels:
+        position = ax.get_position()
+        image = downsample_to_fit(image, position.width * fig_width * dpi, position.height * fig_height * dpi)
+        ax.imshow(np.asarray(image))
+    
+    fig.savefig(output_path, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+
+def load_figure_font(points, dpi):
+    """DejaVu Sans (bundled with matplotlib) at a point size for the given DPI."""
+    from matplotlib import font_manager
     try:
-        # Load the original image
-        original_image = Image.open(example['path'])
+        return ImageFont.truetype(font_manager.findfont("DejaVu Sans"), max(1, round(points * dpi / 72)))
+    except Exception:
+        return ImageFont.load_default()
+
+def render_grid_pillow(rows, suptitle, figsize, output_path, dpi, height_ratios=None):
+    """
+    Render a grid of titled image panels directly with Pillow.
+    
+    Mirrors the matplotlib layout (12 pt panel titles, 16 pt figure title,
+    white margins trimmed like bbox_inches='tight') without building a figure.
+    """
+    width, height = round(figsize[0] * dpi), round(figsize[1] * dpi)
+    title_font = load_figure_font(12, dpi)
+    suptitle_font = load_figure_font(16, dpi)
+    margin = round(0.1 * dpi)
+    title_height = round(12 * dpi / 72 * 1.6)
+    suptitle_height = round(16 * dpi / 72 * 2)
+    
+    canvas = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(canvas)
+    draw.text((width // 2, margin), suptitle, fill="black", font=suptitle_font, anchor="mt")
+    
+    n_cols = max(len(row) for row in rows)
+    ratios = height_ratios or [1] * len(rows)
+    cell_width = (width - 2 * margin) / n_cols
+    grid_height = height - suptitle_height - 2 * margin
+    
+    y = margin + suptitle_height
+    for row, ratio in zip(rows, ratios):
+        cell_height = grid_height * ratio / sum(ratios)
+        for c, (title, image) in enumerate(row):
+            x = margin + c * cell_width
+            draw.text((round(x + cell_width / 2), round(y)), title, fill="black", font=title_font, anchor="mt")
+            
+            image = downsample_to_fit(image.convert("RGB"), cell_width - margin,
+                                      cell_height - title_height - margin)
+            canvas.paste(image, (round(x + (cell_width - image.width) / 2), round(y + title_height)))
+        y += cell_height
+    
+    # Trim the white border, keeping a small margin
+    content = ImageChops.difference(canvas, Image.new("RGB", canvas.size, "white")).getbbox()
+    if content:
+        canvas = canvas.crop((max(0, content[0] - margin), max(0, content[1] - margin),
+                              min(width, content[2] + margin), min(height, content[3] + margin)))
+    canvas.save(output_path, dpi=(dpi, dpi))
+
+def save_grid_figure(rows, suptitle, figsize, output_path, args, height_ratios=None):
+    """Render a grid of (title, image) panel rows with the selected renderer."""
+    if args.renderer == "pillow":
+        render_grid_pillow(rows, suptitle, figsize, output_path, args.dpi, height_ratios)
+    else:
+        render_grid_matplotlib(rows, suptitle, figsize, output_path, args.dpi, height_ratios)
+
+def generate_figure(example, args, figure_index, images=None):
+    """
+    Generate an academic-quality figure of the example image with annotations.
+    
+    images, if given, is the (original, annotated) pair from load_annotated_example.
+    """
+    try:
+        original_image, annotated_image = images or load_annotated_example(example)
         img_width, img_height = original_image.size
         
-        # Create a copy for drawing boxes
-        annotated_image = original_image.copy()
-        
-        # Draw boxes on the annotated image
-        annotated_image = draw_boxes_with_confidence(annotated_image, example['detections'], line_width=2)
-        
         # If include_cropped is True, create cropped versions of selected boxes
         cropped_images = []
         if args.include_cropped:
@@ -234,57 +382,21 @@ def generate_figure(example, args, figure_index):
                 
                 cropped_images.append(("Small/Distant Detection", cropped_small))
         
-        # Create figure
+        # Original and annotated image, with the crops in a shorter second row
+        rows = [[("Original Image", original_image),
+                 (f"All Detections ({example['box_count']} boxes)", annotated_image)]]
         if args.include_cropped and cropped_images:
-            # Figure with original, annotated, and crops
-            fig = plt.figure(figsize=(12, 10))
-            gs = gridspec.GridSpec(2, 2, height_ratios=[3, 1])
-            
-            # Original image
-            ax0 = plt.subplot(gs[0, 0])
-            ax0.imshow(np.array(original_image))
-            ax0.set_title("Original Image")
-            ax0.axis('off')
-            
-            # Annotated image
-            ax1 = plt.subplot(gs[0, 1])
-            ax1.imshow(np.array(annotated_image))
-            ax1.set_title(f"All Detections ({example['box_count']} boxes)")
-            ax1.axis('off')
-            
-            # Cropped images
-            for i, (title, img) in enumerate(cropped_images):
-                ax = plt.subplot(gs[1, i])
-                ax.imshow(np.array(img))
-                ax.set_title(title)
-                ax.axis('off')
-            
+            rows.append(cropped_images)
+            figsize, height_ratios = (12, 10), [3, 1]
         else:
-            # Simple figure with original and annotated
-            fig = plt.figure(figsize=(12, 6))
-            gs = gridspec.GridSpec(1, 2)
-            
-            # Original image
-            ax0 = plt.subplot(gs[0, 0])
-            ax0.imshow(np.array(original_image))
-            ax0.set_title("Original Image")
-            ax0.axis('off')
-            
-            # Annotated image
-            ax1 = plt.subplot(gs[0, 1])
-            ax1.imshow(np.array(annotated_image))
-            ax1.set_title(f"All Detections ({example['box_count']} boxes)")
-            ax1.axis('off')
-        
-        # Add overall figure title
-        plt.suptitle(f"Figure {figure_index}: Example of Complex Detection ({example['town']}, {example['box_count']} boxes)", 
-                    fontsize=16, y=0.98)
-        plt.tight_layout(rect=[0, 0, 1, 0.96])
-        
-        # Save the figure
+            figsize, height_ratios = (12, 6), None
+        
         output_path = os.path.join(args.output_dir, f"complex_example_{figure_index}.png")
-        plt.savefig(output_path, dpi=args.dpi, bbox_inches='tight')
-        plt.close()
+        save_grid_figure(
+            rows,
+            f"Figure {figure_index}: Example of Complex Detection ({example['town']}, {example['box_count']} boxes)",
+            figsize, output_path, args, height_ratios
+        )
         
         print(f"Generated figure {figure_index}: {output_path}")
         return output_path
@@ -293,17 +405,16 @@ def generate_figure(example, args, figure_index):
         print(f"Error generating figure for {example['path']}: {e}")
         return None
 
-def generate_preprocessing_figure(example, args):
-    """Generate a figure showing transformation from multi-box to individual classification tasks."""
+def generate_preprocessing_figure(example, args, images=None):
+    """
+    Generate a figure showing transformation from multi-box to individual classification tasks.
+    
+    images, if given, is the (original, annotated) pair from load_annotated_example.
+    """
     try:
-        # Load the original image
-        original_image = Image.open(example['path'])
+        original_image, annotated_image = images or load_annotated_example(example)
         img_width, img_height = original_image.size
         
-        # Create a copy for drawing boxes
-        annotated_image = original_image.copy()
-        annotated_image = draw_boxes_with_confidence(annotated_image, example['detections'], line_width=2)
-        
         # Select 3-4 diverse examples to show range of processing outcomes
         detections = example['detections']
         
@@ -341,12 +452,12 @@ def generate_preprocessing_figure(example, args):
                     selected_examples.append(("Upper Position", det))
                     break
         
-        # Limit to 3-4 examples
+        # Limit to 3-4 examples; only the first two fit in the figure's second row
         selected_examples = selected_examples[:4]
         
         # Create crops with context
         cropped_images = []
-        for title, det in selected_examples:
+        for title, det in selected_examples[:2]:
             padding = max(50, int(100 * (1 - det['relative_size'])))  # More padding for smaller objects
             cropped_img, rel_box = create_crop_with_context(original_image, det['box'], padding=padding)
             
@@ -374,41 +485,16 @@ def generate_preprocessing_figure(example, args):
             
             cropped_images.append((title, cropped_img))
         
-        # Create figure with original and processed versions
-        fig = plt.figure(figsize=(12, 9))
-        gs = gridspec.GridSpec(2, 2)
-        
-        # Original image
-        ax0 = plt.subplot(gs[0, 0])
-        ax0.imshow(np.array(original_image))
-        ax0.set_title("A. Original Image")
-        ax0.axis('off')
-        
-        # Annotated image
-        ax1 = plt.subplot(gs[0, 1])
-        ax1.imshow(np.array(annotated_image))
-        ax1.set_title(f"B. Detected Objects ({example['box_count']} boxes)")
-        ax1.axis('off')
-        
-        # Cropped examples - arrange in grid
-        for i, (title, img) in enumerate(cropped_images):
-            row = 1 + i // 2
-            col = i % 2
-            if row < 2:  # Only using second row
-                ax = plt.subplot(gs[row, col])
-                ax.imshow(np.array(img))
-                ax.set_title(f"{chr(67+i)}. {title}")  # C, D, E, F...
-                ax.axis('off')
-        
-        # Add overall figure title
-        plt.suptitle("Transformation of Multi-Box Image into Classification-Ready Tasks", 
-                     fontsize=16, y=0.98)
-        plt.tight_layout(rect=[0, 0, 1, 0.96])
-        
-        # Save the figure
+        # Original and processed versions, crops labelled C, D in the second row
+        rows = [
+            [("A. Original Image", original_image),
+             (f"B. Detected Objects ({example['box_count']} boxes)", annotated_image)],
+            [(f"{chr(67+i)}. {title}", img) for i, (title, img) in enumerate(cropped_images)]
+        ]
+        
         output_path = os.path.join(args.output_dir, "preprocessing_example.png")
-        plt.savefig(output_path, dpi=args.dpi, bbox_inches='tight')
-        plt.close()
+        save_grid_figure(rows, "Transformation of Multi-Box Image into Classification-Ready Tasks",
+                         (12, 9), output_path, args)
         
         print(f"Generated preprocessing transformation figure: {output_path}")
         return output_path
@@ -436,35 +522,18 @@ def generate_geographic_variation_figure(args):
             if not os.path.isdir(town_dir):
                 print(f"Warning: {town} directory not found, skipping")
                 continue
-                
-            bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
             
             try:
-                with open(bbox_file, 'r') as f:
-                    bbox_data = json.load(f)
-                
-                # Find a representative example with multiple boxes
-                town_examples = []
-                for image_name, detections in bbox_data.items():
-                    box_count = len(detections)
-                    if box_count >= 3:  # Look for reasonable multi-box examples
-                        image_path = os.path.join(town_dir, image_name)
-                        if os.path.exists(image_path):
-                            town_examples.append({
-                                'town': town,
-                                'image_name': image_name,
-                                'path': image_path,
-                                'box_count': box_count,
-                                'detections': detections,
-                                'multi_box_pct': town_info["multi_box_pct"]
-                            })
+                # Find a representative example with multiple boxes (at least 3)
+                town_examples = top_images_by_box_count(town, 3, min_boxes=3)
                 
-                # Sort by box count and get a good example (not too extreme)
+                # Get a good example by box count (not too extreme)
                 if town_examples:
-                    town_examples.sort(key=lambda x: x['box_count'], reverse=True)
                     # Don't pick the most extreme case, but a representative one
-                    example_idx = min(2, len(town_examples) - 1)
-                    towns_examples.append(town_examples[example_idx])
+                    box_count, image_name = town_examples[min(2, len(town_examples) - 1)]
+                    example = load_example(town, image_name, box_count)
+                    example['multi_box_pct'] = town_info["multi_box_pct"]
+                    towns_examples.append(example)
             except Exception as e:
                 print(f"Error accessing {town} data: {e}")
         
@@ -472,12 +541,9 @@ def generate_geographic_variation_figure(args):
             print("No suitable geographic examples found.")
             return None
         
-        # Create a comparison figure
-        fig = plt.figure(figsize=(15, 10))
-        rows = len(towns_examples)
-        gs = gridspec.GridSpec(rows, 2)
-        
-        for i, example in enumerate(towns_examples):
+        # Create a comparison figure, one row per town
+        rows = []
+        for example in towns_examples:
             try:
                 # Load the original image
                 original_image = Image.open(example['path'])
@@ -486,29 +552,16 @@ def generate_geographic_variation_figure(args):
                 annotated_image = original_image.copy()
                 annotated_image = draw_boxes_with_confidence(annotated_image, example['detections'])
                 
-                # Original image
-                ax0 = plt.subplot(gs[i, 0])
-                ax0.imshow(np.array(original_image))
-                ax0.set_title(f"{example['town']} (Multi-Box: {example['multi_box_pct']}%)")
-                ax0.axis('off')
-                
-                # Annotated image
-                ax1 = plt.subplot(gs[i, 1])
-                ax1.imshow(np.array(annotated_image))
-                ax1.set_title(f"Detected Objects: {example['box_count']} boxes")
-                ax1.axis('off')
+                rows.append([
+                    (f"{example['town']} (Multi-Box: {example['multi_box_pct']}%)", original_image),
+                    (f"Detected Objects: {example['box_count']} boxes", annotated_image)
+                ])
                 
             except Exception as e:
                 print(f"Error processing {example['town']} example: {e}")
         
-        # Add overall figure title
-        plt.suptitle("Geographic Variation in Detection Complexity", fontsize=16, y=0.98)
-        plt.tight_layout(rect=[0, 0, 1, 0.96])
-        
-        # Save the figure
         output_path = os.path.join(args.output_dir, "geographic_variation.png")
-        plt.savefig(output_path, dpi=args.dpi, bbox_inches='tight')
-        plt.close()
+        save_grid_figure(rows, "Geographic Variation in Detection Complexity", (15, 10), output_path, args)
         
         print(f"Generated geographic variation figure: {output_path}")
         return output_path
@@ -517,6 +570,28 @@ def generate_geographic_variation_figure(args):
         print(f"Error generating geographic variation figure: {e}")
         return None
 
+def render_example_figures(example, args, figure_index, include_preprocessing=False):
+    """
+    Render one example's figures in a worker process.
+    
+    The annotated image is drawn once and shared by the example figure and,
+    for the most extreme example, the preprocessing figure.
+    
+    Returns:
+        List of generated figure paths
+    """
+    print(f"Processing example {figure_index}: {example['town']}/{example['image_name']} with {example['box_count']} boxes")
+    try:
+        images = load_annotated_example(example)
+    except Exception as e:
+        print(f"Error loading {example['path']}: {e}")
+        return []
+    
+    paths = [generate_figure(example, args, figure_index, images)]
+    if include_preprocessing:
+        paths.append(generate_preprocessing_figure(example, args, images))
+    return [path for path in paths if path]
+
 def main():
     args = parse_arguments()
     
@@ -531,28 +606,23 @@ def main():
         print("No suitable examples found.")
         return
     
-    print(f"Found {len(examples)} examples. Generating figures...")
+    print(f"Found {len(examples)} examples. Generating figures with {args.workers} workers...")
     
-    # Generate a figure for each example
+    # One task per example (the most extreme one also gets the preprocessing
+    # transformation figure) plus the geographic variation figure
     figure_paths = []
-    for i, example in enumerate(examples):
-        print(f"Processing example {i+1}/{len(examples)}: {example['town']}/{example['image_name']} with {example['box_count']} boxes")
-        figure_path = generate_figure(example, args, i+1)
-        if figure_path:
-            figure_paths.append(figure_path)
-    
-    # Generate preprocessing transformation figure using the most extreme example
-    if examples:
-        print("\nGenerating preprocessing transformation figure...")
-        preprocessing_path = generate_preprocessing_figure(examples[0], args)
-        if preprocessing_path:
-            figure_paths.append(preprocessing_path)
-    
-    # Generate geographic variation figure
-    print("\nGenerating geographic variation figure...")
-    geo_path = generate_geographic_variation_figure(args)
-    if geo_path:
-        figure_paths.append(geo_path)
+    with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        example_futures = [
+            executor.submit(render_example_figures, example, args, i+1, i == 0)
+            for i, example in enumerate(examples)
+        ]
+        geo_future = executor.submit(generate_geographic_variation_figure, args)
+        
+        for future in example_futures:
+            figure_paths.extend(future.result())
+        geo_path = geo_future.result()
+        if geo_path:
+            figure_paths.append(geo_path)
     
     print(f"\nGenerated {len(figure_paths)} figures in {args.output_dir}")
     print("\nTo include these figures in your methodology document:")
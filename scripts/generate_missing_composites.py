@@ -1,14 +1,38 @@
+#!/usr/bin/env python3
+"""
+Generate Missing Composite Images
+
+This script finds boxed images (*_boxed*) that have no side-by-side composite
+in public/static/{TOWN} yet and creates them, copying the boxed image next to
+the composite.
+
+Each town directory is listed once with os.scandir and every existence check
+is answered from those snapshots. Work for all towns goes to a single process
+pool in chunked batches, so the CPU-bound resizing and JPEG encoding runs in
+parallel across towns.
+
+Usage:
+    python scripts/generate_missing_composites.py [options]
+
+Options:
+    --town TOWN              Process one town only (default: all towns)
+    --max-files INT          Limit the number of boxed images per town
+    --workers INT            Number of worker processes/threads (default: CPU count)
+    --mode MODE              Executor: process or thread (default: process)
+    --chunk-size INT         Files per batch sent to a worker (default: automatic)
+    --resample POLICY        Resampling policy: quality, balanced or speed (default: quality)
+    --encoding PROFILE       Composite encoding: legacy, jpeg, jpeg-hq, webp or avif (default: legacy)
+"""
+
 import os
-import sys
-import json
-from PIL import Image, ImageDraw
+import argparse
 import shutil
-from tqdm import tqdm
 import concurrent.futures
+from tqdm import tqdm
 
-# Configuration
-TOWN = "ANTRIM"  # Change this to generate for a specific town, or None for all towns
-MAX_FILES = None  # Set a limit or None for all files
+import composite_engine
+from composite_engine import (RESAMPLING_POLICIES, DEFAULT_POLICY, DEFAULT_ENCODING, available_encodings,
+                              encoded_path)
 
 # Directories
 DATA_DIR = "data"
@@ -17,190 +41,187 @@ PUBLIC_DIR = "public"
 PUBLIC_IMAGES_DIR = os.path.join(PUBLIC_DIR, "images")
 PUBLIC_STATIC_DIR = os.path.join(PUBLIC_DIR, "static")
 
-# Get list of towns to process
-if TOWN:
-    towns = [TOWN]
-else:
-    towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
+# Batches per worker when the chunk size is chosen automatically
+CHUNKS_PER_WORKER = 4
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate missing side-by-side composite images")
 
-print(f"Processing {len(towns)} towns...")
+    parser.add_argument("--town", type=str,
+                        help="Process one town only (default: all towns)")
+    parser.add_argument("--max-files", type=int,
+                        help="Limit the number of boxed images per town")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes/threads (default: CPU count)")
+    parser.add_argument("--mode", type=str, default="process", choices=["process", "thread"],
+                        help="Executor: process or thread (default: process)")
+    parser.add_argument("--chunk-size", type=int,
+                        help="Files per batch sent to a worker (default: automatic)")
+    parser.add_argument("--resample", type=str, default=DEFAULT_POLICY, choices=list(RESAMPLING_POLICIES),
+                        help=f"Resampling policy (default: {DEFAULT_POLICY})")
+    parser.add_argument("--encoding", type=str, default=DEFAULT_ENCODING, choices=available_encodings(),
+                        help=f"Composite encoding profile (default: {DEFAULT_ENCODING})")
 
-total_processed = 0
-total_created = 0
-total_failed = 0
-town_stats = {}
+    return parser.parse_args()
 
-# Function to create composite image
-def create_side_by_side_image(boxed_path, original_path, output_path):
+def list_files(directory):
+    """Snapshot of the regular file names in a directory (empty if it does not exist)."""
     try:
-        # Open both images
-        boxed_img = Image.open(boxed_path)
-        original_img = Image.open(original_path)
-        
-        # Get dimensions
-        box_width, box_height = boxed_img.size
-        orig_width, orig_height = original_img.size
-        
-        # Make the original image the same height as the cropped for side-by-side
-        new_orig_height = box_height
-        new_orig_width = int(orig_width * (new_orig_height / orig_height))
-        
-        # Resize original image
-        resized_orig = original_img.resize((new_orig_width, new_orig_height), Image.LANCZOS)
-        
-        # Create a new image wide enough for both
-        total_width = box_width + new_orig_width + 20  # 20px padding
-        composite = Image.new("RGB", (total_width, box_height + 30), (255, 255, 255))
-        
-        # Paste the boxed image on the left
-        composite.paste(boxed_img, (0, 0))
-        
-        # Paste the original image on the right with some spacing
-        composite.paste(resized_orig, (box_width + 20, 0))
-        
-        # Draw a line to separate the images
-        draw = ImageDraw.Draw(composite)
-        draw.line([(box_width + 10, 0), (box_width + 10, box_height)], fill=(200, 200, 200), width=1)
-        
-        # Add labels
-        try:
-            font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = None
-        
-        draw.text((10, box_height + 5), "Cropped View", fill=(0, 0, 0), font=font)
-        draw.text((box_width + 30, box_height + 5), "Original Context", fill=(0, 0, 0), font=font)
-        
-        # Save the composite image
-        composite.save(output_path, quality=85)
-        return True
-    except Exception as e:
-        print(f"Error creating side-by-side image for {os.path.basename(boxed_path)}: {e}")
-        return False
-
-def process_file(town, file_name):
-    stats = {"processed": 0, "created": 0, "failed": 0}
-    
-    # Skip if not a boxed image
-    if "_boxed" not in file_name or file_name.startswith("composite_"):
-        return stats
-    
-    # Check if composite already exists
-    composite_file_name = f"composite_{file_name}"
-    static_town_dir = os.path.join(PUBLIC_STATIC_DIR, town)
-    composite_path = os.path.join(static_town_dir, composite_file_name)
-    
-    if os.path.exists(composite_path):
-        return stats
-    
-    # Create static directory if it doesn't exist
-    os.makedirs(static_town_dir, exist_ok=True)
-    
-    # Source directories
-    true_positive_town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-    public_images_town_dir = os.path.join(PUBLIC_IMAGES_DIR, town)
-    
-    # Search for the boxed file
-    source_file = None
-    if os.path.exists(os.path.join(true_positive_town_dir, file_name)):
-        source_file = os.path.join(true_positive_town_dir, file_name)
-    elif os.path.exists(os.path.join(public_images_town_dir, file_name)):
-        source_file = os.path.join(public_images_town_dir, file_name)
-    
-    if not source_file:
-        stats["failed"] += 1
-        return stats
-    
-    # Find the original image
-    original_file_name = file_name.replace("_boxed", "")
-    original_file = None
-    if os.path.exists(os.path.join(true_positive_town_dir, original_file_name)):
-        original_file = os.path.join(true_positive_town_dir, original_file_name)
-    elif os.path.exists(os.path.join(public_images_town_dir, original_file_name)):
-        original_file = os.path.join(public_images_town_dir, original_file_name)
-    
-    if not original_file:
-        original_file = source_file  # Fallback to using the boxed image as original
-    
-    # Create the composite image
-    success = create_side_by_side_image(source_file, original_file, composite_path)
-    
-    # Copy the boxed image to static directory
-    static_boxed_path = os.path.join(static_town_dir, file_name)
-    if not os.path.exists(static_boxed_path):
-        shutil.copy2(source_file, static_boxed_path)
-    
-    stats["processed"] += 1
-    if success:
-        stats["created"] += 1
-    else:
-        stats["failed"] += 1
-    
-    return stats
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except OSError:
+        return set()
+
+def create_side_by_side_image(boxed_path, original_path, output_path, policy=DEFAULT_POLICY,
+                              encoding=DEFAULT_ENCODING):
+    """Composite of a boxed image and its original, scaled to the boxed image's height."""
+    return composite_engine.create_side_by_side_image(boxed_path, original_path, None, output_path,
+                                                      "crop-height", policy, encoding=encoding)
+
+def plan_town(town, max_files=None, encoding=DEFAULT_ENCODING):
+    """
+    Work out which composites a town is missing, from directory snapshots.
 
-# Process each town
-for town in towns:
-    print(f"\nProcessing town: {town}")
+    A composite counts as present only under the encoding's file name.
+
+    Returns:
+        (number of boxed images, list of tasks); each task is
+        (town, source_file, original_file, composite_path, static_boxed_path or None)
+    """
     true_positive_town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
     public_images_town_dir = os.path.join(PUBLIC_IMAGES_DIR, town)
-    
-    # Get all boxed images
-    boxed_files = []
-    
-    # Look in true_positive_dir
-    if os.path.exists(true_positive_town_dir):
-        boxed_files.extend([f for f in os.listdir(true_positive_town_dir) 
-                          if "_boxed" in f and not f.startswith("composite_") 
-                          and os.path.isfile(os.path.join(true_positive_town_dir, f))])
-    
-    # Look in public_images_dir
-    if os.path.exists(public_images_town_dir):
-        boxed_files.extend([f for f in os.listdir(public_images_town_dir) 
-                          if "_boxed" in f and not f.startswith("composite_") 
-                          and os.path.isfile(os.path.join(public_images_town_dir, f))])
-    
-    # Remove duplicates
-    boxed_files = list(set(boxed_files))
-    
+    static_town_dir = os.path.join(PUBLIC_STATIC_DIR, town)
+
+    true_positive_files = list_files(true_positive_town_dir)
+    public_image_files = list_files(public_images_town_dir)
+    static_files = list_files(static_town_dir)
+
+    # All boxed images, without duplicates
+    boxed_files = sorted(f for f in true_positive_files | public_image_files
+                         if "_boxed" in f and not f.startswith("composite_"))
+
     # Limit files if specified
-    if MAX_FILES:
-        boxed_files = boxed_files[:MAX_FILES]
-    
-    town_stats[town] = {"total": len(boxed_files), "created": 0, "failed": 0}
-    print(f"Found {len(boxed_files)} boxed images for {town}")
-    
-    if not boxed_files:
-        continue
-    
-    # Process files with a progress bar
-    with tqdm(total=len(boxed_files), desc=f"Creating composites for {town}") as pbar:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            futures = {executor.submit(process_file, town, file_name): file_name for file_name in boxed_files}
-            
-            for future in concurrent.futures.as_completed(futures):
-                file_name = futures[future]
-                try:
-                    stats = future.result()
-                    total_processed += stats["processed"]
-                    total_created += stats["created"]
-                    total_failed += stats["failed"]
-                    town_stats[town]["created"] += stats["created"]
-                    town_stats[town]["failed"] += stats["failed"]
-                except Exception as e:
-                    print(f"Error processing {file_name}: {e}")
-                    total_failed += 1
-                    town_stats[town]["failed"] += 1
-                
-                pbar.update(1)
-
-# Print summary
-print("\n===== COMPOSITE IMAGE GENERATION SUMMARY =====")
-print(f"Total files processed: {total_processed}")
-print(f"Total composite images created: {total_created}")
-print(f"Total failures: {total_failed}")
-print("\n===== PER-TOWN STATISTICS =====")
-for town, stats in town_stats.items():
-    success_rate = f"{(stats['created'] / stats['total'] * 100):.1f}%" if stats['total'] > 0 else "N/A"
-    print(f"{town}: {stats['created']}/{stats['total']} ({success_rate})")
-
-print("\nDone\!")
+    if max_files:
+        boxed_files = boxed_files[:max_files]
+
+    def locate(file_name):
+        if file_name in true_positive_files:
+            return os.path.join(true_positive_town_dir, file_name)
+        if file_name in public_image_files:
+            return os.path.join(public_images_town_dir, file_name)
+        return None
+
+    tasks = []
+    for file_name in boxed_files:
+        # Skip if the composite already exists
+        composite_name = encoded_path(f"composite_{file_name}", encoding)
+        if composite_name in static_files:
+            continue
+
+        source_file = locate(file_name)
+        # Fallback to using the boxed image as original
+        original_file = locate(file_name.replace("_boxed", "")) or source_file
+        static_boxed_path = None if file_name in static_files else os.path.join(static_town_dir, file_name)
+
+        tasks.append((town, source_file, original_file,
+                      os.path.join(static_town_dir, composite_name), static_boxed_path))
+
+    return len(boxed_files), tasks
+
+def process_batch(tasks, policy=DEFAULT_POLICY, encoding=DEFAULT_ENCODING):
+    """
+    Create the composites for a batch of tasks (runs in a worker).
+
+    Returns:
+        List of (town, success) per task
+    """
+    results = []
+    for town, source_file, original_file, composite_path, static_boxed_path in tasks:
+        try:
+            success = create_side_by_side_image(source_file, original_file, composite_path, policy, encoding)
+
+            # Copy the boxed image to static directory
+            if static_boxed_path:
+                shutil.copy2(source_file, static_boxed_path)
+        except Exception as e:
+            print(f"Error processing {os.path.basename(source_file)}: {e}")
+            success = False
+        results.append((town, success))
+    return results
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    # Get list of towns to process
+    if args.town:
+        towns = [args.town]
+    else:
+        towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
+
+    print(f"Processing {len(towns)} towns...")
+
+    town_stats = {}
+    all_tasks = []
+    for town in sorted(towns):
+        total, tasks = plan_town(town, args.max_files, args.encoding)
+        town_stats[town] = {"total": total, "created": 0, "failed": 0}
+        print(f"{town}: {total} boxed images, {len(tasks)} missing composites")
+
+        if tasks:
+            os.makedirs(os.path.join(PUBLIC_STATIC_DIR, town), exist_ok=True)
+            all_tasks.extend(tasks)
+
+    total_processed = 0
+    total_created = 0
+    total_failed = 0
+
+    if all_tasks:
+        workers = max(1, args.workers)
+        chunk_size = args.chunk_size or max(1, -(-len(all_tasks) // (workers * CHUNKS_PER_WORKER)))
+        chunks = [all_tasks[i:i + chunk_size] for i in range(0, len(all_tasks), chunk_size)]
+
+        executor_class = (concurrent.futures.ProcessPoolExecutor if args.mode == "process"
+                          else concurrent.futures.ThreadPoolExecutor)
+        print(f"\nCreating {len(all_tasks)} composites in {len(chunks)} batches "
+              f"with {workers} {args.mode} workers")
+
+        # Process all towns in one pool with a progress bar
+        with tqdm(total=len(all_tasks), desc="Creating composites") as pbar:
+            with executor_class(max_workers=workers) as executor:
+                futures = {executor.submit(process_batch, chunk, args.resample, args.encoding): chunk for chunk in chunks}
+
+                for future in concurrent.futures.as_completed(futures):
+                    chunk = futures[future]
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        print(f"Error processing batch of {len(chunk)} files: {e}")
+                        results = [(task[0], False) for task in chunk]
+
+                    for town, success in results:
+                        total_processed += 1
+                        if success:
+                            total_created += 1
+                            town_stats[town]["created"] += 1
+                        else:
+                            total_failed += 1
+                            town_stats[town]["failed"] += 1
+
+                    pbar.update(len(chunk))
+
+    # Print summary
+    print("\n===== COMPOSITE IMAGE GENERATION SUMMARY =====")
+    print(f"Total files processed: {total_processed}")
+    print(f"Total composite images created: {total_created}")
+    print(f"Total failures: {total_failed}")
+    print("\n===== PER-TOWN STATISTICS =====")
+    for town, stats in town_stats.items():
+        success_rate = f"{(stats['created'] / stats['total'] * 100):.1f}%" if stats['total'] > 0 else "N/A"
+        print(f"{town}: {stats['created']}/{stats['total']} ({success_rate})")
+
+    print("\nDone!")
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,17 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from PIL import Image, ImageTk, ImageDraw
 import sys
-from collections import Counter
+from collections import Counter, OrderedDict
 import random
+import math
+import queue
+import time
+import hashlib
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+
+from detection_index import open_town_index, get_detections
 
 # Base directories - same as in create_masked_images.py
 BASE_DIR = "data"
@@ -13,6 +22,442 @@ TRUE_POSITIVE_DIR = os.path.join(BASE_DIR, "true_positive_images")
 OUTPUT_DIR = os.path.join(BASE_DIR, "true_positive_masked_images")
 CROP_DIR = os.path.join(BASE_DIR, "cropped_images_for_classification")
 QUEUE_FILE = os.path.join(BASE_DIR, "classification_queue.json")
+THUMBNAIL_DIR = os.path.join(BASE_DIR, "thumbnail_cache")
+
+# Background work: scanning towns and preparing images runs on a thread pool;
+# results are handed to the Tk thread through a queue polled with after()
+WORKER_THREADS = min(4, os.cpu_count() or 1)
+EVENT_POLL_MS = 50
+
+# Detections are drawn as canvas items over the displayed image, so toggling
+# them needs no image I/O; clicks are hit-tested through a grid spatial index
+BOX_COLOR = "red"
+SELECTED_BOX_COLOR = "yellow"
+BOX_CELL_SIZE = 128  # Source pixels per spatial index cell
+
+# Display-ready (decoded, resized, overlaid) images kept in memory, and how
+# many images either side of the current one are prepared in the background
+DISPLAY_CACHE_SIZE = 64
+PREFETCH_AHEAD = 3
+
+# Zooming renders the current image from a pyramid of 256 px tiles at
+# power-of-two levels; only tiles in view are resampled and drawn
+TILE_SIZE = 256
+TILE_CACHE_SIZE = 512
+MAX_ZOOM = 8.0  # Display pixels per source pixel
+
+class TilePyramid:
+    """
+    Lazily built multi-resolution tile pyramid for one image.
+    
+    Level 0 is the full-resolution image and each further level halves it.
+    Level images and tiles are only created when a view first needs them.
+    """
+    
+    def __init__(self, image, tile_size=TILE_SIZE, max_tiles=TILE_CACHE_SIZE):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.levels = [image]
+        self.tiles = OrderedDict()
+    
+    @property
+    def size(self):
+        return self.levels[0].size
+    
+    def level_for_scale(self, scale):
+        """Smallest level that still has at least as many pixels as the display."""
+        level = 0
+        while scale * 2 ** (level + 1) <= 1 and min(self.size) >> (level + 1) >= 1:
+            level += 1
+        return level
+    
+    def level_image(self, level):
+        while len(self.levels) <= level:
+            self.levels.append(self.levels[-1].reduce(2))
+        return self.levels[level]
+    
+    def tile(self, level, tx, ty):
+        key = (level, tx, ty)
+        tile = self.tiles.get(key)
+        if tile is None:
+            image = self.level_image(level)
+            x0, y0 = tx * self.tile_size, ty * self.tile_size
+            tile = image.crop((x0, y0, min(x0 + self.tile_size, image.width),
+                               min(y0 + self.tile_size, image.height)))
+            self.tiles[key] = tile
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+        else:
+            self.tiles.move_to_end(key)
+        return tile
+    
+    def visible_tiles(self, scale, view):
+        """
+        Tiles covering a view rectangle given in display coordinates.
+        
+        Yields:
+            (level, tx, ty, (x, y, width, height)) with the tile's display geometry
+        """
+        level = self.level_for_scale(scale)
+        level_width, level_height = self.level_image(level).size
+        factor = scale * 2 ** level  # Display pixels per level pixel
+        step = self.tile_size * factor
+        
+        x0, y0, x1, y1 = view
+        tx_range = range(max(0, int(x0 // step)), min(math.ceil(level_width / self.tile_size), int(x1 // step) + 1))
+        ty_range = range(max(0, int(y0 // step)), min(math.ceil(level_height / self.tile_size), int(y1 // step) + 1))
+        for ty in ty_range:
+            top = round(ty * step)
+            bottom = round(min((ty + 1) * self.tile_size, level_height) * factor)
+            for tx in tx_range:
+                left = round(tx * step)
+                right = round(min((tx + 1) * self.tile_size, level_width) * factor)
+                yield level, tx, ty, (left, top, max(1, right - left), max(1, bottom - top))
+
+# Distance filter options and the distance_hint keyword each one matches
+DISTANCE_CATEGORIES = {
+    "Distant flags": "distant",
+    "Normal sized": "normal",
+    "Small detections": "small"
+}
+
+def positions_to_bits(positions, size):
+    """Bitset (a Python int) with the given positions set."""
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, "little")
+
+def first_positions(bits, limit):
+    """Lowest set positions of a bitset, in increasing order."""
+    positions = []
+    while bits and len(positions) < limit:
+        lowest = bits & -bits
+        positions.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return positions
+
+class ExistenceCache:
+    """Answers os.path.exists from one os.scandir per directory."""
+    
+    def __init__(self):
+        self.directories = {}
+    
+    def exists(self, path):
+        if not path:
+            return False
+        directory, name = os.path.split(path)
+        names = self.directories.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory or ".") as entries:
+                    names = {entry.name for entry in entries}
+            except OSError:
+                names = set()
+            self.directories[directory] = names
+        return name in names
+
+class ClassificationQueueIndex:
+    """
+    Per-field indexes over the classification queue for fast filtering.
+    
+    Positions are queue order. Towns, distance categories and file existence
+    are held as bitsets; confidences are kept sorted so a threshold maps to a
+    suffix of positions (its bitset is cached per threshold). A filter is the
+    AND of the relevant bitsets.
+    """
+    
+    def __init__(self, items):
+        self.items = items
+        size = len(items)
+        
+        town_positions = {}
+        distance_positions = {keyword: [] for keyword in DISTANCE_CATEGORIES.values()}
+        existing = []
+        existence = ExistenceCache()
+        
+        for position, item in enumerate(items):
+            town_positions.setdefault(item['town'], []).append(position)
+            
+            hint = item.get('distance_hint', '').lower()
+            for keyword, positions in distance_positions.items():
+                if keyword in hint:
+                    positions.append(position)
+            
+            # Check if the image file exists
+            if item.get('is_cropped', False):
+                image_path = item.get('cropped_image')
+            else:
+                image_path = item.get('original_image')
+            if existence.exists(image_path):
+                existing.append(position)
+        
+        self.town_bits = {town: positions_to_bits(positions, size)
+                          for town, positions in town_positions.items()}
+        self.distance_bits = {keyword: positions_to_bits(positions, size)
+                              for keyword, positions in distance_positions.items()}
+        self.exists_bits = positions_to_bits(existing, size)
+        
+        # Confidence sorted ascending, with the queue position of each value
+        self.by_confidence = sorted(range(size), key=lambda position: items[position]['confidence'])
+        self.confidences = [items[position]['confidence'] for position in self.by_confidence]
+        self.confidence_cache = {}
+    
+    @property
+    def towns(self):
+        return sorted(self.town_bits)
+    
+    def confidence_bits(self, min_confidence):
+        bits = self.confidence_cache.get(min_confidence)
+        if bits is None:
+            start = bisect_left(self.confidences, min_confidence)
+            bits = positions_to_bits(self.by_confidence[start:], len(self.items))
+            self.confidence_cache[min_confidence] = bits
+        return bits
+    
+    def filter(self, min_confidence=0.0, town="All", distance="All", limit=None):
+        """Items matching all filters, in queue order, up to limit."""
+        bits = self.exists_bits & self.confidence_bits(min_confidence)
+        if town != "All":
+            bits &= self.town_bits.get(town, 0)
+        if distance != "All":
+            bits &= self.distance_bits.get(DISTANCE_CATEGORIES.get(distance), 0)
+        
+        limit = len(self.items) if limit is None else limit
+        return [self.items[position] for position in first_positions(bits, limit)]
+
+# Thumbnail grid: cell geometry and how many thumbnails stay decoded in memory
+THUMBNAIL_SIZE = 160
+GRID_PADDING = 8
+GRID_PHOTO_CACHE_SIZE = 600
+
+def thumbnail_cache_path(source_path):
+    """On-disk thumbnail location; the key changes whenever the source file does."""
+    stat = os.stat(source_path)
+    key = f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}:{stat.st_size}:{THUMBNAIL_SIZE}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(THUMBNAIL_DIR, digest[:2], f"{digest}.jpg")
+
+def load_thumbnail(source_path):
+    """Load a thumbnail from the persistent cache, creating it if needed."""
+    cache_path = thumbnail_cache_path(source_path)
+    if os.path.exists(cache_path):
+        thumbnail = Image.open(cache_path)
+        thumbnail.load()
+        return thumbnail
+    
+    with Image.open(source_path) as image:
+        image.draft("RGB", (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    thumbnail.save(tmp_path, "JPEG", quality=85)
+    os.replace(tmp_path, cache_path)
+    return thumbnail
+
+def item_source_path(image_info):
+    """Source image of a bbox-mode or classification-mode item."""
+    if 'path' in image_info:
+        return image_info['path']
+    if image_info.get('is_cropped', False):
+        return image_info.get('cropped_image')
+    return image_info.get('original_image')
+
+class ThumbnailGrid(tk.Toplevel):
+    """
+    Virtualized thumbnail grid over the viewer's current image list.
+    
+    Only cells in (or just beyond) the visible rows get canvas items, and their
+    thumbnails are loaded by the viewer's worker threads. A separate background
+    thread fills the persistent thumbnail cache for the whole list. Clicking a
+    thumbnail shows that image in the main viewer.
+    """
+    
+    def __init__(self, viewer):
+        super().__init__(viewer)
+        self.viewer = viewer
+        self.title("Thumbnail Grid")
+        self.geometry("1000x700")
+        
+        self.cell = THUMBNAIL_SIZE + 2 * GRID_PADDING
+        self.columns = 1
+        self.photos = OrderedDict()
+        self.pending = set()
+        self.warm_generation = 0
+        
+        self.canvas = tk.Canvas(self, bg="#303030", highlightthickness=0,
+                                yscrollincrement=self.cell // 4)
+        scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.scroll)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.canvas.configure(yscrollcommand=scrollbar.set)
+        
+        self.canvas.bind("<Configure>", lambda e: self.refresh())
+        self.canvas.bind("<MouseWheel>", lambda e: self.scroll("scroll", -1 if e.delta > 0 else 1, "units"))
+        self.canvas.bind("<Button-4>", lambda e: self.scroll("scroll", -1, "units"))
+        self.canvas.bind("<Button-5>", lambda e: self.scroll("scroll", 1, "units"))
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        
+        self.refresh()
+    
+    def on_close(self):
+        self.warm_generation += 1
+        self.viewer.grid_window = None
+        self.destroy()
+    
+    def refresh(self):
+        """Recompute the layout for the current list and window size, then redraw."""
+        width = max(self.canvas.winfo_width(), self.cell)
+        self.columns = max(1, width // self.cell)
+        rows = math.ceil(len(self.viewer.images) / self.columns)
+        self.canvas.config(scrollregion=(0, 0, self.columns * self.cell, rows * self.cell))
+        self.render()
+        self.start_warming()
+    
+    def scroll(self, *args):
+        self.canvas.yview(*args)
+        self.render()
+    
+    def visible_range(self, margin_rows=1):
+        """Item positions in the visible rows, plus a margin above and below."""
+        top = self.canvas.canvasy(0)
+        bottom = self.canvas.canvasy(self.canvas.winfo_height())
+        first_row = max(0, int(top // self.cell) - margin_rows)
+        last_row = int(bottom // self.cell) + margin_rows
+        return range(first_row * self.columns,
+                     min(len(self.viewer.images), (last_row + 1) * self.columns))
+    
+    def render(self):
+        """Create canvas items for visible cells only."""
+        self.canvas.delete("all")
+        images = self.viewer.images
+        for position in self.visible_range():
+            source = item_source_path(images[position])
+            row, column = divmod(position, self.columns)
+            x = column * self.cell + self.cell // 2
+            y = row * self.cell + self.cell // 2
+            
+            photo = self.photos.get(source)
+            if photo is not None:
+                self.photos.move_to_end(source)
+                self.canvas.create_image(x, y, image=photo)
+            else:
+                half = THUMBNAIL_SIZE // 2
+                self.canvas.create_rectangle(x - half, y - half, x + half, y + half, outline="#606060")
+                self.request(source)
+            
+            if position == self.viewer.current_index:
+                half = self.cell // 2 - 2
+                self.canvas.create_rectangle(x - half, y - half, x + half, y + half,
+                                             outline="yellow", width=2)
+    
+    def request(self, source):
+        """Load a thumbnail on a worker thread; it arrives as a viewer event."""
+        if source in self.pending or not source:
+            return
+        self.pending.add(source)
+        self.viewer.executor.submit(self.load, source)
+    
+    def load(self, source):
+        try:
+            thumbnail = load_thumbnail(source)
+        except Exception as e:
+            print(f"Error creating thumbnail for {source}: {e}")
+            thumbnail = None
+        self.viewer.events.put(("thumbnail", None, (source, thumbnail)))
+    
+    def on_thumbnail(self, source, thumbnail):
+        """Turn a loaded thumbnail into a PhotoImage (Tk thread) and redraw if visible."""
+        self.pending.discard(source)
+        if thumbnail is None:
+            return
+        self.photos[source] = ImageTk.PhotoImage(thumbnail)
+        while len(self.photos) > GRID_PHOTO_CACHE_SIZE:
+            self.photos.popitem(last=False)
+        
+        images = self.viewer.images
+        if any(item_source_path(images[position]) == source for position in self.visible_range()):
+            self.render()
+    
+    def start_warming(self):
+        """Fill the on-disk thumbnail cache for the whole list on a background thread."""
+        self.warm_generation += 1
+        sources = [item_source_path(item) for item in self.viewer.images]
+        threading.Thread(target=self.warm, args=(sources, self.warm_generation), daemon=True).start()
+    
+    def warm(self, sources, generation):
+        for source in sources:
+            if generation != self.warm_generation:
+                return
+            try:
+                if source and not os.path.exists(thumbnail_cache_path(source)):
+                    load_thumbnail(source)
+            except Exception:
+                pass
+    
+    def on_click(self, event):
+        column = int(self.canvas.canvasx(event.x) // self.cell)
+        row = int(self.canvas.canvasy(event.y) // self.cell)
+        position = row * self.columns + column
+        if column < self.columns and position < len(self.viewer.images):
+            self.viewer.current_index = position
+            self.viewer.update_image()
+            self.render()
+
+class BoxSpatialIndex:
+    """Uniform grid over source-image coordinates for point-in-box queries."""
+    
+    def __init__(self, boxes, cell_size=BOX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.boxes = [(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)) for x0, y0, x1, y1 in boxes]
+        self.cells = {}
+        for i, (x0, y0, x1, y1) in enumerate(self.boxes):
+            for cx in range(int(x0 // cell_size), int(x1 // cell_size) + 1):
+                for cy in range(int(y0 // cell_size), int(y1 // cell_size) + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+    
+    def query(self, x, y):
+        """Indices of boxes containing a point, smallest box first."""
+        candidates = self.cells.get((int(x // self.cell_size), int(y // self.cell_size)), [])
+        hits = [i for i in candidates
+                if self.boxes[i][0] <= x <= self.boxes[i][2] and self.boxes[i][1] <= y <= self.boxes[i][3]]
+        return sorted(hits, key=lambda i: (self.boxes[i][2] - self.boxes[i][0]) * (self.boxes[i][3] - self.boxes[i][1]))
+
+class DisplayImageCache:
+    """
+    Bounded LRU of display-ready images keyed by (path, canvas size).
+    
+    Boxes are drawn as canvas items, so the bitmap does not depend on whether
+    they are shown.
+    
+    Only touched from the Tk thread; prefetch workers hand their results over
+    through the event queue.
+    """
+    
+    def __init__(self, max_items=DISPLAY_CACHE_SIZE):
+        self.max_items = max_items
+        self.items = OrderedDict()
+    
+    def __contains__(self, key):
+        return key in self.items
+    
+    def get(self, key):
+        image = self.items.get(key)
+        if image is not None:
+            self.items.move_to_end(key)
+        return image
+    
+    def put(self, key, image):
+        self.items[key] = image
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+    
+    def clear(self):
+        self.items.clear()
 
 class FlagImageViewer(tk.Tk):
     """GUI application for viewing flag images with bounding boxes."""
@@ -39,59 +484,137 @@ class FlagImageViewer(tk.Tk):
         self.min_confidence = tk.DoubleVar(value=0.3)
         self.max_samples = tk.IntVar(value=100)
         self.classification_queue = []
+        self.queue_index = None
+        self.queue_mtime = None
         self.filter_by_town = tk.StringVar(value="All")
         self.town_list = ["All"]
         self.distance_filter = tk.StringVar(value="All")
         self.distance_options = ["All", "Distant flags", "Normal sized", "Small detections"]
         
-        # Scan data to find the maximum number of boxes
-        self.scan_max_boxes()
+        # Background workers and the events they post back to the Tk thread
+        self.executor = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+        self.events = queue.Queue()
+        self.scan_complete = False
+        self.load_generation = 0
+        
+        # Display-ready images and the keys being prepared by the prefetcher
+        self.display_cache = DisplayImageCache()
+        self.pending_prefetch = set()
+        
+        # Thumbnail grid window, when open
+        self.grid_window = None
+        self.canvas_size = (0, 0)
+        self.resize_job = None
+        
+        # Zoom state: a tile pyramid of the current image once the user zooms
+        self.pyramid = None
+        self.zoom_scale = None
+        self.fit_scale = None
+        self.tile_photos = {}
+        
+        # Detections of the current image, in source pixels, and the display scale
+        self.current_detections = []
+        self.box_index = None
+        self.box_scale = 1.0
+        self.selected_box = None
+        self.press_position = None
         
         # Create the UI
         self.create_ui()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
         
-        # Load images on startup
-        self.load_images()
+        # Scan data to find the maximum number of boxes, then load images
+        self.status_var.set("Scanning towns...")
+        self.executor.submit(self.scan_max_boxes)
+        self.after(EVENT_POLL_MS, self.process_events)
+    
+    def open_grid(self):
+        """Open (or raise) the thumbnail grid for the current image list."""
+        if self.grid_window is None:
+            self.grid_window = ThumbnailGrid(self)
+        else:
+            self.grid_window.lift()
+    
+    def refresh_grid(self):
+        """Re-layout the thumbnail grid after the image list changes."""
+        if self.grid_window is not None:
+            self.grid_window.refresh()
+    
+    def on_close(self):
+        """Stop background work and close the window."""
+        self.load_generation += 1
+        if self.grid_window is not None:
+            self.grid_window.warm_generation += 1
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
+    
+    def process_events(self):
+        """Handle results posted by background workers (runs on the Tk thread)."""
+        try:
+            while True:
+                event, generation, payload = self.events.get_nowait()
+                if event == "scan_done":
+                    self.on_scan_done(*payload)
+                elif event == "prepared":
+                    self.on_image_prepared(*payload)
+                elif event == "thumbnail":
+                    if self.grid_window is not None:
+                        self.grid_window.on_thumbnail(*payload)
+                elif generation != self.load_generation:
+                    continue  # Results of a superseded filter
+                elif event == "images":
+                    self.on_images_found(payload)
+                elif event == "images_done":
+                    self.on_images_done(payload)
+        except queue.Empty:
+            pass
+        self.after(EVENT_POLL_MS, self.process_events)
     
     def scan_max_boxes(self):
-        """Scan all JSON files to find the maximum number of bounding boxes in any image."""
+        """Find the maximum number of bounding boxes in any image (runs on a worker)."""
+        towns = []
         try:
             # Get list of towns
             towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) 
                     if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
             
-            self.town_list.extend(towns)
-            
             max_boxes = 0
             
             # Process each town
             for town in towns:
-                town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-                bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
-                
                 try:
-                    with open(bbox_file, 'r') as f:
-                        bbox_data = json.load(f)
-                    
-                    # Find the maximum number of boxes in any image
-                    for image_name, detections in bbox_data.items():
-                        box_count = len(detections)
-                        max_boxes = max(max_boxes, box_count)
+                    # The detection index header records the town's maximum box count
+                    index = open_town_index(town)
+                    if index is not None:
+                        max_boxes = max(max_boxes, index.max_boxes)
                     
                 except Exception as e:
                     print(f"Error scanning {town}: {e}")
             
-            self.max_boxes_in_data = max_boxes
-            # Set the max_boxes variable to the found maximum
-            self.max_boxes.set(max_boxes)
-            
             print(f"Maximum number of bounding boxes found in data: {max_boxes}")
             
         except Exception as e:
             print(f"Error scanning for maximum boxes: {e}")
             # Set a reasonable default if scanning fails
-            self.max_boxes_in_data = 20
-            self.max_boxes.set(20)
+            max_boxes = 20
+        
+        self.events.put(("scan_done", None, (towns, max_boxes)))
+    
+    def on_scan_done(self, towns, max_boxes):
+        """Apply the scanned town list and box range, then load images."""
+        self.town_list.extend(towns)
+        self.town_combo.config(values=self.town_list)
+        
+        self.max_boxes_in_data = max_boxes
+        # Set the max_boxes variable to the found maximum
+        self.max_boxes.set(max_boxes)
+        self.min_boxes_spinbox.config(to=max_boxes)
+        self.max_boxes_spinbox.config(to=max_boxes)
+        
+        self.scan_complete = True
+        self.status_var.set(f"Ready - Maximum boxes in data: {self.max_boxes_in_data}")
+        if self.view_mode.get() == "bbox":
+            self.load_images()
     
     def create_ui(self):
         """Create the user interface."""
@@ -141,10 +664,10 @@ class FlagImageViewer(tk.Tk):
         self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         # Scrollbars
-        v_scrollbar = ttk.Scrollbar(self.canvas_frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        v_scrollbar = ttk.Scrollbar(self.canvas_frame, orient=tk.VERTICAL, command=self.scroll_y)
         v_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         
-        h_scrollbar = ttk.Scrollbar(self.image_frame, orient=tk.HORIZONTAL, command=self.canvas.xview)
+        h_scrollbar = ttk.Scrollbar(self.image_frame, orient=tk.HORIZONTAL, command=self.scroll_x)
         h_scrollbar.pack(side=tk.BOTTOM, fill=tk.X)
         
         self.canvas.configure(yscrollcommand=v_scrollbar.set, xscrollcommand=h_scrollbar.set)
@@ -169,6 +692,9 @@ class FlagImageViewer(tk.Tk):
         random_button = ttk.Button(nav_frame, text="Random Image", command=self.random_image)
         random_button.pack(side=tk.LEFT, padx=5)
         
+        grid_button = ttk.Button(nav_frame, text="Thumbnail Grid", command=self.open_grid)
+        grid_button.pack(side=tk.LEFT, padx=5)
+        
         # Keyboard bindings
         self.bind("<Left>", lambda e: self.prev_image())
         self.bind("<Right>", lambda e: self.next_image())
@@ -180,14 +706,19 @@ class FlagImageViewer(tk.Tk):
         self.canvas.bind("<Button-4>", self.zoom)    # Linux scroll up
         self.canvas.bind("<Button-5>", self.zoom)    # Linux scroll down
         
+        # Drag to pan a zoomed image; click to inspect a box
+        self.canvas.bind("<ButtonPress-1>", self.on_press)
+        self.canvas.bind("<B1-Motion>", self.pan)
+        self.canvas.bind("<ButtonRelease-1>", self.on_release)
+        
+        # Cached display images depend on the canvas size
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
+        
         # Status bar
         self.status_var = tk.StringVar()
         status_bar = ttk.Label(self, textvariable=self.status_var, relief=tk.SUNKEN, anchor=tk.W)
         status_bar.pack(side=tk.BOTTOM, fill=tk.X)
         
-        # Set initial status
-        self.status_var.set(f"Ready - Maximum boxes in data: {self.max_boxes_in_data}")
-        
         # Initialize the correct filters
         self.switch_view_mode()
     
@@ -197,23 +728,23 @@ class FlagImageViewer(tk.Tk):
         
         # Min boxes filter
         ttk.Label(self.bbox_filter_frame, text="Min Boxes:").pack(side=tk.LEFT, padx=(0, 5))
-        min_boxes_spinbox = ttk.Spinbox(self.bbox_filter_frame, from_=1, to=self.max_boxes_in_data, width=5, 
-                                        textvariable=self.min_boxes)
-        min_boxes_spinbox.pack(side=tk.LEFT, padx=(0, 10))
+        self.min_boxes_spinbox = ttk.Spinbox(self.bbox_filter_frame, from_=1, to=self.max_boxes_in_data, width=5, 
+                                             textvariable=self.min_boxes)
+        self.min_boxes_spinbox.pack(side=tk.LEFT, padx=(0, 10))
         
         # Max boxes filter
         ttk.Label(self.bbox_filter_frame, text="Max Boxes:").pack(side=tk.LEFT, padx=(0, 5))
-        max_boxes_spinbox = ttk.Spinbox(self.bbox_filter_frame, from_=1, to=self.max_boxes_in_data, width=5, 
-                                        textvariable=self.max_boxes)
-        max_boxes_spinbox.pack(side=tk.LEFT, padx=(0, 10))
+        self.max_boxes_spinbox = ttk.Spinbox(self.bbox_filter_frame, from_=1, to=self.max_boxes_in_data, width=5, 
+                                             textvariable=self.max_boxes)
+        self.max_boxes_spinbox.pack(side=tk.LEFT, padx=(0, 10))
         
         # Filter button
         filter_button = ttk.Button(self.bbox_filter_frame, text="Apply Filter", command=self.load_images)
         filter_button.pack(side=tk.LEFT, padx=(0, 20))
         
         # Toggle masked/original
-        masked_check = ttk.Checkbutton(self.bbox_filter_frame, text="Show Masked Images", 
-                                      variable=self.show_masked, command=self.update_image)
+        masked_check = ttk.Checkbutton(self.bbox_filter_frame, text="Show Boxes", 
+                                      variable=self.show_masked, command=self.set_box_visibility)
         masked_check.pack(side=tk.LEFT, padx=(0, 20))
     
     def create_classification_filters(self):
@@ -228,9 +759,9 @@ class FlagImageViewer(tk.Tk):
         
         # Town filter
         ttk.Label(self.classification_filter_frame, text="Town:").pack(side=tk.LEFT, padx=(0, 5))
-        town_combo = ttk.Combobox(self.classification_filter_frame, textvariable=self.filter_by_town, 
-                                 values=self.town_list, width=20)
-        town_combo.pack(side=tk.LEFT, padx=(0, 10))
+        self.town_combo = ttk.Combobox(self.classification_filter_frame, textvariable=self.filter_by_town, 
+                                       values=self.town_list, width=20)
+        self.town_combo.pack(side=tk.LEFT, padx=(0, 10))
         
         # Distance hint filter
         ttk.Label(self.classification_filter_frame, text="Distance:").pack(side=tk.LEFT, padx=(0, 5))
@@ -266,7 +797,10 @@ class FlagImageViewer(tk.Tk):
             self.load_classification_images()
     
     def load_images(self):
-        """Load images with bounding boxes in the specified range."""
+        """Start loading images with bounding boxes in the specified range."""
+        if not self.scan_complete:
+            return  # Loading starts once the background scan finishes
+        
         min_boxes = self.min_boxes.get()
         max_boxes = self.max_boxes.get()
         
@@ -277,27 +811,47 @@ class FlagImageViewer(tk.Tk):
             min_boxes = max_boxes
         
         self.status_var.set(f"Finding images with {min_boxes} to {max_boxes} bounding boxes...")
-        self.update()  # Update the UI
         
-        # Find images with bounding boxes in the specified range
-        self.images = self.find_images_with_box_range(min_boxes, max_boxes)
+        # Start a new generation; events from earlier loads are ignored
+        self.load_generation += 1
+        self.images = []
+        self.current_index = 0
+        self.count_label.config(text="Images: 0")
+        self.canvas.delete("all")
+        self.refresh_grid()
         
-        # Update count label
+        # Find images with bounding boxes in the specified range in the background
+        self.executor.submit(self.find_images_with_box_range, min_boxes, max_boxes, self.load_generation)
+    
+    def on_images_found(self, batch):
+        """Append a batch of scanned images, showing the first one immediately."""
+        first_batch = not self.images
+        self.images.extend(batch)
         self.count_label.config(text=f"Images: {len(self.images)}")
-        
+        self.refresh_grid()
+        if first_batch and self.images:
+            self.update_image()
+    
+    def on_images_done(self, range_text):
+        """Sort the completed scan by box count, keeping the current image selected."""
         if not self.images:
-            messagebox.showinfo("No Images", f"No images found with {min_boxes} to {max_boxes} bounding boxes.")
+            messagebox.showinfo("No Images", f"No images found with {range_text} bounding boxes.")
             self.status_var.set("No images found")
             return
         
-        # Reset to first image
-        self.current_index = 0
-        self.update_image()
+        current = self.images[self.current_index]
+        # Sort by box count (descending)
+        self.images.sort(key=lambda x: x['box_count'], reverse=True)
+        self.current_index = self.images.index(current)
+        self.refresh_grid()
         
-        self.status_var.set(f"Loaded {len(self.images)} images with {min_boxes} to {max_boxes} bounding boxes")
+        self.status_var.set(f"Loaded {len(self.images)} images with {range_text} bounding boxes")
     
     def load_classification_images(self):
         """Load images from the classification queue."""
+        # Ignore any bbox scan still running in the background
+        self.load_generation += 1
+        
         try:
             if not os.path.exists(QUEUE_FILE):
                 messagebox.showinfo("Queue File Missing", 
@@ -306,62 +860,38 @@ class FlagImageViewer(tk.Tk):
                 self.status_var.set("Classification queue file not found")
                 return
             
-            self.status_var.set("Loading classification queue...")
-            self.update()  # Update the UI
-            
-            # Load the queue
-            with open(QUEUE_FILE, 'r') as f:
-                queue_data = json.load(f)
-            
-            # Extract the list of images
-            if isinstance(queue_data, dict) and 'images' in queue_data:
-                full_queue = queue_data['images']
-            else:
-                full_queue = queue_data
-            
-            # Apply filters
-            min_conf = self.min_confidence.get()
-            town_filter = self.filter_by_town.get()
-            distance_filter = self.distance_filter.get()
-            max_samples = self.max_samples.get()
-            
-            filtered_queue = []
-            for item in full_queue:
-                # Apply confidence filter
-                if item['confidence'] < min_conf:
-                    continue
-                
-                # Apply town filter
-                if town_filter != "All" and item['town'] != town_filter:
-                    continue
+            # The queue is read and indexed once, and again only if the file changes
+            queue_mtime = os.path.getmtime(QUEUE_FILE)
+            if self.queue_index is None or queue_mtime != self.queue_mtime:
+                self.status_var.set("Loading classification queue...")
+                self.update()  # Update the UI
                 
-                # Apply distance filter
-                if distance_filter != "All":
-                    hint = item.get('distance_hint', '').lower()
-                    if distance_filter == "Distant flags" and "distant" not in hint:
-                        continue
-                    elif distance_filter == "Normal sized" and "normal" not in hint:
-                        continue
-                    elif distance_filter == "Small detections" and "small" not in hint:
-                        continue
+                # Load the queue
+                with open(QUEUE_FILE, 'r') as f:
+                    queue_data = json.load(f)
                 
-                # Check if the image file exists
-                if item.get('is_cropped', False):
-                    image_path = item.get('cropped_image')
+                # Extract the list of images
+                if isinstance(queue_data, dict) and 'images' in queue_data:
+                    full_queue = queue_data['images']
                 else:
-                    image_path = item.get('original_image')
+                    full_queue = queue_data
                 
-                if not os.path.exists(image_path):
-                    continue
-                
-                filtered_queue.append(item)
+                self.queue_index = ClassificationQueueIndex(full_queue)
+                self.queue_mtime = queue_mtime
             
-            # Limit the number of samples
-            if len(filtered_queue) > max_samples:
-                filtered_queue = filtered_queue[:max_samples]
+            # Apply filters
+            start = time.perf_counter()
+            filtered_queue = self.queue_index.filter(
+                min_confidence=self.min_confidence.get(),
+                town=self.filter_by_town.get(),
+                distance=self.distance_filter.get(),
+                limit=self.max_samples.get()
+            )
+            filter_ms = (time.perf_counter() - start) * 1000
             
             self.classification_queue = filtered_queue
             self.images = self.classification_queue  # Use the same variable for consistency in update_image
+            self.refresh_grid()
             
             # Update count label
             self.count_label.config(text=f"Images: {len(self.images)}")
@@ -375,14 +905,20 @@ class FlagImageViewer(tk.Tk):
             self.current_index = 0
             self.update_image()
             
-            self.status_var.set(f"Loaded {len(self.images)} images from classification queue")
+            self.status_var.set(f"Loaded {len(self.images)} images from classification queue "
+                                f"(filtered in {filter_ms:.1f} ms)")
             
         except Exception as e:
             messagebox.showerror("Error", f"Error loading classification queue: {e}")
             self.status_var.set(f"Error: {e}")
     
-    def find_images_with_box_range(self, min_boxes=2, max_boxes=None):
-        """Find all images with bounding boxes in the specified range and return them as a list."""
+    def find_images_with_box_range(self, min_boxes=2, max_boxes=None, generation=None):
+        """
+        Find all images with bounding boxes in the specified range (runs on a worker).
+        
+        Each town's matches are posted to the Tk thread as soon as they are found.
+        No masked images are needed; boxes are drawn live from the detection index.
+        """
         # If max_boxes is None, use the maximum found in the data
         if max_boxes is None:
             max_boxes = self.max_boxes_in_data
@@ -391,57 +927,135 @@ class FlagImageViewer(tk.Tk):
         towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) 
                 if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
         
-        filtered_images = []
-        
         # Process each town
         for town in towns:
+            if generation != self.load_generation:
+                return  # A newer filter was applied
+            
             town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
-            bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
+            batch = []
             
             try:
-                with open(bbox_file, 'r') as f:
-                    bbox_data = json.load(f)
+                index = open_town_index(town)
+                if index is None:
+                    continue
                 
-                # Find images with bounding boxes in the specified range
-                for image_name, detections in bbox_data.items():
-                    box_count = len(detections)
-                    if min_boxes <= box_count <= max_boxes:
-                        image_path = os.path.join(town_dir, image_name)
-                        if os.path.exists(image_path):
-                            # Calculate masked image path
-                            town_output_dir = os.path.join(OUTPUT_DIR, town)
-                            masked_path = os.path.join(town_output_dir, f"masked_{image_name}")
-                            
-                            # Check if masked image exists, create if not
-                            if not os.path.exists(masked_path):
-                                os.makedirs(town_output_dir, exist_ok=True)
-                                self.create_masked_image(image_path, detections, masked_path)
-                            
-                            filtered_images.append({
-                                'town': town,
-                                'image_name': image_name,
-                                'path': image_path,
-                                'masked_path': masked_path,
-                                'box_count': box_count,
-                                'detections': detections
-                            })
+                # Box counts are read from the index slot table
+                for image_name, box_count in index.iter_box_counts(min_boxes, max_boxes):
+                    image_path = os.path.join(town_dir, image_name)
+                    if os.path.exists(image_path):
+                        batch.append({
+                            'town': town,
+                            'image_name': image_name,
+                            'path': image_path,
+                            'box_count': box_count
+                        })
                 
             except Exception as e:
                 print(f"Error scanning {town}: {e}")
+            
+            if batch:
+                batch.sort(key=lambda x: x['box_count'], reverse=True)
+                self.events.put(("images", generation, batch))
         
-        # Sort by box count (descending)
-        filtered_images.sort(key=lambda x: x['box_count'], reverse=True)
+        self.events.put(("images_done", generation, f"{min_boxes} to {max_boxes}"))
+    
+    def load_display_image(self, image_info, mode="bbox"):
+        """Open the image to display for an item."""
+        if mode == "bbox":
+            # Boxes are drawn over the original as canvas items
+            return Image.open(image_info['path'])
+        
+        # Classification queue mode
+        if image_info.get('is_cropped', False):
+            return Image.open(image_info.get('cropped_image'))
+        return Image.open(image_info.get('original_image'))
+    
+    def display_key(self, image_info):
+        """Cache key of an item's display image: (path, canvas size)."""
+        return (item_source_path(image_info), self.canvas_size)
+    
+    def prepare_display_image(self, image_info, mode, canvas_size):
+        """
+        Decode and resize an item's image for display (safe on a worker).
+        
+        Returns:
+            (image, scale, cacheable) where scale is display pixels per source
+            pixel; images not fitted to a drawn canvas are not cacheable
+        """
+        image = self.load_display_image(image_info, mode)
+        scale = 1.0
+        cacheable = True
+        
+        # Resize image to fit canvas while maintaining aspect ratio
+        canvas_width, canvas_height = canvas_size
+        
+        if canvas_width > 1 and canvas_height > 1:  # Ensure canvas has been drawn
+            # Calculate scale factor
+            img_width, img_height = image.size
+            width_ratio = canvas_width / img_width
+            height_ratio = canvas_height / img_height
+            scale_factor = min(width_ratio, height_ratio) * 0.9  # 90% of available space
+            
+            # Resize image
+            new_width = int(img_width * scale_factor)
+            new_height = int(img_height * scale_factor)
+            scale = new_width / img_width
+            # Let the JPEG decoder downscale by a power of two before resampling
+            image.draft("RGB", (new_width, new_height))
+            # Fix for PIL.Image.LANCZOS deprecation
+            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        else:
+            image.load()
+            cacheable = False
+        
+        return image, scale, cacheable
+    
+    def prefetch_neighbours(self):
+        """Prepare display images for the next and previous few items in the background."""
+        if not self.images or self.canvas_size[0] <= 1:
+            return
         
-        return filtered_images
+        mode = self.view_mode.get()
+        for offset in range(1, PREFETCH_AHEAD + 1):
+            for index in (self.current_index + offset, self.current_index - offset):
+                image_info = self.images[index % len(self.images)]
+                key = self.display_key(image_info)
+                if key in self.display_cache or key in self.pending_prefetch:
+                    continue
+                self.pending_prefetch.add(key)
+                self.executor.submit(self.prefetch_image, dict(image_info), key, mode,
+                                     self.load_generation)
     
-    def create_masked_image(self, image_path, detections, output_path):
-        """Create a masked image with bounding boxes and confidence scores."""
+    def prefetch_image(self, image_info, key, mode, generation):
+        """Prepare one display image (runs on a worker)."""
         try:
-            # Import the necessary function from create_masked_images.py
-            from create_masked_images import create_masked_image
-            create_masked_image(image_path, detections, output_path)
+            image, scale, cacheable = self.prepare_display_image(image_info, mode, key[1])
         except Exception as e:
-            print(f"Error creating masked image: {e}")
+            print(f"Error prefetching {key[0]}: {e}")
+            cacheable = False
+        self.events.put(("prepared", generation, (key, (image, scale) if cacheable else None)))
+    
+    def on_image_prepared(self, key, prepared):
+        """Store a prefetched image, unless the canvas has been resized since."""
+        self.pending_prefetch.discard(key)
+        if prepared is not None and key[1] == self.canvas_size:
+            self.display_cache.put(key, prepared)
+    
+    def on_canvas_resize(self, event):
+        """Invalidate cached display images and redraw once resizing settles."""
+        size = (event.width, event.height)
+        if size == self.canvas_size:
+            return
+        self.canvas_size = size
+        self.display_cache.clear()
+        if self.resize_job is not None:
+            self.after_cancel(self.resize_job)
+        self.resize_job = self.after(150, self.on_resize_settled)
+    
+    def on_resize_settled(self):
+        self.resize_job = None
+        self.update_image()
     
     def update_image(self):
         """Update the displayed image."""
@@ -451,44 +1065,26 @@ class FlagImageViewer(tk.Tk):
         # Get current image info
         image_info = self.images[self.current_index]
         
-        # Determine which image to show based on mode
-        if self.view_mode.get() == "bbox":
-            # Original/masked image mode
-            if self.show_masked.get():
-                image_path = image_info['masked_path']
-            else:
-                image_path = image_info['path']
-        else:
-            # Classification queue mode
-            if image_info.get('is_cropped', False):
-                image_path = image_info.get('cropped_image')
-            else:
-                image_path = image_info.get('original_image')
-        
         try:
-            # Load and display the image
-            image = Image.open(image_path)
-            
-            # Resize image to fit canvas while maintaining aspect ratio
-            canvas_width = self.canvas.winfo_width()
-            canvas_height = self.canvas.winfo_height()
-            
-            if canvas_width > 1 and canvas_height > 1:  # Ensure canvas has been drawn
-                # Calculate scale factor
-                img_width, img_height = image.size
-                width_ratio = canvas_width / img_width
-                height_ratio = canvas_height / img_height
-                scale_factor = min(width_ratio, height_ratio) * 0.9  # 90% of available space
-                
-                # Resize image
-                new_width = int(img_width * scale_factor)
-                new_height = int(img_height * scale_factor)
-                # Fix for PIL.Image.LANCZOS deprecation
-                image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            # Use the prefetched display image when there is one
+            key = self.display_key(image_info)
+            prepared = self.display_cache.get(key)
+            if prepared is None:
+                image, scale, cacheable = self.prepare_display_image(
+                    image_info, self.view_mode.get(), self.canvas_size)
+                prepared = (image, scale)
+                if cacheable:
+                    self.display_cache.put(key, prepared)
+            image, self.box_scale = prepared
             
             # Convert to PhotoImage
             self.current_image_tk = ImageTk.PhotoImage(image)
             
+            # A new image starts at the fit-to-canvas view
+            self.pyramid = None
+            self.zoom_scale = None
+            self.tile_photos = {}
+            
             # Clear canvas and display image
             self.canvas.delete("all")
             self.canvas.create_image(0, 0, anchor=tk.NW, image=self.current_image_tk)
@@ -496,6 +1092,15 @@ class FlagImageViewer(tk.Tk):
             # Configure canvas scrolling
             self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
             
+            # Detections are read from the detection index and drawn as vectors
+            self.selected_box = None
+            if self.view_mode.get() == "bbox":
+                self.current_detections = get_detections(image_info['town'], image_info['image_name']) or []
+            else:
+                self.current_detections = []
+            self.box_index = BoxSpatialIndex([d['box'] for d in self.current_detections])
+            self.draw_boxes(self.box_scale)
+            
             # Update info text
             if self.view_mode.get() == "bbox":
                 self.update_bbox_info_text(image_info)
@@ -508,6 +1113,58 @@ class FlagImageViewer(tk.Tk):
         except Exception as e:
             self.status_var.set(f"Error loading image: {e}")
             print(f"Error loading image: {e}")
+        
+        # Warm the cache for the images either side of this one
+        self.prefetch_neighbours()
+        
+        # Keep the grid's highlight on the current image
+        if self.grid_window is not None:
+            self.grid_window.render()
+    
+    def draw_boxes(self, scale):
+        """Draw the current detections as canvas items at a display scale."""
+        self.canvas.delete("boxes")
+        state = tk.NORMAL if self.show_masked.get() else tk.HIDDEN
+        
+        for i, detection in enumerate(self.current_detections):
+            x0, y0, x1, y1 = [coord * scale for coord in detection['box']]
+            selected = i == self.selected_box
+            self.canvas.create_rectangle(x0, y0, x1, y1, tags="boxes", state=state,
+                                         outline=SELECTED_BOX_COLOR if selected else BOX_COLOR,
+                                         width=3 if selected else 2, dash=() if selected else (5, 5))
+            self.canvas.create_text(x0, y0 - 2, anchor=tk.SW, tags="boxes", state=state,
+                                    text=f"Conf: {detection['confidence']:.2f}",
+                                    fill=SELECTED_BOX_COLOR if selected else BOX_COLOR)
+    
+    def set_box_visibility(self):
+        """Show or hide the drawn boxes (no image I/O)."""
+        state = tk.NORMAL if self.show_masked.get() else tk.HIDDEN
+        self.canvas.itemconfigure("boxes", state=state)
+    
+    def on_press(self, event):
+        self.press_position = (event.x, event.y)
+        self.canvas.scan_mark(event.x, event.y)
+    
+    def on_release(self, event):
+        """Treat a press and release without dragging as a click on a box."""
+        if self.press_position is None:
+            return
+        moved = abs(event.x - self.press_position[0]) + abs(event.y - self.press_position[1])
+        self.press_position = None
+        if moved <= 3:
+            self.inspect_box(event)
+    
+    def inspect_box(self, event):
+        """Select the smallest box under the cursor and show its details."""
+        if self.box_index is None or not self.current_detections or not self.show_masked.get():
+            return
+        
+        scale = self.zoom_scale if self.pyramid is not None else self.box_scale
+        hits = self.box_index.query(self.canvas.canvasx(event.x) / scale,
+                                    self.canvas.canvasy(event.y) / scale)
+        self.selected_box = hits[0] if hits else None
+        self.draw_boxes(scale)
+        self.update_bbox_info_text(self.images[self.current_index])
     
     def update_bbox_info_text(self, image_info):
         """Update the information text panel for bbox mode."""
@@ -518,9 +1175,15 @@ class FlagImageViewer(tk.Tk):
         info += f"Image: {image_info['image_name']}\n"
         info += f"Bounding Boxes: {image_info['box_count']}\n\n"
         
+        # Selected box, if one was clicked
+        if self.selected_box is not None:
+            detection = self.current_detections[self.selected_box]
+            info += f"Selected: Box {self.selected_box + 1}: Confidence: {detection['confidence']:.2f}, "
+            info += f"Coords: {detection['box']}\n\n"
+        
         # Detailed detection info
         info += "Detections:\n"
-        for i, detection in enumerate(image_info['detections']):
+        for i, detection in enumerate(self.current_detections):
             box = detection['box']
             confidence = detection['confidence']
             info += f"  Box {i+1}: Confidence: {confidence:.2f}, Coords: {box}\n"
@@ -589,25 +1252,94 @@ class FlagImageViewer(tk.Tk):
         self.update_image()
     
     def toggle_masked(self):
-        """Toggle between masked and original images."""
+        """Toggle the drawn bounding boxes."""
         if self.view_mode.get() == "bbox":
             self.show_masked.set(not self.show_masked.get())
-            self.update_image()
+            self.set_box_visibility()
     
     def zoom(self, event):
-        """Handle zoom with mouse wheel."""
+        """Handle zoom with mouse wheel, keeping the point under the cursor fixed."""
         if not self.current_image_tk:
             return
         
         # Determine zoom direction
         if event.num == 4 or event.delta > 0:  # Zoom in
-            factor = 1.1
+            factor = 1.25
         else:  # Zoom out
-            factor = 0.9
+            factor = 0.8
+        
+        if self.pyramid is None:
+            # Build the pyramid from the full-resolution current image
+            try:
+                image_info = self.images[self.current_index]
+                image = self.load_display_image(image_info, self.view_mode.get()).convert("RGB")
+            except Exception as e:
+                self.status_var.set(f"Error zooming: {e}")
+                return
+            self.pyramid = TilePyramid(image)
+            self.fit_scale = self.current_image_tk.width() / image.width
+            self.zoom_scale = self.fit_scale
+        
+        new_scale = min(max(self.zoom_scale * factor, self.fit_scale), MAX_ZOOM)
+        if new_scale == self.zoom_scale:
+            return
         
-        # Apply zoom
-        self.canvas.scale("all", event.x, event.y, factor, factor)
-        self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
+        # Source image point under the cursor
+        source_x = self.canvas.canvasx(event.x) / self.zoom_scale
+        source_y = self.canvas.canvasy(event.y) / self.zoom_scale
+        
+        self.zoom_scale = new_scale
+        self.tile_photos = {}
+        width = self.pyramid.size[0] * new_scale
+        height = self.pyramid.size[1] * new_scale
+        self.canvas.config(scrollregion=(0, 0, width, height))
+        self.canvas.xview_moveto(max(0, source_x * new_scale - event.x) / width)
+        self.canvas.yview_moveto(max(0, source_y * new_scale - event.y) / height)
+        
+        self.render_tiles()
+        self.status_var.set(f"Image {self.current_index + 1} of {len(self.images)} - "
+                            f"zoom {new_scale / self.fit_scale:.1f}x")
+    
+    def render_tiles(self):
+        """Draw the pyramid tiles that intersect the visible part of the canvas."""
+        if self.pyramid is None:
+            return
+        
+        view = (self.canvas.canvasx(0), self.canvas.canvasy(0),
+                self.canvas.canvasx(self.canvas.winfo_width()),
+                self.canvas.canvasy(self.canvas.winfo_height()))
+        
+        # Tiles are resampled at most once per zoom level; bound the PhotoImages kept
+        if len(self.tile_photos) > TILE_CACHE_SIZE:
+            self.tile_photos = {}
+        
+        self.canvas.delete("all")
+        for level, tx, ty, (x, y, width, height) in self.pyramid.visible_tiles(self.zoom_scale, view):
+            photo = self.tile_photos.get((level, tx, ty))
+            if photo is None:
+                tile = self.pyramid.tile(level, tx, ty)
+                resample = Image.Resampling.NEAREST if self.zoom_scale > 2 else Image.Resampling.BILINEAR
+                photo = ImageTk.PhotoImage(tile.resize((width, height), resample))
+                self.tile_photos[(level, tx, ty)] = photo
+            self.canvas.create_image(x, y, anchor=tk.NW, image=photo)
+        
+        # Boxes stay sharp at any zoom because they are redrawn as vectors
+        self.draw_boxes(self.zoom_scale)
+    
+    def scroll_x(self, *args):
+        self.canvas.xview(*args)
+        self.render_tiles()
+    
+    def scroll_y(self, *args):
+        self.canvas.yview(*args)
+        self.render_tiles()
+    
+    def pan(self, event):
+        """Drag the view of a zoomed image."""
+        if self.pyramid is None:
+            return
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.render_tiles()
 
 if __name__ == "__main__":
     app = FlagImageViewer()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Multi-Expert Label Consensus (Dawid-Skene EM)
+
+This script estimates consensus labels and per-expert reliability from the
+expert classifications export. Labels are held as a sparse item x expert x class
+count tensor (one entry per label), and both majority vote and Dawid-Skene EM
+are computed with vectorized NumPy operations, so hundreds of thousands of
+labels are processed in seconds.
+
+Usage:
+    python scripts/label_consensus.py [options]
+
+Options:
+    --classifications FILE   Classifications export (default: data/classifications/classifications.json)
+    --field NAME             Label field: primaryCategory or specificFlag (default: primaryCategory)
+    --method NAME            Consensus method: dawid-skene or majority (default: dawid-skene)
+    --weight-by-confidence   Weight each label by the expert's confidence (1-5)
+    --max-iter INT           Maximum EM iterations (default: 100)
+    --tol FLOAT              Convergence tolerance on the log-likelihood (default: 1e-6)
+    --output FILE            Write consensus labels and expert reliabilities to a JSON file
+"""
+
+import os
+import json
+import argparse
+import time
+import numpy as np
+
+from classification_store import CLASSIFICATIONS_FILE, load_classifications, normalize_image_id
+
+# Maximum value of the expert confidence field, used to scale label weights
+MAX_EXPERT_CONFIDENCE = 5
+
+# Pseudo-count added to confusion matrices and class priors to avoid log(0)
+SMOOTHING = 0.01
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Estimate consensus labels from multiple experts")
+
+    parser.add_argument("--classifications", type=str, default=CLASSIFICATIONS_FILE,
+                        help=f"Classifications export (default: {CLASSIFICATIONS_FILE})")
+    parser.add_argument("--field", type=str, default="primaryCategory",
+                        choices=["primaryCategory", "specificFlag"],
+                        help="Label field (default: primaryCategory)")
+    parser.add_argument("--method", type=str, default="dawid-skene", choices=["dawid-skene", "majority"],
+                        help="Consensus method (default: dawid-skene)")
+    parser.add_argument("--weight-by-confidence", action="store_true",
+                        help="Weight each label by the expert's confidence (1-5)")
+    parser.add_argument("--max-iter", type=int, default=100,
+                        help="Maximum EM iterations (default: 100)")
+    parser.add_argument("--tol", type=float, default=1e-6,
+                        help="Convergence tolerance on the log-likelihood (default: 1e-6)")
+    parser.add_argument("--output", type=str,
+                        help="Write consensus labels and expert reliabilities to a JSON file")
+
+    return parser.parse_args()
+
+def build_label_tensor(records, field="primaryCategory", weight_by_confidence=False):
+    """
+    Build the sparse item x expert x class label tensor.
+
+    The tensor is returned in coordinate form: parallel arrays of item, expert
+    and class indices plus a weight per label. Records with an empty value for
+    the field are skipped.
+
+    Returns:
+        Dictionary with 'items', 'experts', 'classes' (index -> name lists) and
+        'item_idx', 'expert_idx', 'class_idx', 'weight' arrays
+    """
+    item_ids = {}
+    expert_ids = {}
+    class_ids = {}
+    item_idx = []
+    expert_idx = []
+    class_idx = []
+    weight = []
+
+    for record in records:
+        value = record.get(field) or ""
+        image_id = record.get("imageId")
+        if not value or not image_id:
+            continue
+
+        item_idx.append(item_ids.setdefault(normalize_image_id(image_id), len(item_ids)))
+        expert_idx.append(expert_ids.setdefault(record.get("expertId") or "anonymous", len(expert_ids)))
+        class_idx.append(class_ids.setdefault(value, len(class_ids)))
+
+        if weight_by_confidence:
+            confidence = record.get("confidence") or MAX_EXPERT_CONFIDENCE
+            weight.append(min(max(float(confidence), 1.0), MAX_EXPERT_CONFIDENCE) / MAX_EXPERT_CONFIDENCE)
+        else:
+            weight.append(1.0)
+
+    return {
+        "items": list(item_ids),
+        "experts": list(expert_ids),
+        "classes": list(class_ids),
+        "item_idx": np.asarray(item_idx, dtype=np.int64),
+        "expert_idx": np.asarray(expert_idx, dtype=np.int64),
+        "class_idx": np.asarray(class_idx, dtype=np.int64),
+        "weight": np.asarray(weight, dtype=np.float64)
+    }
+
+def item_class_counts(tensor):
+    """Sum label weights into a dense item x class matrix."""
+    n_items = len(tensor["items"])
+    n_classes = len(tensor["classes"])
+    flat = tensor["item_idx"] * n_classes + tensor["class_idx"]
+    counts = np.bincount(flat, weights=tensor["weight"], minlength=n_items * n_classes)
+    return counts.reshape(n_items, n_classes)
+
+def majority_vote(tensor):
+    """
+    Weighted majority vote baseline.
+
+    Returns:
+        Item x class matrix of vote shares (ties share the posterior mass)
+    """
+    counts = item_class_counts(tensor)
+    totals = counts.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1.0
+    return counts / totals
+
+def _confusion_matrices(tensor, posteriors):
+    """M-step: expected expert x true class x observed class counts, row-normalized."""
+    n_experts = len(tensor["experts"])
+    n_classes = len(tensor["classes"])
+
+    # Each label contributes posterior[item, j] * weight to cell (expert, j, observed class)
+    values = posteriors[tensor["item_idx"]] * tensor["weight"][:, None]
+    base = tensor["expert_idx"] * n_classes * n_classes + tensor["class_idx"]
+    flat = base[:, None] + np.arange(n_classes)[None, :] * n_classes
+    counts = np.bincount(flat.ravel(), weights=values.ravel(), minlength=n_experts * n_classes * n_classes)
+    counts = counts.reshape(n_experts, n_classes, n_classes) + SMOOTHING
+
+    return counts / counts.sum(axis=2, keepdims=True)
+
+def _log_posteriors(tensor, log_priors, log_confusion):
+    """E-step: unnormalized log posterior of each true class for every item."""
+    n_items = len(tensor["items"])
+    n_classes = len(tensor["classes"])
+
+    # log P(observed | true = j) for every label, shape (labels, classes)
+    per_label = log_confusion[tensor["expert_idx"], :, tensor["class_idx"]] * tensor["weight"][:, None]
+    flat = tensor["item_idx"][:, None] * n_classes + np.arange(n_classes)[None, :]
+    sums = np.bincount(flat.ravel(), weights=per_label.ravel(), minlength=n_items * n_classes)
+
+    return sums.reshape(n_items, n_classes) + log_priors[None, :]
+
+def dawid_skene(tensor, max_iter=100, tol=1e-6):
+    """
+    Run Dawid-Skene EM, initialized from the weighted majority vote.
+
+    Returns:
+        Dictionary with 'posteriors' (items x classes), 'confusion'
+        (experts x true class x observed class), 'priors', 'iterations',
+        'log_likelihood' and 'converged'
+    """
+    posteriors = majority_vote(tensor)
+    previous = -np.inf
+    log_likelihood = previous
+    converged = False
+    iteration = 0
+
+    for iteration in range(1, max_iter + 1):
+        # M-step
+        priors = posteriors.sum(axis=0) + SMOOTHING
+        priors /= priors.sum()
+        confusion = _confusion_matrices(tensor, posteriors)
+
+        # E-step
+        log_post = _log_posteriors(tensor, np.log(priors), np.log(confusion))
+        log_norm = np.logaddexp.reduce(log_post, axis=1)
+        posteriors = np.exp(log_post - log_norm[:, None])
+
+        log_likelihood = float(log_norm.sum())
+        if abs(log_likelihood - previous) <= tol * max(1.0, abs(log_likelihood)):
+            converged = True
+            break
+        previous = log_likelihood
+
+    return {
+        "posteriors": posteriors,
+        "confusion": confusion,
+        "priors": priors,
+        "iterations": iteration,
+        "log_likelihood": log_likelihood,
+        "converged": converged
+    }
+
+def expert_reliability(tensor, confusion, priors):
+    """Per-expert accuracy implied by the confusion matrices and class priors."""
+    diagonal = np.diagonal(confusion, axis1=1, axis2=2)
+    accuracy = diagonal @ priors
+    label_counts = np.bincount(tensor["expert_idx"], minlength=len(tensor["experts"]))
+
+    return [
+        {"expert_id": expert, "labels": int(label_counts[e]), "accuracy": float(accuracy[e]),
+         "confusion": confusion[e].round(4).tolist()}
+        for e, expert in enumerate(tensor["experts"])
+    ]
+
+def consensus_labels(tensor, posteriors):
+    """Consensus label and its posterior probability for every item."""
+    best = posteriors.argmax(axis=1)
+    best_prob = posteriors[np.arange(len(best)), best]
+    label_counts = np.bincount(tensor["item_idx"], minlength=len(tensor["items"]))
+
+    return [
+        {"image_id": item, "label": tensor["classes"][best[i]], "probability": float(best_prob[i]),
+         "labels": int(label_counts[i]),
+         "posterior": {c: float(p) for c, p in zip(tensor["classes"], posteriors[i]) if p >= 0.001}}
+        for i, item in enumerate(tensor["items"])
+    ]
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    records = load_classifications(args.classifications)
+    tensor = build_label_tensor(records, args.field, args.weight_by_confidence)
+    if not len(tensor["item_idx"]):
+        print(f"No labels found for {args.field}. Exiting.")
+        return
+
+    print(f"Loaded {len(tensor['item_idx'])} labels on {len(tensor['items'])} items "
+          f"from {len(tensor['experts'])} experts ({len(tensor['classes'])} classes)")
+
+    start = time.perf_counter()
+    majority = majority_vote(tensor)
+    result = None
+    if args.method == "dawid-skene":
+        result = dawid_skene(tensor, args.max_iter, args.tol)
+        posteriors = result["posteriors"]
+        status = "converged" if result["converged"] else "did not converge"
+        print(f"Dawid-Skene {status} after {result['iterations']} iterations "
+              f"(log-likelihood {result['log_likelihood']:.2f})")
+    else:
+        posteriors = majority
+    print(f"Consensus computed in {time.perf_counter() - start:.2f} seconds")
+
+    labels = consensus_labels(tensor, posteriors)
+    changed = int((posteriors.argmax(axis=1) != majority.argmax(axis=1)).sum())
+    if args.method == "dawid-skene":
+        print(f"Items where consensus differs from majority vote: {changed}")
+
+    reliabilities = []
+    if result is not None:
+        reliabilities = expert_reliability(tensor, result["confusion"], result["priors"])
+        print("\nEstimated expert accuracy:")
+        for row in sorted(reliabilities, key=lambda x: x["accuracy"], reverse=True):
+            print(f"  {row['expert_id']}: {row['accuracy']:.1%} over {row['labels']} labels")
+
+    print("\nConsensus label distribution:")
+    distribution = np.bincount(posteriors.argmax(axis=1), minlength=len(tensor["classes"]))
+    for c, count in sorted(zip(tensor["classes"], distribution), key=lambda x: x[1], reverse=True):
+        print(f"  {c}: {count} items")
+
+    if args.output:
+        output_dir = os.path.dirname(args.output)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({
+                "metadata": {
+                    "field": args.field,
+                    "method": args.method,
+                    "weight_by_confidence": args.weight_by_confidence,
+                    "labels": int(len(tensor["item_idx"])),
+                    "classes": tensor["classes"]
+                },
+                "items": labels,
+                "experts": reliabilities
+            }, f, indent=2)
+        print(f"\nConsensus saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Uncertainty- and Coverage-Driven Labelling Scheduler
+
+This script ranks the classification queue by how much another expert label
+would improve the dataset. Each item's priority combines:
+1. Label need - items below the target number of labels come first
+2. Disagreement - normalized entropy of the labels the item already has
+3. Detector score - the original queue ordering key (confidence and relative size)
+4. Town coverage - a bonus for towns that are below their labelled-item target
+
+Priorities live in indexed heaps (one per town, plus a town-level bonus), so a
+new label updates the ranking in O(log n) instead of re-sorting the queue.
+Experts can get their own copy of the heaps without the items they have
+already seen, so handing them work never walks past those items.
+
+Usage:
+    python scripts/labeling_scheduler.py [options]
+
+Options:
+    --queue-file FILE        Classification queue (default: data/classification_queue.json)
+    --classifications FILE   Classifications export (default: data/classifications/classifications.json)
+    --field NAME             Label field used for disagreement (default: primaryCategory)
+    --target-labels INT      Labels wanted per item (default: 3)
+    --max-labels INT         Items with this many labels are no longer scheduled (default: 5)
+    --town-target INT        Labelled items wanted per town (default: 50)
+    --top INT                Number of items to print (default: 20)
+    --output FILE            Write the queue in priority order to a JSON file
+"""
+
+import os
+import json
+import argparse
+import math
+import time
+from collections import Counter, defaultdict
+
+from classification_store import CLASSIFICATIONS_FILE, load_classifications, normalize_image_id
+
+# Base directories
+BASE_DIR = "data"
+QUEUE_FILE = os.path.join(BASE_DIR, "classification_queue.json")
+
+# Relative weight of each priority component
+DEFAULT_WEIGHTS = {
+    "label_need": 1.0,
+    "disagreement": 0.8,
+    "detector": 0.3,
+    "town_coverage": 0.5
+}
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Rank the classification queue by labelling priority")
+
+    parser.add_argument("--queue-file", type=str, default=QUEUE_FILE,
+                        help=f"Classification queue (default: {QUEUE_FILE})")
+    parser.add_argument("--classifications", type=str, default=CLASSIFICATIONS_FILE,
+                        help=f"Classifications export (default: {CLASSIFICATIONS_FILE})")
+    parser.add_argument("--field", type=str, default="primaryCategory",
+                        help="Label field used for disagreement (default: primaryCategory)")
+    parser.add_argument("--target-labels", type=int, default=3,
+                        help="Labels wanted per item (default: 3)")
+    parser.add_argument("--max-labels", type=int, default=5,
+                        help="Items with this many labels are no longer scheduled (default: 5)")
+    parser.add_argument("--town-target", type=int, default=50,
+                        help="Labelled items wanted per town (default: 50)")
+    parser.add_argument("--top", type=int, default=20,
+                        help="Number of items to print (default: 20)")
+    parser.add_argument("--output", type=str,
+                        help="Write the queue in priority order to a JSON file")
+
+    return parser.parse_args()
+
+def queue_sort_key(item):
+    """The detector-based ordering key used by prepare_images_for_classification."""
+    return item.get('confidence', 0) * 0.7 + item.get('relative_size', 0.1) * 30
+
+def load_queue_items(queue_file):
+    """Load the list of items from a classification queue file."""
+    try:
+        with open(queue_file, 'r') as f:
+            queue_data = json.load(f)
+    except Exception as e:
+        print(f"Error loading classification queue: {e}")
+        return []
+
+    if isinstance(queue_data, dict) and 'images' in queue_data:
+        return queue_data['images']
+    return queue_data
+
+class IndexedHeap:
+    """
+    Max-heap keyed by item id with a position index.
+
+    The index allows the priority of any item to be changed or the item to be
+    removed in O(log n), which a plain heapq list cannot do.
+    """
+
+    def __init__(self):
+        self._heap = []       # list of [priority, key]
+        self._position = {}   # key -> index in self._heap
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._position
+
+    def priority(self, key):
+        return self._heap[self._position[key]][0]
+
+    def push(self, key, priority):
+        """Add a key, or update its priority if it is already present."""
+        if key in self._position:
+            self.update(key, priority)
+            return
+        self._heap.append([priority, key])
+        self._position[key] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def update(self, key, priority):
+        index = self._position[key]
+        old = self._heap[index][0]
+        self._heap[index][0] = priority
+        if priority > old:
+            self._sift_up(index)
+        elif priority < old:
+            self._sift_down(index)
+
+    def remove(self, key):
+        index = self._position.pop(key)
+        last = self._heap.pop()
+        if index < len(self._heap):
+            self._heap[index] = last
+            self._position[last[1]] = index
+            self._sift_up(index)
+            self._sift_down(self._position[last[1]])
+
+    def items(self):
+        """(key, priority) of every item, in heap order."""
+        return [(key, priority) for priority, key in self._heap]
+
+    def peek(self):
+        """Return (key, priority) of the highest priority item without removing it."""
+        priority, key = self._heap[0]
+        return key, priority
+
+    def pop(self):
+        key, priority = self.peek()
+        self.remove(key)
+        return key, priority
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._position[heap[i][1]] = i
+        self._position[heap[j][1]] = j
+
+    def _sift_up(self, index):
+        heap = self._heap
+        while index > 0:
+            parent = (index - 1) // 2
+            if heap[index][0] <= heap[parent][0]:
+                break
+            self._swap(index, parent)
+            index = parent
+
+    def _sift_down(self, index):
+        heap = self._heap
+        size = len(heap)
+        while True:
+            largest = index
+            left = 2 * index + 1
+            right = left + 1
+            if left < size and heap[left][0] > heap[largest][0]:
+                largest = left
+            if right < size and heap[right][0] > heap[largest][0]:
+                largest = right
+            if largest == index:
+                break
+            self._swap(index, largest)
+            index = largest
+
+class LabelingScheduler:
+    """Maintains labelling priorities for queue items as labels arrive."""
+
+    def __init__(self, queue_items, field="primaryCategory", target_labels=3, max_labels=5,
+                 town_target=50, weights=None):
+        self.field = field
+        self.target_labels = target_labels
+        self.max_labels = max_labels
+        self.town_target = town_target
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+
+        self.items = {}                               # item id -> queue item
+        self.label_counts = defaultdict(Counter)      # item id -> Counter of label values
+        self.num_labels = Counter()                   # item id -> labels received
+        self.expert_labels = {}                       # (expert id, item id) -> label value
+        self.classes = set()
+        self.town_labelled = Counter()                # town -> items with at least one label
+        self.town_pending = Counter()                 # town -> items currently out for labelling
+        self.town_heaps = defaultdict(IndexedHeap)    # town -> IndexedHeap of local priorities
+        self.expert_views = {}                        # expert id -> (excluded item ids, town -> IndexedHeap)
+
+        max_key = max((queue_sort_key(item) for item in queue_items), default=1.0) or 1.0
+        self._detector_score = {}
+        for item in queue_items:
+            item_id = item.get('filename') or os.path.basename(item.get('cropped_image', ''))
+            if not item_id:
+                continue
+            self.items[item_id] = item
+            self._detector_score[item_id] = queue_sort_key(item) / max_key
+
+        for item_id, item in self.items.items():
+            self.town_heaps[item.get('town', 'unknown')].push(item_id, self.local_priority(item_id))
+
+    def __len__(self):
+        return sum(len(heap) for heap in self.town_heaps.values())
+
+    def _town(self, item_id):
+        return self.items[item_id].get('town', 'unknown')
+
+    def _schedule(self, item_id, priority):
+        """Add an item (or change its priority) in the main heaps and every expert view that has not excluded it."""
+        town = self._town(item_id)
+        self.town_heaps[town].push(item_id, priority)
+        for excluded, heaps in self.expert_views.values():
+            if item_id not in excluded:
+                heaps[town].push(item_id, priority)
+
+    def take(self, item_id):
+        """Remove an item from the schedule (e.g. while it is leased), including every expert view."""
+        town = self._town(item_id)
+        for heaps in [self.town_heaps] + [heaps for _, heaps in self.expert_views.values()]:
+            heap = heaps[town]
+            if item_id in heap:
+                heap.remove(item_id)
+
+    def add_expert(self, expert_id, excluded=()):
+        """
+        Give an expert their own heaps: the schedule minus the items in `excluded`.
+
+        Every priority change is applied to each expert's heaps as well, so
+        labels cost O(experts * log n), but pop_next for an expert never has
+        to skip the items they have already seen. Does nothing if the expert
+        already has heaps.
+        """
+        if expert_id in self.expert_views:
+            return
+        excluded = set(excluded)
+        heaps = defaultdict(IndexedHeap)
+        for town, heap in self.town_heaps.items():
+            for item_id, priority in heap.items():
+                if item_id not in excluded:
+                    heaps[town].push(item_id, priority)
+        self.expert_views[expert_id] = (excluded, heaps)
+
+    def exclude(self, expert_id, item_id):
+        """Keep an item out of an expert's heaps from now on (no-op for experts without heaps)."""
+        view = self.expert_views.get(expert_id)
+        if view is None:
+            return
+        excluded, heaps = view
+        excluded.add(item_id)
+        heap = heaps[self._town(item_id)]
+        if item_id in heap:
+            heap.remove(item_id)
+
+    def disagreement(self, item_id):
+        """Normalized entropy (0-1) of the labels an item has received."""
+        counts = self.label_counts.get(item_id)
+        total = self.num_labels[item_id]
+        if not counts or total < 2:
+            return 0.0
+
+        entropy = -sum((c / total) * math.log(c / total) for c in counts.values() if c)
+        return entropy / math.log(max(2, len(self.classes)))
+
+    def local_priority(self, item_id):
+        """Priority of an item ignoring its town's coverage bonus."""
+        labels = self.num_labels[item_id]
+        label_need = max(0, self.target_labels - labels) / self.target_labels
+
+        return (self.weights["label_need"] * label_need +
+                self.weights["disagreement"] * self.disagreement(item_id) +
+                self.weights["detector"] * self._detector_score[item_id])
+
+    def town_bonus(self, town):
+        """Coverage bonus for towns with fewer labelled (or pending) items than the target."""
+        if self.town_target <= 0:
+            return 0.0
+        covered = self.town_labelled[town] + self.town_pending[town]
+        deficit = max(0, self.town_target - covered) / self.town_target
+        return self.weights["town_coverage"] * deficit
+
+    def priority(self, item_id):
+        town = self.items[item_id].get('town', 'unknown')
+        return self.local_priority(item_id) + self.town_bonus(town)
+
+    def add_label(self, record):
+        """
+        Account for one new classification record. Returns the affected item id or None.
+
+        Each expert counts once per item: a later record from the same expert
+        replaces their earlier label, and an identical one is ignored.
+        """
+        item_id = normalize_image_id(record.get("imageId", ""))
+        if item_id not in self.items:
+            return None
+
+        value = record.get(self.field) or ""
+        expert_id = record.get("expertId")
+        key = (expert_id, item_id)
+        if expert_id and key in self.expert_labels:
+            previous = self.expert_labels[key]
+            if previous == value:
+                return None
+            if previous:
+                self.label_counts[item_id][previous] -= 1
+                if self.label_counts[item_id][previous] <= 0:
+                    del self.label_counts[item_id][previous]
+        else:
+            if self.num_labels[item_id] == 0:
+                self.town_labelled[self.items[item_id].get('town', 'unknown')] += 1
+            self.num_labels[item_id] += 1
+        if expert_id:
+            self.expert_labels[key] = value
+
+        if value:
+            self.label_counts[item_id][value] += 1
+            if value not in self.classes:
+                # The entropy normalization changes, but only items that already
+                # disagree are affected; refresh those so the heaps stay exact
+                self.classes.add(value)
+                self._refresh_disagreeing()
+
+        # Items taken out of the schedule (e.g. leased to an expert) stay out
+        # until they are pushed back
+        if item_id in self.town_heaps[self._town(item_id)]:
+            if self.num_labels[item_id] >= self.max_labels:
+                self.take(item_id)
+            else:
+                self._schedule(item_id, self.local_priority(item_id))
+
+        return item_id
+
+    def add_labels(self, records):
+        """Account for a batch of classification records. Returns the number that matched queue items."""
+        return sum(1 for record in records if self.add_label(record) is not None)
+
+    def _refresh_disagreeing(self):
+        for item_id, counts in self.label_counts.items():
+            if len(counts) > 1 and item_id in self.town_heaps[self._town(item_id)]:
+                self._schedule(item_id, self.local_priority(item_id))
+
+    def pop_next(self, expert_id=None):
+        """
+        Remove and return (item_id, priority) of the highest priority item.
+
+        Only the top of each town heap is compared, so the cost is
+        O(towns + log n), plus O(log n) per expert view the item is removed
+        from. With an expert_id (see add_expert), the pick comes from that
+        expert's heaps, which already leave out the items they have seen.
+        """
+        heaps = self.town_heaps if expert_id is None else self.expert_views[expert_id][1]
+
+        best_town = None
+        best_priority = None
+        for town, heap in heaps.items():
+            if not len(heap):
+                continue
+            priority = heap.peek()[1] + self.town_bonus(town)
+            if best_priority is None or priority > best_priority:
+                best_town, best_priority = town, priority
+
+        if best_town is None:
+            return None
+
+        item_id, _ = heaps[best_town].peek()
+        self.take(item_id)
+        return item_id, best_priority
+
+    def push(self, item_id):
+        """Return an item to the schedule (e.g. after pop_next, if it was not labelled)."""
+        if self.num_labels[item_id] < self.max_labels:
+            self._schedule(item_id, self.local_priority(item_id))
+
+    def top(self, n, expert_id=None):
+        """The n highest priority items, without changing the schedule."""
+        popped = []
+        for _ in range(n):
+            entry = self.pop_next(expert_id)
+            if entry is None:
+                break
+            popped.append(entry)
+
+        for item_id, _ in popped:
+            self.push(item_id)
+
+        return popped
+
+    def ranked(self):
+        """All scheduled items in priority order (the schedule is left unchanged)."""
+        return self.top(len(self))
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    queue_items = load_queue_items(args.queue_file)
+    if not queue_items:
+        print("No items in classification queue. Exiting.")
+        return
+
+    start = time.perf_counter()
+    scheduler = LabelingScheduler(queue_items, field=args.field, target_labels=args.target_labels,
+                                  max_labels=args.max_labels, town_target=args.town_target)
+    print(f"Built schedule for {len(scheduler.items)} items in {time.perf_counter() - start:.2f} seconds")
+
+    records = load_classifications(args.classifications)
+    start = time.perf_counter()
+    matched = scheduler.add_labels(sorted(records, key=lambda r: r.get("timestamp", "")))
+    elapsed = time.perf_counter() - start
+    print(f"Applied {matched}/{len(records)} labels in {elapsed * 1000:.1f} ms")
+    print(f"Items still scheduled: {len(scheduler)}")
+
+    print(f"\nTop {args.top} items:")
+    for item_id, priority in scheduler.top(args.top):
+        item = scheduler.items[item_id]
+        print(f"  {priority:.3f}  {item.get('town', 'unknown')}/{item_id} "
+              f"(labels: {scheduler.num_labels[item_id]}, disagreement: {scheduler.disagreement(item_id):.2f}, "
+              f"confidence: {item.get('confidence', 0):.2f})")
+
+    if args.output:
+        ranked = scheduler.ranked()
+        ordered = []
+        for item_id, priority in ranked:
+            item = dict(scheduler.items[item_id])
+            item['priority'] = round(priority, 6)
+            item['label_count'] = scheduler.num_labels[item_id]
+            ordered.append(item)
+
+        with open(args.output, 'w') as f:
+            json.dump({
+                "metadata": {
+                    "source_queue": args.queue_file,
+                    "target_labels": args.target_labels,
+                    "max_labels": args.max_labels,
+                    "town_target": args.town_target,
+                    "total_images": len(ordered)
+                },
+                "images": ordered
+            }, f, indent=2)
+        print(f"\nPrioritized queue saved to: {args.output}")
+
+if __name__ == "__main__":
+    main()
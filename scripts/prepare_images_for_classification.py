@@ -28,6 +28,35 @@ Options:
     --copy-to-public         Copy processed images to the public directory
     --public-dir             Public directory for web-accessible images (default: public/images)
     --side-by-side           Create side-by-side versions of cropped and original images
+    --resample POLICY        Composite resampling policy: quality, balanced or speed (default: quality)
+    --layered                Write one shared context image per original instead of per-box composites
+    --context-height INT     Height of layered context images (default: 600)
+    --derivatives            Also write responsive renditions and record them in the queue items
+    --derivative-sizes LIST  Long-edge sizes of the renditions (default: 320,640,1280)
+    --encoding PROFILE       Output encoding: legacy, jpeg, jpeg-hq, webp or avif (default: legacy)
+    --shards                 Also pack the output directory into tar shards with an offset index
+    --shard-dir DIR          Shard directory (default: data/shards/{name of output dir})
+    --shard-size MB          Maximum shard size in MB (default: 256)
+    --plan-sample INT        Select INT boxes from detection metadata only and write a work plan (no rendering)
+    --plan-file FILE         Work plan path (default: data/classification_plan.json)
+    --from-plan FILE         Render only the boxes listed in a work plan
+    --allocation NAME        Plan sampler allocation: proportional or neyman (default: proportional)
+    --seed INT               Random seed for a reproducible plan
+
+Sample-first workflow: run with --plan-sample to choose the sample from the
+bounding box JSON (confidence, size, position, box count) without decoding any
+pixels, then run with --from-plan so cropping and compositing cost scales with
+the sample rather than the corpus.
+
+Encoding profiles (see composite_engine.ENCODING_PROFILES) set the format,
+quality, progressive scans, chroma subsampling and metadata stripping of every
+crop, composite, context image and rendition. To see the bytes each profile
+would save on a finished run:
+    python scripts/composite_engine.py --encoding-report data/cropped_images_for_classification
+
+With --shards, the output directory is also packed into a few fixed-size tar
+shards with an offset index (see shard_archive.py), so it can be moved as a
+handful of large files and single crops read back without extracting.
 """
 
 import os
@@ -35,16 +64,27 @@ import json
 import argparse
 import random
 from collections import Counter, defaultdict
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import numpy as np
 from datetime import datetime
 import shutil
 import tqdm  # Import tqdm for progress bars
 
+import composite_engine
+import shard_archive
+from composite_engine import (RESAMPLING_POLICIES, DEFAULT_POLICY, CONTEXT_HEIGHT, JPEG_QUALITY,
+                              DERIVATIVE_SIZES, DEFAULT_ENCODING, draw_dashed_box, load_font, render_context,
+                              context_filename, scale_box, parse_sizes, write_derivatives, available_encodings,
+                              encoded_path, save_image)
+
 # Base directories
 BASE_DIR = "data"
 TRUE_POSITIVE_DIR = os.path.join(BASE_DIR, "true_positive_images")
 OUTPUT_DIR = os.path.join(BASE_DIR, "cropped_images_for_classification")
+PLAN_FILE = os.path.join(BASE_DIR, "classification_plan.json")
+
+# Boxes below this confidence are never queued
+MIN_QUEUE_CONFIDENCE = 0.25
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -90,6 +130,34 @@ def parse_arguments():
                         help="Public directory for web-accessible images (default: public/images)")
     parser.add_argument("--side-by-side", action="store_true",
                         help="Create side-by-side versions of cropped and original images")
+    parser.add_argument("--resample", type=str, default=DEFAULT_POLICY, choices=list(RESAMPLING_POLICIES),
+                        help=f"Composite resampling policy (default: {DEFAULT_POLICY})")
+    parser.add_argument("--layered", action="store_true",
+                        help="Write one shared context image per original instead of per-box composites")
+    parser.add_argument("--context-height", type=int, default=CONTEXT_HEIGHT,
+                        help=f"Height of layered context images (default: {CONTEXT_HEIGHT})")
+    parser.add_argument("--derivatives", action="store_true",
+                        help="Also write responsive renditions and record them in the queue items")
+    parser.add_argument("--derivative-sizes", type=parse_sizes, default=DERIVATIVE_SIZES,
+                        help="Long-edge sizes of the renditions (default: 320,640,1280)")
+    parser.add_argument("--encoding", type=str, default=DEFAULT_ENCODING, choices=available_encodings(),
+                        help=f"Output encoding profile (default: {DEFAULT_ENCODING})")
+    parser.add_argument("--shards", action="store_true",
+                        help="Also pack the output directory into tar shards with an offset index")
+    parser.add_argument("--shard-dir", type=str,
+                        help="Shard directory (default: data/shards/{name of output dir})")
+    parser.add_argument("--shard-size", type=int, default=shard_archive.DEFAULT_SHARD_SIZE_MB,
+                        help=f"Maximum shard size in MB (default: {shard_archive.DEFAULT_SHARD_SIZE_MB})")
+    parser.add_argument("--plan-sample", type=int,
+                        help="Select N boxes from detection metadata only and write a work plan")
+    parser.add_argument("--plan-file", type=str, default=PLAN_FILE,
+                        help=f"Work plan path (default: {PLAN_FILE})")
+    parser.add_argument("--from-plan", type=str,
+                        help="Render only the boxes listed in a work plan")
+    parser.add_argument("--allocation", type=str, default="proportional", choices=["proportional", "neyman"],
+                        help="Plan sampler allocation (default: proportional)")
+    parser.add_argument("--seed", type=int,
+                        help="Random seed for a reproducible plan")
     
     return parser.parse_args()
 
@@ -295,7 +363,7 @@ def clean_output_directory(output_dir):
             try:
                 for root, dirs, files in os.walk(output_dir):
                     for file in files:
-                        if file.endswith('.jpg') or file.endswith('.png'):
+                        if file.endswith(('.jpg', '.png', '.webp', '.avif')):
                             os.remove(os.path.join(root, file))
                             if args.debug:
                                 print(f"Removed file: {os.path.join(root, file)}")
@@ -306,6 +374,136 @@ def clean_output_directory(output_dir):
     os.makedirs(output_dir, exist_ok=True)
     print(f"Created fresh output directory: {output_dir}")
 
+def describe_box(box, img_width, img_height):
+    """
+    Size, position and distance hint of a box, from its coordinates alone.
+    
+    Returns:
+        (relative_size, position_factor, distance_hint)
+    """
+    # Calculate relative box size
+    box_width = box[2] - box[0]
+    box_height = box[3] - box[1]
+    box_area = box_width * box_height
+    relative_size = box_area / (img_width * img_height)
+    
+    # Calculate position factor (0-1, higher means likely more distant)
+    # Flags at the top of the image are often far away
+    y_center = (box[1] + box[3]) / 2
+    position_factor = 1 - (y_center / img_height)  # 0 at bottom, 1 at top
+    
+    # Determine distance hint
+    if relative_size < 0.01:
+        if position_factor > 0.7:
+            distance_hint = "Likely distant flag (high in image)"
+        else:
+            distance_hint = "Small detection - possibly distant flag"
+    else:
+        distance_hint = "Normal sized detection"
+    
+    return relative_size, position_factor, distance_hint
+
+def list_towns(args):
+    """Towns to process: the --town argument, or every town directory."""
+    if args.town:
+        if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, args.town)):
+            return [args.town]
+        print(f"Error: Town '{args.town}' not found in {TRUE_POSITIVE_DIR}")
+        return []
+    return [d for d in os.listdir(TRUE_POSITIVE_DIR) 
+            if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
+
+def plan_sample(args):
+    """
+    Choose the sample from detection metadata and write a work plan.
+    
+    Only image headers are read (for the image size); no pixels are decoded.
+    The sample is drawn with the joint stratified sampler used for publishing.
+    
+    Returns:
+        List of planned boxes
+    """
+    from sample_cropped_for_public import select_joint_stratified_sample, print_stratum_report
+    
+    candidates = []
+    for town in tqdm.tqdm(list_towns(args), desc="Planning towns", unit="town"):
+        town_dir = os.path.join(TRUE_POSITIVE_DIR, town)
+        bbox_file = os.path.join(town_dir, f"true_positive_bboxes_hf_{town}.json")
+        
+        try:
+            with open(bbox_file, 'r') as f:
+                bbox_data = json.load(f)
+        except Exception as e:
+            print(f"Error scanning {town}: {e}")
+            continue
+        
+        for image_name, detections in bbox_data.items():
+            image_path = os.path.join(town_dir, image_name)
+            try:
+                with Image.open(image_path) as image:
+                    img_width, img_height = image.size
+            except Exception as e:
+                print(f"Error reading {image_path}: {e}")
+                continue
+            
+            for i, detection in enumerate(detections):
+                confidence = detection['confidence']
+                if confidence < MIN_QUEUE_CONFIDENCE:
+                    continue
+                
+                relative_size, position_factor, distance_hint = describe_box(
+                    detection['box'], img_width, img_height)
+                candidates.append({
+                    'town': town,
+                    'image_name': image_name,
+                    'original_image': image_path,
+                    'box_index': i,
+                    'box': detection['box'],
+                    'confidence': confidence,
+                    'relative_size': float(relative_size),
+                    'position_factor': float(position_factor),
+                    'distance_hint': distance_hint if len(detections) > 1 else 'Single detection',
+                    'box_count': len(detections)
+                })
+    
+    print(f"Found {len(candidates)} candidate boxes")
+    if not candidates:
+        print("No candidate boxes to plan from; no work plan written")
+        return []
+    
+    selected, report = select_joint_stratified_sample(candidates, args.plan_sample, args.allocation, args.seed)
+    print_stratum_report(report, args.debug)
+    
+    plan_dir = os.path.dirname(args.plan_file)
+    if plan_dir:
+        os.makedirs(plan_dir, exist_ok=True)
+    with open(args.plan_file, 'w') as f:
+        json.dump({
+            "metadata": {
+                "created": datetime.now().isoformat(),
+                "sample_size": args.plan_sample,
+                "allocation": args.allocation,
+                "seed": args.seed,
+                "candidates": len(candidates),
+                "planned": len(selected)
+            },
+            "items": selected
+        }, f, indent=2)
+    
+    print(f"\nWork plan with {len(selected)} boxes from "
+          f"{len(set((item['town'], item['image_name']) for item in selected))} images saved to: {args.plan_file}")
+    return selected
+
+def load_plan(plan_file):
+    """Load a work plan as {town: {image_name: set of box indices}}."""
+    with open(plan_file, 'r') as f:
+        plan_data = json.load(f)
+    
+    plan = defaultdict(lambda: defaultdict(set))
+    for item in plan_data.get("items", []):
+        plan[item['town']][item['image_name']].add(item['box_index'])
+    return plan
+
 def prepare_images_for_classification(args):
     """
     Process multi-box images to create single-box images for classification.
@@ -321,18 +519,19 @@ def prepare_images_for_classification(args):
         clean_output_directory(args.output_dir)
     
     # Get towns to process
+    towns = list_towns(args)
+    if not towns:
+        return []
     if args.town:
-        # Process only the specified town if it exists
-        if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, args.town)):
-            towns = [args.town]
-            print(f"Processing single town: {args.town}")
-        else:
-            print(f"Error: Town '{args.town}' not found in {TRUE_POSITIVE_DIR}")
-            return []
-    else:
-        # Process all towns if no specific town is specified
-        towns = [d for d in os.listdir(TRUE_POSITIVE_DIR) 
-                if os.path.isdir(os.path.join(TRUE_POSITIVE_DIR, d))]
+        print(f"Processing single town: {args.town}")
+    
+    # A work plan restricts rendering to the planned boxes
+    plan = None
+    if args.from_plan:
+        plan = load_plan(args.from_plan)
+        towns = [town for town in towns if town in plan]
+        print(f"Rendering work plan {args.from_plan}: "
+              f"{sum(len(boxes) for images in plan.values() for boxes in images.values())} boxes in {len(towns)} towns")
     
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
@@ -388,6 +587,9 @@ def prepare_images_for_classification(args):
                     print(f"Adding specific test image to the selection: {specific_test_image}")
                     image_names.insert(0, specific_test_image)
             
+            if plan is not None:
+                image_names = [name for name in plan[town] if name in bbox_data]
+            
             # Progress bar for images in this town
             town_progress = tqdm.tqdm(
                 image_names,
@@ -414,44 +616,23 @@ def prepare_images_for_classification(args):
                 try:
                     image = Image.open(image_path)
                     img_width, img_height = image.size
-                    total_image_area = img_width * img_height
                     
                     # Create town subdirectory in the output dir
                     town_output_dir = os.path.join(args.output_dir, town)
                     os.makedirs(town_output_dir, exist_ok=True)
                     
                     boxes_added = 0
+                    context = None  # (web path, size) of this original's context image
                     
                     for i, detection in enumerate(detections):
                         box = detection['box']
                         confidence = detection['confidence']
                         
-                        # Calculate relative box size
-                        box_width = box[2] - box[0]
-                        box_height = box[3] - box[1]
-                        box_area = box_width * box_height
-                        relative_size = box_area / total_image_area
-                        
-                        # Calculate position factor (0-1, higher means likely more distant)
-                        # Flags at the top of the image are often far away
-                        y_center = (box[1] + box[3]) / 2
-                        position_factor = 1 - (y_center / img_height)  # 0 at bottom, 1 at top
-                        
-                        # Calculate a combined score that favors:
-                        # - Higher confidence
-                        # - Larger relative size
-                        # - Adjusts for position (distance)
-                        position_adjustment = 1 + (position_factor * 0.5)  # 1.0-1.5x multiplier for height
-                        adjusted_size = relative_size * position_adjustment
+                        # Only boxes in the work plan are rendered
+                        if plan is not None and i not in plan[town][image_name]:
+                            continue
                         
-                        # Determine distance hint
-                        if relative_size < 0.01:
-                            if position_factor > 0.7:
-                                distance_hint = "Likely distant flag (high in image)"
-                            else:
-                                distance_hint = "Small detection - possibly distant flag"
-                        else:
-                            distance_hint = "Normal sized detection"
+                        relative_size, position_factor, distance_hint = describe_box(box, img_width, img_height)
                         
                         # More lenient filtering for boxes high in the image (distant flags)
                         min_size_threshold = args.min_size
@@ -460,7 +641,7 @@ def prepare_images_for_classification(args):
                         
                         # Less restrictive filtering to ensure we get enough samples
                         # Skip only very low confidence boxes
-                        if confidence < 0.25:  # Lower threshold from 0.3 to 0.25
+                        if confidence < MIN_QUEUE_CONFIDENCE:  # Lower threshold from 0.3 to 0.25
                             if args.debug:
                                 print(f"Skipping low confidence box {i} in {image_path}: confidence={confidence:.2f}")
                             continue
@@ -494,28 +675,8 @@ def prepare_images_for_classification(args):
                             line_width = args.line_width
                             
                             if args.dashed:
-                                # Create dashed line
-                                dash_length = 6  # Length of each dash
-                                dash_gap = 3     # Gap between dashes
-                                
                                 # Draw dashed rectangle with specified line width
-                                x0, y0, x1, y1 = relative_box
-                                
-                                # Draw horizontal dashed lines (top and bottom)
-                                for x in range(int(x0), int(x1), dash_length + dash_gap):
-                                    # Top line
-                                    end_x = min(x + dash_length, x1)
-                                    draw.line([(x, y0), (end_x, y0)], fill="red", width=line_width)
-                                    # Bottom line
-                                    draw.line([(x, y1), (end_x, y1)], fill="red", width=line_width)
-                                
-                                # Draw vertical dashed lines (left and right)
-                                for y in range(int(y0), int(y1), dash_length + dash_gap):
-                                    # Left line
-                                    end_y = min(y + dash_length, y1)
-                                    draw.line([(x0, y), (x0, end_y)], fill="red", width=line_width)
-                                    # Right line
-                                    draw.line([(x1, y), (x1, end_y)], fill="red", width=line_width)
+                                draw_dashed_box(cropped_img, relative_box, width=line_width)
                             else:
                                 # Draw solid rectangle
                                 draw.rectangle(relative_box, outline="red", width=line_width)
@@ -526,12 +687,7 @@ def prepare_images_for_classification(args):
                             box_height = relative_box[3] - relative_box[1]
                             font_size = max(10, int(min(box_width, box_height) / 15))
                             
-                            try:
-                                from PIL import ImageFont
-                                font = ImageFont.truetype("arial.ttf", font_size)
-                            except Exception:
-                                # Fallback for systems without arial
-                                font = None
+                            font = load_font(font_size)
                             
                             # Format confidence as percentage
                             conf_text = f"{confidence:.0%}"
@@ -562,23 +718,43 @@ def prepare_images_for_classification(args):
                             draw.text((text_x, text_y), conf_text, fill="red", font=font)
                         
                         # Save cropped image
-                        crop_filename = f"{image_name.split('.')[0]}_box{i}.jpg"
+                        crop_filename = encoded_path(f"{image_name.split('.')[0]}_box{i}.jpg", args.encoding)
                         crop_path = os.path.join(town_output_dir, crop_filename)
-                        cropped_img.save(crop_path)
+                        save_image(cropped_img, crop_path, args.encoding)
                         
                         # Copy to public directory
                         cropped_web_path = copy_to_public_dir(crop_path, town, args)
                         original_web_path = copy_to_public_dir(image_path, town, args)
                         
-                        # Create side-by-side view if requested
+                        # Layered output: one shared context image per original, written once
+                        if args.layered and context is None:
+                            context_image = render_context(image, args.context_height, args.resample)
+                            context_path = os.path.join(town_output_dir, context_filename(image_name, args.context_height))
+                            context_path = save_image(context_image, context_path, args.encoding, JPEG_QUALITY)
+                            context_web_path = copy_to_public_dir(context_path, town, args)
+                            context = (context_web_path, list(context_image.size),
+                                       publish_renditions(context_path, context_web_path, town, args))
+                        
+                        # Create side-by-side view if requested (layered output replaces it)
                         composite_web_path = None
-                        if args.side_by_side:
+                        if args.side_by_side and not args.layered:
                             composite_filename = f"composite_{image_name.split('.')[0]}_box{i}.jpg"
-                            composite_path = os.path.join(town_output_dir, composite_filename)
+                            composite_path = encoded_path(os.path.join(town_output_dir, composite_filename), args.encoding)
                             
-                            if create_side_by_side_image(crop_path, image_path, box, composite_path):
+                            if create_side_by_side_image(crop_path, image_path, box, composite_path, args.resample,
+                                                         args.encoding):
                                 composite_web_path = copy_to_public_dir(composite_path, town, args)
                         
+                        # Responsive renditions of every image written for this box
+                        renditions = {}
+                        if args.derivatives:
+                            renditions['cropped_image'] = publish_renditions(crop_path, cropped_web_path, town, args)
+                            if composite_web_path:
+                                renditions['composite_image'] = publish_renditions(
+                                    composite_path, composite_web_path, town, args)
+                            if context:
+                                renditions['context_image'] = context[2]
+                        
                         # Add to classification queue
                         item = {
                             'town': town,
@@ -600,6 +776,15 @@ def prepare_images_for_classification(args):
                             item['composite_image'] = composite_web_path
                             item['has_composite'] = True
                         
+                        # Shared context image and the box in its pixel space
+                        if context:
+                            item['context_image'], item['context_size'] = context[:2]
+                            item['context_box'] = scale_box(box, (img_width, img_height), context[1])
+                        
+                        # srcset-ready renditions ({"src", "width", "height"}) per image field
+                        if renditions:
+                            item['renditions'] = renditions
+                        
                         classification_queue.append(item)
                         
                         boxes_added += 1
@@ -659,28 +844,8 @@ def draw_boxes_on_image(image_path, detections, args):
             
             # Draw rectangle (dashed or solid)
             if args.dashed:
-                # Create dashed line
-                dash_length = 6  # Length of each dash
-                dash_gap = 3     # Gap between dashes
-                
                 # Draw dashed rectangle
-                x0, y0, x1, y1 = box
-                
-                # Draw horizontal dashed lines (top and bottom)
-                for x in range(int(x0), int(x1), dash_length + dash_gap):
-                    # Top line
-                    end_x = min(x + dash_length, x1)
-                    draw.line([(x, y0), (end_x, y0)], fill="red", width=args.line_width)
-                    # Bottom line
-                    draw.line([(x, y1), (end_x, y1)], fill="red", width=args.line_width)
-                
-                # Draw vertical dashed lines (left and right)
-                for y in range(int(y0), int(y1), dash_length + dash_gap):
-                    # Left line
-                    end_y = min(y + dash_length, y1)
-                    draw.line([(x0, y), (x0, end_y)], fill="red", width=args.line_width)
-                    # Right line
-                    draw.line([(x1, y), (x1, end_y)], fill="red", width=args.line_width)
+                draw_dashed_box(modified_img, box, width=args.line_width)
             else:
                 # Draw solid rectangle
                 draw.rectangle(box, outline="red", width=args.line_width)
@@ -692,11 +857,7 @@ def draw_boxes_on_image(image_path, detections, args):
                 box_height = box[3] - box[1]
                 font_size = max(10, int(min(box_width, box_height) / 15))
                 
-                try:
-                    font = ImageFont.truetype("arial.ttf", font_size)
-                except Exception:
-                    # Fallback for systems without arial
-                    font = None
+                font = load_font(font_size)
                 
                 # Format confidence as percentage
                 conf_text = f"{confidence:.0%}"
@@ -770,104 +931,32 @@ def copy_to_public_dir(source_path, town, args):
         print(f"Error copying to public dir: {e}")
         return source_path
 
-def create_side_by_side_image(cropped_path, original_path, box, output_path):
+def publish_renditions(path, web_path, town, args):
+    """
+    Write bounded-size renditions of an output image and copy them like the image.
+    
+    Returns:
+        srcset-ready entries [{"src", "width", "height"}, ...], smallest first
+    """
+    return [
+        {
+            "src": web_path if rendition["path"] == path else copy_to_public_dir(rendition["path"], town, args),
+            "width": rendition["width"],
+            "height": rendition["height"]
+        }
+        for rendition in write_derivatives(path, args.derivative_sizes, args.resample, encoding=args.encoding)
+    ]
+
+def create_side_by_side_image(cropped_path, original_path, box, output_path, policy=DEFAULT_POLICY,
+                              encoding=DEFAULT_ENCODING):
     """
     Create a side-by-side composite image showing both cropped and original views.
+    
+    The composite is at least as tall as the crop, with up to 600 px of
+    context; the original is only downscaled, never enlarged.
     """
-    try:
-        # Open both images
-        cropped_img = Image.open(cropped_path)
-        original_img = Image.open(original_path)
-        
-        # Get dimensions
-        crop_width, crop_height = cropped_img.size
-        orig_width, orig_height = original_img.size
-        
-        # Calculate new dimensions
-        # Determine the best height for the side-by-side display
-        # Use the larger of the two heights to prevent downscaling the original
-        target_height = max(crop_height, min(600, orig_height))
-        
-        # Scale cropped image if needed
-        if crop_height != target_height:
-            new_crop_width = int(crop_width * (target_height / crop_height))
-            cropped_img = cropped_img.resize((new_crop_width, target_height), Image.LANCZOS)
-            crop_width, crop_height = cropped_img.size
-            
-        # Scale original image proportionally, maintaining aspect ratio
-        new_orig_height = target_height
-        new_orig_width = int(orig_width * (new_orig_height / orig_height))
-        
-        # Only resize if absolutely necessary (if original is very large)
-        if orig_height > target_height:
-            resized_orig = original_img.resize((new_orig_width, new_orig_height), Image.LANCZOS)
-        else:
-            # Use original image without resizing
-            resized_orig = original_img
-            new_orig_width, new_orig_height = orig_width, orig_height
-        
-        # Create a new image wide enough for both
-        total_width = crop_width + new_orig_width + 20  # 20px padding
-        composite = Image.new('RGB', (total_width, crop_height + 30), (255, 255, 255))
-        
-        # Paste the cropped image on the left
-        composite.paste(cropped_img, (0, 0))
-        
-        # Paste the original image on the right with some spacing
-        composite.paste(resized_orig, (crop_width + 20, 0))
-        
-        # Draw a line to separate the images
-        draw = ImageDraw.Draw(composite)
-        draw.line([(crop_width + 10, 0), (crop_width + 10, crop_height)], fill=(200, 200, 200), width=1)
-        
-        # Add labels
-        try:
-            font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = ImageFont.load_default()
-        
-        draw.text((10, crop_height + 5), "Cropped View", fill=(0, 0, 0), font=font)
-        draw.text((crop_width + 30, crop_height + 5), "Original Context", fill=(0, 0, 0), font=font)
-        
-        # Mark the bounding box in the original context view
-        if box:
-            # Scale the box coordinates to fit the resized original
-            scale_x = new_orig_width / orig_width
-            scale_y = new_orig_height / orig_height
-            
-            scaled_box = [
-                int(box[0] * scale_x),
-                int(box[1] * scale_y),
-                int(box[2] * scale_x),
-                int(box[3] * scale_y)
-            ]
-            
-            # Draw dashed rectangle
-            x0, y0, x1, y1 = scaled_box
-            dash_length = 6
-            dash_gap = 3
-            
-            # Adjust coordinates to the position in the composite image
-            x0 += crop_width + 20
-            x1 += crop_width + 20
-            
-            # Draw dashed lines
-            for x in range(int(x0), int(x1), dash_length + dash_gap):
-                end_x = min(x + dash_length, x1)
-                draw.line([(x, y0), (end_x, y0)], fill="red", width=2)
-                draw.line([(x, y1), (end_x, y1)], fill="red", width=2)
-            
-            for y in range(int(y0), int(y1), dash_length + dash_gap):
-                end_y = min(y + dash_length, y1)
-                draw.line([(x0, y), (x0, end_y)], fill="red", width=2)
-                draw.line([(x1, y), (x1, end_y)], fill="red", width=2)
-        
-        # Save the composite image
-        composite.save(output_path, quality=85)
-        return True
-    except Exception as e:
-        print(f"Error creating side-by-side image: {e}")
-        return False
+    return composite_engine.create_side_by_side_image(cropped_path, original_path, box, output_path,
+                                                      "context-600", policy, encoding=encoding)
 
 def main():
     """Main function to run the script."""
@@ -890,18 +979,37 @@ def main():
     if args.auto_threshold:
         print("Auto threshold: Enabled")
         
-    if args.side_by_side:
+    if args.layered:
+        print(f"Layered mode: Enabled (context height {args.context_height})")
+    elif args.side_by_side:
         print("Side-by-side mode: Enabled")
         
     if args.auto_clean:
         print("Auto clean: Enabled (will clean without confirmation)")
     
+    if args.encoding != DEFAULT_ENCODING:
+        print(f"Encoding: {args.encoding}")
+    
+    if args.plan_sample:
+        print(f"Planning a sample of {args.plan_sample} boxes ({args.allocation} allocation)")
+        start_time = datetime.now()
+        planned = plan_sample(args)
+        print(f"\nPlanning completed in {(datetime.now() - start_time).total_seconds():.1f} seconds")
+        if planned:
+            print(f"Render it with: --from-plan {args.plan_file}")
+        return
+    
     start_time = datetime.now()
     classification_queue = prepare_images_for_classification(args)
     end_time = datetime.now()
     
     print(f"\nProcessing completed in {(end_time - start_time).total_seconds():.1f} seconds")
     print(f"Generated {len(classification_queue)} images for classification")
+    
+    if args.shards:
+        shard_dir = args.shard_dir or shard_archive.default_shard_dir(args.output_dir)
+        count, shard_paths = shard_archive.pack_directory(args.output_dir, shard_dir, args.shard_size)
+        print(f"Packed {count} files into {len(shard_paths)} shards: {shard_dir}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
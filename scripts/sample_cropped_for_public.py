@@ -4,10 +4,25 @@ Sample and Copy Cropped Images for Expert Flag Labeller App
 
 This script:
 1. Loads the classification_queue.json file with all cropped images
-2. Selects a stratified sample across towns (approx. 3,000 images)
+2. Selects a stratified sample (approx. 3,000 images), jointly across towns,
+   confidence bands, distance hints and boxes-per-image classes
 3. Copies the selected images to public/images/{TOWN}/{image} structure
 4. Maintains stratification across towns, confidence scores, and image types
 
+With --sync, the published directory is diffed against the new selection using
+a manifest (.publish_manifest.json): only added or changed images are written
+and only removed ones are deleted, so runs are incremental and unattended.
+
+With --layered, each original's context is published once and every crop's box
+position in it is written to layers.json, for the app to draw the highlight.
+With --derivatives, every published image also gets bounded-size renditions,
+listed with their dimensions in derivatives.json for srcset.
+With --encoding, every published file is written under that encoding profile
+(format, quality, progressive, subsampling, metadata stripping) instead of
+being copied as is.
+With --shards, the output directory is also packed into fixed-size tar shards
+with an offset index (see shard_archive.py) once publishing is done.
+
 Usage:
     python scripts/sample_cropped_for_public.py [options]
 
@@ -17,6 +32,23 @@ Options:
     --queue-file PATH        Input classification queue (default: data/classification_queue.json)
     --preserve-ratio         Preserve the ratio of single/multi-box images
     --balance-towns          Balance sampling across towns (prevent domination by large towns)
+    --sampler NAME           Sampler: joint (town x confidence x distance x box count) or legacy (default: joint)
+    --allocation NAME        Joint sampler allocation: proportional or neyman (default: proportional)
+    --seed INT               Random seed for a reproducible sample
+    --stratum-report FILE    Write realized vs target stratum sizes to a JSON file
+    --workers INT            Worker processes for composites and copies (default: 1)
+    --resample POLICY        Composite resampling policy: quality, balanced or speed (default: quality)
+    --layered                Publish crops plus one shared context image per original instead of composites
+    --context-height INT     Height of layered context images (default: 600)
+    --derivatives            Also publish responsive renditions and write derivatives.json (srcset entries)
+    --derivative-sizes LIST  Long-edge sizes of the renditions (default: 320,640,1280)
+    --encoding PROFILE       Output encoding: legacy, jpeg, jpeg-hq, webp or avif (default: legacy)
+    --shards                 Also pack the output directory into tar shards with an offset index
+    --shard-dir DIR          Shard directory (default: data/shards/{name of output dir})
+    --shard-size MB          Maximum shard size in MB (default: 256)
+    --sync                   Publish only the difference from what is already in the output directory
+    --top-up INT             Keep the published sample and add INT more images (implies --sync)
+    --yes                    Do not prompt before replacing the output directory (non-sync mode)
     --debug                  Print detailed debug information
 """
 
@@ -25,9 +57,38 @@ import json
 import argparse
 import random
 import shutil
-from collections import defaultdict
+from collections import defaultdict, Counter
 import math
-from PIL import Image, ImageDraw, ImageFont
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+
+import composite_engine
+import shard_archive
+from composite_engine import (RESAMPLING_POLICIES, DEFAULT_POLICY, CONTEXT_HEIGHT, JPEG_QUALITY,
+                              DERIVATIVE_SIZES, DEFAULT_ENCODING, render_context, context_filename, scale_box,
+                              parse_sizes, write_derivatives, available_encodings, encoded_path, save_image)
+
+# Confidence band edges used by the joint sampler
+CONFIDENCE_BANDS = [0.5, 0.7, 0.85]
+
+# Boxes-per-image classes (upper bound inclusive, label) used by the joint sampler
+BOX_COUNT_CLASSES = [(1, "1 box"), (3, "2-3 boxes"), (None, "4+ boxes")]
+
+# Record of what has been published to the output directory (used by --sync)
+PUBLISH_MANIFEST = ".publish_manifest.json"
+
+# Context image and box position per published crop (--layered), read by generate-image-list.js
+LAYER_MANIFEST = "layers.json"
+
+# Renditions (src, width, height) per published image (--derivatives), read by generate-image-list.js
+RENDITION_MANIFEST = "derivatives.json"
+
+# Stratum dimensions, in key order
+STRATUM_DIMENSIONS = ["town", "confidence_band", "distance_hint", "box_count_class"]
+
+# Lower bound on a stratum's confidence spread for Neyman allocation, so that
+# single-item and uniform strata are not starved
+MIN_STRATUM_SPREAD = 0.01
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -43,6 +104,40 @@ def parse_arguments():
                         help="Preserve the ratio of single/multi-box images")
     parser.add_argument("--balance-towns", action="store_true", default=True,
                         help="Balance sampling across towns")
+    parser.add_argument("--sampler", type=str, default="joint", choices=["joint", "legacy"],
+                        help="Sampler: joint (town x confidence x distance x box count) or legacy (default: joint)")
+    parser.add_argument("--allocation", type=str, default="proportional", choices=["proportional", "neyman"],
+                        help="Joint sampler allocation (default: proportional)")
+    parser.add_argument("--seed", type=int,
+                        help="Random seed for a reproducible sample")
+    parser.add_argument("--stratum-report", type=str,
+                        help="Write realized vs target stratum sizes to a JSON file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes for composites and copies (default: 1)")
+    parser.add_argument("--resample", type=str, default=DEFAULT_POLICY, choices=list(RESAMPLING_POLICIES),
+                        help=f"Composite resampling policy (default: {DEFAULT_POLICY})")
+    parser.add_argument("--layered", action="store_true",
+                        help="Publish crops plus one shared context image per original instead of composites")
+    parser.add_argument("--context-height", type=int, default=CONTEXT_HEIGHT,
+                        help=f"Height of layered context images (default: {CONTEXT_HEIGHT})")
+    parser.add_argument("--derivatives", action="store_true",
+                        help="Also publish responsive renditions and write derivatives.json (srcset entries)")
+    parser.add_argument("--derivative-sizes", type=parse_sizes, default=DERIVATIVE_SIZES,
+                        help="Long-edge sizes of the renditions (default: 320,640,1280)")
+    parser.add_argument("--encoding", type=str, default=DEFAULT_ENCODING, choices=available_encodings(),
+                        help=f"Output encoding profile (default: {DEFAULT_ENCODING})")
+    parser.add_argument("--shards", action="store_true",
+                        help="Also pack the output directory into tar shards with an offset index")
+    parser.add_argument("--shard-dir", type=str,
+                        help="Shard directory (default: data/shards/{name of output dir})")
+    parser.add_argument("--shard-size", type=int, default=shard_archive.DEFAULT_SHARD_SIZE_MB,
+                        help=f"Maximum shard size in MB (default: {shard_archive.DEFAULT_SHARD_SIZE_MB})")
+    parser.add_argument("--sync", action="store_true",
+                        help="Publish only the difference from what is already in the output directory")
+    parser.add_argument("--top-up", type=int,
+                        help="Keep the published sample and add this many more images (implies --sync)")
+    parser.add_argument("--yes", action="store_true",
+                        help="Do not prompt before replacing the output directory (non-sync mode)")
     parser.add_argument("--debug", action="store_true",
                         help="Print detailed debug information")
     
@@ -130,7 +225,8 @@ def select_stratified_sample(queue_data, args):
                 # If we haven't reached our target, sample more from towns with remaining images
                 remaining = single_sample_size - len(selected_images)
                 if remaining > 0:
-                    remaining_images = [img for img in single_box_images if img not in selected_images]
+                    selected_ids = set(id(img) for img in selected_images)
+                    remaining_images = [img for img in single_box_images if id(img) not in selected_ids]
                     if remaining_images:
                         remaining_sample = random.sample(
                             remaining_images, 
@@ -194,7 +290,8 @@ def select_stratified_sample(queue_data, args):
             # If we haven't reached our target, sample more from towns with remaining images
             remaining = total_sample_size - len(selected_images)
             if remaining > 0:
-                remaining_images = [img for img in images if img not in selected_images]
+                selected_ids = set(id(img) for img in selected_images)
+                remaining_images = [img for img in images if id(img) not in selected_ids]
                 if remaining_images:
                     selected_images.extend(
                         random.sample(
@@ -216,7 +313,8 @@ def select_stratified_sample(queue_data, args):
         selected_images = selected_images[:total_sample_size]
     elif len(selected_images) < total_sample_size:
         remaining = total_sample_size - len(selected_images)
-        remaining_images = [img for img in images if img not in selected_images]
+        selected_ids = set(id(img) for img in selected_images)
+        remaining_images = [img for img in images if id(img) not in selected_ids]
         if remaining_images and remaining > 0:
             selected_images.extend(
                 random.sample(
@@ -250,100 +348,661 @@ def select_stratified_sample(queue_data, args):
     
     return selected_images
 
-def copy_selected_images(selected_images, args):
-    """Copy the selected images to the output directory."""
-    # Clean the output directory
-    if os.path.exists(args.output_dir):
-        print(f"Cleaning output directory: {args.output_dir}")
-        user_input = input(f"This will delete all existing files in {args.output_dir}. Continue? (y/n): ")
-        if user_input.lower() != 'y':
-            print("Operation canceled. Existing files will be kept.")
-            return False
+def confidence_band(confidence):
+    """Label of the confidence band a detection falls into."""
+    lower = 0.0
+    for edge in CONFIDENCE_BANDS:
+        if confidence < edge:
+            return f"{lower:.2f}-{edge:.2f}"
+        lower = edge
+    return f"{lower:.2f}-1.00"
+
+def box_count_class(box_count):
+    """Label of the boxes-per-image class."""
+    for upper, label in BOX_COUNT_CLASSES:
+        if upper is None or box_count <= upper:
+            return label
+
+def allocate_sample(sizes, spreads, sample_size, allocation="proportional"):
+    """
+    Allocate an exact sample total across strata.
+    
+    Proportional allocation weights each stratum by its size; Neyman by size
+    times the within-stratum spread. Strata whose share exceeds their size are
+    capped and the remainder is re-allocated; the final integer allocation
+    uses largest remainders, so it always sums to min(sample_size, population).
+    
+    Args:
+        sizes: Dictionary of stratum key -> population size
+        spreads: Dictionary of stratum key -> standard deviation (Neyman only)
+    
+    Returns:
+        (targets, allocation) - unconstrained fractional targets and integer allocation
+    """
+    if allocation == "neyman":
+        weights = {key: size * max(spreads.get(key, 0.0), MIN_STRATUM_SPREAD) for key, size in sizes.items()}
+    else:
+        weights = dict(sizes)
+    
+    total_weight = sum(weights.values())
+    targets = {key: sample_size * weight / total_weight for key, weight in weights.items()}
+    
+    allocated = {}
+    active = set(sizes)
+    remaining = min(sample_size, sum(sizes.values()))
+    
+    # Cap strata that would receive more than they hold, then re-allocate
+    while active:
+        active_weight = sum(weights[key] for key in active)
+        shares = {key: remaining * weights[key] / active_weight for key in active}
+        capped = [key for key in active if shares[key] >= sizes[key]]
+        if not capped:
+            break
+        for key in capped:
+            allocated[key] = sizes[key]
+            remaining -= sizes[key]
+            active.discard(key)
+    
+    if active:
+        floors = {key: int(shares[key]) for key in active}
+        allocated.update(floors)
+        leftover = remaining - sum(floors.values())
+        by_remainder = sorted(active, key=lambda key: (floors[key] - shares[key], key))
+        for key in by_remainder[:leftover]:
+            allocated[key] += 1
+    
+    return targets, allocated
+
+def select_joint_stratified_sample(images, sample_size, allocation="proportional", seed=None):
+    """
+    Select a sample stratified jointly by town, confidence band, distance hint
+    and boxes-per-image class.
+    
+    Items are bucketed by stratum in one pass and each stratum is sampled by
+    index, so selection is linear in the queue size. The same seed always
+    gives the same sample.
+    
+    Returns:
+        (selected_images, report) where report lists population, target,
+        allocated and realized sizes for every stratum
+    """
+    rng = random.Random(seed)
+    
+    # Boxes per source image, from the queue itself unless the item records it
+    boxes_per_image = Counter(img.get("original_image") for img in images)
+    
+    strata = defaultdict(list)
+    sums = defaultdict(float)
+    squares = defaultdict(float)
+    for position, img in enumerate(images):
+        confidence = img.get("confidence", 0.0)
+        box_count = img.get("box_count") or boxes_per_image[img.get("original_image")]
+        key = (
+            img.get("town", "unknown"),
+            confidence_band(confidence),
+            img.get("distance_hint", "Unknown"),
+            box_count_class(box_count)
+        )
+        strata[key].append(position)
+        sums[key] += confidence
+        squares[key] += confidence * confidence
+    
+    sizes = {key: len(positions) for key, positions in strata.items()}
+    spreads = {key: math.sqrt(max(0.0, squares[key] / sizes[key] - (sums[key] / sizes[key]) ** 2))
+               for key in strata}
+    targets, allocated = allocate_sample(sizes, spreads, sample_size, allocation)
+    
+    selected_images = []
+    report = []
+    # Strata are visited in a fixed order so a seed reproduces the sample
+    for key in sorted(strata):
+        chosen = rng.sample(strata[key], allocated.get(key, 0))
+        selected_images.extend(images[position] for position in sorted(chosen))
         
-        shutil.rmtree(args.output_dir)
+        row = dict(zip(STRATUM_DIMENSIONS, key))
+        row.update({
+            "population": sizes[key],
+            "target": round(targets[key], 3),
+            "allocated": allocated.get(key, 0),
+            "realized": len(chosen)
+        })
+        report.append(row)
     
-    # Create the output directory
-    os.makedirs(args.output_dir, exist_ok=True)
+    return selected_images, report
+
+def print_stratum_report(report, debug=False):
+    """Print realized vs target sizes, overall and per stratum dimension."""
+    if not report:
+        print("\nJoint Stratification Report: no strata (nothing to sample)")
+        return
     
-    # Create an additional flag in args to control side-by-side creation
-    create_side_by_side = True  # You could make this a command line argument
+    realized_total = sum(row["realized"] for row in report)
+    target_total = sum(row["target"] for row in report)
+    deviations = [abs(row["realized"] - row["target"]) for row in report]
     
-    # Copy each selected image
+    print("\nJoint Stratification Report:")
+    print(f"Strata: {len(report)} ({sum(1 for row in report if row['realized'])} sampled)")
+    print(f"Realized total: {realized_total} (target {target_total:.0f})")
+    print(f"Largest stratum deviation from target: {max(deviations):.2f} items")
+    
+    for dimension in STRATUM_DIMENSIONS:
+        if dimension == "town" and not debug:
+            continue
+        realized = Counter()
+        target = Counter()
+        for row in report:
+            realized[row[dimension]] += row["realized"]
+            target[row[dimension]] += row["target"]
+        print(f"\nBy {dimension.replace('_', ' ')}:")
+        for value in sorted(target, key=lambda v: target[v], reverse=True):
+            print(f"  {value}: {realized[value]} realized / {target[value]:.1f} target")
+    
+    if debug:
+        print("\nPer-stratum sizes:")
+        for row in report:
+            if row["realized"] or row["target"] >= 0.5:
+                label = " / ".join(str(row[dimension]) for dimension in STRATUM_DIMENSIONS)
+                print(f"  {label}: {row['realized']} realized / {row['target']:.2f} target "
+                      f"(population {row['population']})")
+
+def publish_target(img, output_dir, context_height=None, encoding=DEFAULT_ENCODING):
+    """
+    Work out where a selected item is read from and published to.
+    
+    With a context_height (layered output) cropped items get a shared
+    'context_path' instead of a composite. Published paths carry the
+    encoding's file extension.
+    
+    Returns:
+        Dictionary with 'source_path', 'original_path', 'box', 'town_dir',
+        'target_path', 'composite_path' (None unless a composite is expected)
+        and 'context_path' (None unless a layered context is expected)
+    """
+    # Determine source path based on whether it's a cropped or original image
+    if img.get("is_cropped", False):
+        source_path = img.get("cropped_image")
+        original_path = img.get("original_image")
+        box = img.get("box")
+    else:
+        source_path = img.get("boxed_image", img.get("original_image"))
+        original_path = None
+        box = None
+    
+    # Get town and filename
+    town = img.get("town", "unknown")
+    
+    # For cropped images, the filename is in the cropped_image path
+    if img.get("is_cropped", False):
+        filename = os.path.basename(source_path)
+    else:
+        filename = img.get("filename", os.path.basename(source_path))
+    
+    # Sanitize town name for directory structure
+    town_dir = os.path.join(output_dir, sanitize_town_name(town))
+    
+    composite_path = None
+    context_path = None
+    if img.get("is_cropped", False) and original_path:
+        if context_height:
+            # One context image per original, shared by all of its boxes
+            context_path = os.path.join(town_dir, context_filename(original_path, context_height, encoding))
+        else:
+            # Create a different filename for the composite
+            composite_path = encoded_path(os.path.join(town_dir, f"composite_{filename}"), encoding)
+    
+    return {
+        "source_path": source_path,
+        "original_path": original_path,
+        "box": box,
+        "town_dir": town_dir,
+        "target_path": encoded_path(os.path.join(town_dir, filename), encoding),
+        "composite_path": composite_path,
+        "context_path": context_path
+    }
+
+def web_path(path, output_dir):
+    """Web path of a published file (relative to the directory the output dir is served from)."""
+    return "/" + os.path.relpath(path, os.path.dirname(os.path.abspath(output_dir))).replace(os.sep, "/")
+
+def publish_file(source_path, target_path, encoding=DEFAULT_ENCODING):
+    """Copy a file to its published path, re-encoding it unless the encoding is legacy."""
+    if encoding == DEFAULT_ENCODING:
+        shutil.copy2(source_path, target_path)
+        return
+    with Image.open(source_path) as image:
+        save_image(image, target_path, encoding)
+
+def image_height(path):
+    """Height of an image, read from its header."""
+    with Image.open(path) as image:
+        return image.size[1]
+
+def load_group_original(original_path, max_height):
+    """
+    Decode an original once for all composites that use it.
+    
+    The JPEG decoder is asked for the smallest power-of-two reduction that is
+    still at least max_height tall, so later resizes start from fewer pixels.
+    
+    Returns:
+        (image, full_size) - the decoded image and the original's true size
+    """
+    image = Image.open(original_path)
+    full_size = image.size
+    if max_height and max_height < full_size[1]:
+        image.draft("RGB", (int(full_size[0] * max_height / full_size[1]) + 1, max_height))
+    image.load()
+    return image, full_size
+
+def publish_group(items, output_dir, create_side_by_side=True, debug=False, policy=DEFAULT_POLICY,
+                  context_height=None, derivative_sizes=None, encoding=DEFAULT_ENCODING):
+    """
+    Publish items that share one source original.
+    
+    The original is decoded once for the whole group and reused for every
+    composite, or rendered once as the group's shared context image when a
+    context_height (layered output) is given. With derivative_sizes, each
+    written image also gets its renditions. Every file is written under the
+    encoding profile. Safe to run in a worker process.
+    
+    Returns:
+        (success_count, error_count, messages, outputs, layers, renditions)
+        where outputs maps each published item's source path to the file
+        written for it, layers maps layered items' source paths to their
+        context placement and renditions maps written files to their renditions
+    """
     success_count = 0
     error_count = 0
+    messages = []
+    outputs = {}
+    layers = {}
+    renditions = {}
+    original = None
+    context_size = None
     
-    for img in selected_images:
-        # Determine source path based on whether it's a cropped or original image
-        if img.get("is_cropped", False):
-            source_path = img.get("cropped_image")
-            original_path = img.get("original_image")
-            box = img.get("box")
-        else:
-            source_path = img.get("boxed_image", img.get("original_image"))
-            original_path = None
-            box = None
-        
-        # Get town and filename
-        town = img.get("town", "unknown")
-        
-        # For cropped images, the filename is in the cropped_image path
-        if img.get("is_cropped", False):
-            filename = os.path.basename(source_path)
-        else:
-            filename = img.get("filename", os.path.basename(source_path))
-        
-        # Sanitize town name for directory structure
-        sanitized_town = sanitize_town_name(town)
-        
-        # Create town directory if it doesn't exist
-        town_dir = os.path.join(args.output_dir, sanitized_town)
-        os.makedirs(town_dir, exist_ok=True)
-        
-        # Set target path
-        target_path = os.path.join(town_dir, filename)
+    def derive(path):
+        if derivative_sizes and path not in renditions:
+            renditions[path] = write_derivatives(path, derivative_sizes, policy, encoding=encoding)
+    
+    # Each item's paths, worked out once for the whole group
+    targets = [publish_target(img, output_dir, context_height, encoding) for img in items]
+    
+    for img, target in zip(items, targets):
+        source_path = target["source_path"]
+        target_path = target["target_path"]
+        original_path = target["original_path"]
+        os.makedirs(target["town_dir"], exist_ok=True)
         
         try:
-            if args.debug:
-                print(f"Copying: {source_path} -> {target_path}")
+            if debug:
+                messages.append(f"Copying: {source_path} -> {target_path}")
             
             # Check if source file exists
-            if not os.path.exists(source_path):
-                print(f"Source file does not exist: {source_path}")
+            if not source_path or not os.path.exists(source_path):
+                messages.append(f"Source file does not exist: {source_path}")
                 error_count += 1
                 continue
             
+            # Layered output: the crop as is, plus the group's shared context image
+            if target["context_path"] and os.path.exists(original_path):
+                if context_size is None:
+                    original = load_group_original(original_path, context_height)
+                    context_image = render_context(original[0], context_height, policy, original[1])
+                    save_image(context_image, target["context_path"], encoding, JPEG_QUALITY)
+                    context_size = list(context_image.size)
+                    derive(target["context_path"])
+                
+                publish_file(source_path, target_path, encoding)
+                outputs[source_path] = target_path
+                layers[source_path] = {
+                    "context": target["context_path"],
+                    "context_size": context_size,
+                    "context_box": scale_box(target["box"], original[1], context_size)
+                }
+                success_count += 1
+            
             # For cropped images with available original, create side-by-side composite
-            if create_side_by_side and img.get("is_cropped", False) and original_path and os.path.exists(original_path):
-                # Create a different filename for the composite
-                composite_filename = f"composite_{filename}"
-                composite_path = os.path.join(town_dir, composite_filename)
+            elif create_side_by_side and target["composite_path"] and os.path.exists(original_path):
+                if original is None:
+                    # Decode the shared original at the largest height this group needs
+                    max_height = max(image_height(other["source_path"]) for other in targets
+                                     if os.path.exists(other["source_path"] or ""))
+                    original = load_group_original(original_path, max_height)
                 
                 # Create the side-by-side image
-                if create_side_by_side_image(source_path, original_path, box, composite_path):
-                    # Use the composite as the target instead
-                    target_path = composite_path
+                if create_side_by_side_image(source_path, original_path, target["box"],
+                                             target["composite_path"], original=original, policy=policy,
+                                             encoding=encoding):
+                    outputs[source_path] = target["composite_path"]
                     success_count += 1
                 else:
                     # Fall back to just copying the cropped image
-                    shutil.copy2(source_path, target_path)
+                    publish_file(source_path, target_path, encoding)
+                    outputs[source_path] = target_path
                     success_count += 1
             else:
                 # Copy the file normally
-                shutil.copy2(source_path, target_path)
+                publish_file(source_path, target_path, encoding)
+                outputs[source_path] = target_path
                 success_count += 1
             
+            derive(outputs[source_path])
+            
         except Exception as e:
-            print(f"Error copying {source_path}: {e}")
+            messages.append(f"Error copying {source_path}: {e}")
             error_count += 1
     
+    return success_count, error_count, messages, outputs, layers, renditions
+
+def group_by_original(selected_images):
+    """Group selected items by their source original, keeping first-seen order."""
+    groups = defaultdict(list)
+    for img in selected_images:
+        key = img.get("original_image") if img.get("is_cropped", False) else None
+        # Items without a shared original are published on their own
+        groups[key if key else ("single", id(img))].append(img)
+    return list(groups.values())
+
+def publish_groups(groups, output_dir, workers=1, create_side_by_side=True, debug=False, policy=DEFAULT_POLICY,
+                   context_height=None, derivative_sizes=None, encoding=DEFAULT_ENCODING):
+    """
+    Publish groups serially or on a process pool.
+    
+    At most two groups per worker are in flight at a time, so memory stays
+    bounded by a few decoded originals per worker.
+    
+    Returns:
+        (success_count, error_count, outputs, layers, renditions)
+    """
+    success_count = 0
+    error_count = 0
+    outputs = {}
+    layers = {}
+    renditions = {}
+    
+    def collect(result):
+        nonlocal success_count, error_count
+        success, errors, messages, written, placed, derived = result
+        success_count += success
+        error_count += errors
+        outputs.update(written)
+        layers.update(placed)
+        renditions.update(derived)
+        for message in messages:
+            print(message)
+    
+    if workers <= 1:
+        for group in groups:
+            collect(publish_group(group, output_dir, create_side_by_side, debug, policy, context_height,
+                                  derivative_sizes, encoding))
+        return success_count, error_count, outputs, layers, renditions
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for group in groups:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+            pending.add(executor.submit(publish_group, group, output_dir, create_side_by_side, debug, policy,
+                                        context_height, derivative_sizes, encoding))
+        for future in wait(pending).done:
+            collect(future.result())
+    
+    return success_count, error_count, outputs, layers, renditions
+
+def layered_context_height(args):
+    """Context image height when publishing layered output, else None."""
+    return getattr(args, "context_height", CONTEXT_HEIGHT) if getattr(args, "layered", False) else None
+
+def derivative_sizes_for(args):
+    """Rendition sizes when publishing derivatives, else None."""
+    return getattr(args, "derivative_sizes", DERIVATIVE_SIZES) if getattr(args, "derivatives", False) else None
+
+def written_bytes(paths):
+    """Total size of the files that exist among paths."""
+    return sum(os.path.getsize(path) for path in set(paths) if path and os.path.exists(path))
+
+def save_rendition_manifest(output_dir, renditions):
+    """
+    Write derivatives.json: for each published image (by file name), its
+    srcset-ready renditions [{"src", "width", "height"}, ...], smallest first.
+    """
+    manifest = {
+        os.path.basename(path): [
+            {"src": web_path(rendition["path"], output_dir),
+             "width": rendition["width"], "height": rendition["height"]}
+            for rendition in entries
+        ]
+        for path, entries in renditions.items()
+    }
+    
+    rendition_path = os.path.join(output_dir, RENDITION_MANIFEST)
+    if manifest:
+        with open(rendition_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    elif os.path.exists(rendition_path):
+        os.remove(rendition_path)
+
+def save_layer_manifest(output_dir, outputs, layers):
+    """
+    Write layers.json: for each layered crop (by published file name), its
+    shared context image's web path and size and the box in context pixels.
+    """
+    manifest = {}
+    for source_path, layer in layers.items():
+        manifest[os.path.basename(outputs[source_path])] = {
+            "context_image": web_path(layer["context"], output_dir),
+            "context_size": layer["context_size"],
+            "context_box": layer["context_box"]
+        }
+    
+    layer_path = os.path.join(output_dir, LAYER_MANIFEST)
+    if manifest:
+        with open(layer_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+    elif os.path.exists(layer_path):
+        os.remove(layer_path)
+    return len(set(layer["context"] for layer in layers.values()))
+
+def copy_selected_images(selected_images, args):
+    """Copy the selected images to the output directory."""
+    # Clean the output directory
+    if os.path.exists(args.output_dir):
+        print(f"Cleaning output directory: {args.output_dir}")
+        if not getattr(args, "yes", False):
+            user_input = input(f"This will delete all existing files in {args.output_dir}. Continue? (y/n): ")
+            if user_input.lower() != 'y':
+                print("Operation canceled. Existing files will be kept.")
+                return False
+        
+        shutil.rmtree(args.output_dir)
+    
+    # Create the output directory
+    os.makedirs(args.output_dir, exist_ok=True)
+    
+    # Create an additional flag in args to control side-by-side creation
+    create_side_by_side = True  # You could make this a command line argument
+    
+    # Items sharing an original are published together so it is decoded once
+    groups = group_by_original(selected_images)
+    workers = getattr(args, "workers", 1)
+    print(f"Publishing {len(selected_images)} images from {len(groups)} originals with {workers} worker(s)...")
+    encoding = getattr(args, "encoding", DEFAULT_ENCODING)
+    success_count, error_count, outputs, layers, renditions = publish_groups(
+        groups, args.output_dir, workers, create_side_by_side, args.debug,
+        getattr(args, "resample", DEFAULT_POLICY), layered_context_height(args), derivative_sizes_for(args),
+        encoding)
+    context_count = save_layer_manifest(args.output_dir, outputs, layers)
+    save_rendition_manifest(args.output_dir, renditions)
+    
     print(f"\nCopy Summary:")
     print(f"Successfully copied: {success_count} images")
     print(f"Failed to copy: {error_count} images")
+    if layers:
+        print(f"Layered: {len(layers)} crops sharing {context_count} context images")
+    if renditions:
+        print(f"Renditions: {sum(len(entries) - 1 for entries in renditions.values())} "
+              f"for {len(renditions)} images")
+    written = list(outputs.values()) + [layer["context"] for layer in layers.values()]
+    written += [rendition["path"] for entries in renditions.values() for rendition in entries]
+    print(f"Encoding: {encoding} ({written_bytes(written) / 1024 / 1024:.1f} MB written)")
     print(f"Output directory: {os.path.abspath(args.output_dir)}")
     
     return success_count > 0
 
-def create_side_by_side_image(cropped_path, original_path, box, output_path):
+def file_signature(path):
+    """mtime and size of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+    except (OSError, TypeError):
+        return None
+
+def publish_fingerprint(img, target):
+    """Fingerprint of everything a published file depends on."""
+    return json.dumps([
+        file_signature(target["source_path"]),
+        file_signature(target["original_path"]) if target["composite_path"] or target["context_path"] else None,
+        target["box"],
+        img.get("town"),
+        target["context_path"],
+        target.get("derivative_sizes"),
+        target.get("encoding")
+    ])
+
+def load_publish_manifest(output_dir):
+    """Load the record of published items ({} if the directory has none)."""
+    try:
+        with open(os.path.join(output_dir, PUBLISH_MANIFEST), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_publish_manifest(output_dir, manifest):
+    """Write the publish manifest atomically."""
+    manifest_path = os.path.join(output_dir, PUBLISH_MANIFEST)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def published_items(output_dir):
+    """Queue items currently published, in their published order."""
+    manifest = load_publish_manifest(output_dir)
+    return [entry["item"] for entry in manifest.get("items", {}).values()]
+
+def sync_selected_images(selected_images, args):
+    """
+    Make the output directory match the selection, touching only the difference.
+    
+    Items are keyed by their source path. New items and items whose source,
+    original, box or output file changed are published; items no longer
+    selected have their output deleted. Files not recorded in the manifest are
+    never deleted. Never prompts.
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = load_publish_manifest(args.output_dir)
+    previous = manifest.get("items", {})
+    
+    context_height = layered_context_height(args)
+    derivative_sizes = derivative_sizes_for(args)
+    encoding = getattr(args, "encoding", DEFAULT_ENCODING)
+    desired = {}
+    for img in selected_images:
+        target = publish_target(img, args.output_dir, context_height, encoding)
+        target["derivative_sizes"] = derivative_sizes
+        target["encoding"] = encoding
+        if target["source_path"]:
+            desired[target["source_path"]] = (img, publish_fingerprint(img, target))
+    
+    to_publish = {}
+    for key, (img, fingerprint) in desired.items():
+        entry = previous.get(key)
+        if not (entry and entry["fingerprint"] == fingerprint and os.path.exists(entry["output"])):
+            to_publish[key] = img
+    unchanged = len(desired) - len(to_publish)
+    added = sum(1 for key in to_publish if key not in previous)
+    removed = [key for key in previous if key not in desired]
+    
+    print(f"\nSync plan: {added} new, {len(to_publish) - added} changed, "
+          f"{unchanged} unchanged, {len(removed)} to remove")
+    
+    # Delete removed items (and directories they leave empty)
+    deleted = 0
+    for key in removed:
+        output_path = previous[key]["output"]
+        try:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+                deleted += 1
+            town_dir = os.path.dirname(output_path)
+            if os.path.isdir(town_dir) and not os.listdir(town_dir):
+                os.rmdir(town_dir)
+        except OSError as e:
+            print(f"Error removing {output_path}: {e}")
+    
+    # Publish additions and changes
+    groups = group_by_original(list(to_publish.values()))
+    workers = getattr(args, "workers", 1)
+    success_count, error_count, outputs, layers, renditions = publish_groups(
+        groups, args.output_dir, workers, True, args.debug,
+        getattr(args, "resample", DEFAULT_POLICY), context_height, derivative_sizes, encoding)
+    
+    # Record the new state. Failed new items stay out and failed changes keep
+    # their previous entry (and so their live files); either way the
+    # fingerprint differs, so the next run retries them
+    items = {}
+    for key, (img, fingerprint) in desired.items():
+        if key in outputs:
+            items[key] = {"item": img, "fingerprint": fingerprint, "output": outputs[key]}
+            if key in layers:
+                items[key]["layer"] = layers[key]
+            written = [outputs[key]] + ([layers[key]["context"]] if key in layers else [])
+            derived = {path: renditions[path] for path in written if path in renditions}
+            if derived:
+                items[key]["renditions"] = derived
+        elif key in previous:
+            items[key] = previous[key]
+    save_publish_manifest(args.output_dir, {"items": items})
+    
+    # Files of earlier publishes that nothing refers to any more: outputs whose
+    # name changed (e.g. composite -> layered crop), unshared context images
+    # and renditions
+    def entry_files(entry):
+        files = [entry["output"], entry.get("layer", {}).get("context")]
+        for entries in entry.get("renditions", {}).values():
+            files.extend(rendition["path"] for rendition in entries)
+        return [path for path in files if path]
+    
+    current_files = set(path for entry in items.values() for path in entry_files(entry))
+    for key, entry in previous.items():
+        for path in entry_files(entry):
+            if path not in current_files and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"Error removing {path}: {e}")
+    
+    save_layer_manifest(args.output_dir,
+                        {key: entry["output"] for key, entry in items.items()},
+                        {key: entry["layer"] for key, entry in items.items() if "layer" in entry})
+    save_rendition_manifest(args.output_dir,
+                            {path: entries for entry in items.values()
+                             for path, entries in entry.get("renditions", {}).items()})
+    
+    print("\nSync Summary:")
+    print(f"Published: {success_count} images")
+    print(f"Unchanged: {unchanged} images")
+    print(f"Removed: {deleted} images")
+    print(f"Failed to copy: {error_count} images")
+    print(f"Encoding: {encoding} ({written_bytes(current_files) / 1024 / 1024:.1f} MB published)")
+    print(f"Output directory: {os.path.abspath(args.output_dir)}")
+    
+    return error_count == 0 or success_count > 0 or unchanged > 0
+
+def create_side_by_side_image(cropped_path, original_path, box, output_path, original=None, policy=DEFAULT_POLICY,
+                              encoding=DEFAULT_ENCODING):
     """
     Create a side-by-side composite image showing both cropped and original views.
     
@@ -352,89 +1011,21 @@ def create_side_by_side_image(cropped_path, original_path, box, output_path):
         original_path: Path to the original image
         box: Bounding box coordinates [x1, y1, x2, y2]
         output_path: Path to save the composite image
+        original: Optional (image, full_size) already decoded by load_group_original
+        policy: Resampling policy (see composite_engine.RESAMPLING_POLICIES)
+        encoding: Encoding profile (see composite_engine.ENCODING_PROFILES)
     
     Returns:
         True if successful, False otherwise
     """
-    try:
-        # Open both images
-        cropped_img = Image.open(cropped_path)
-        original_img = Image.open(original_path)
-        
-        # Get dimensions
-        crop_width, crop_height = cropped_img.size
-        orig_width, orig_height = original_img.size
-        
-        # Calculate new dimensions
-        # Make the original image the same height as the cropped for side-by-side
-        new_orig_height = crop_height
-        new_orig_width = int(orig_width * (new_orig_height / orig_height))
-        
-        # Resize original image
-        resized_orig = original_img.resize((new_orig_width, new_orig_height), Image.LANCZOS)
-        
-        # Create a new image wide enough for both
-        total_width = crop_width + new_orig_width + 20  # 20px padding
-        composite = Image.new('RGB', (total_width, crop_height + 30), (255, 255, 255))
-        
-        # Paste the cropped image on the left
-        composite.paste(cropped_img, (0, 0))
-        
-        # Paste the original image on the right with some spacing
-        composite.paste(resized_orig, (crop_width + 20, 0))
-        
-        # Draw a line to separate the images
-        draw = ImageDraw.Draw(composite)
-        draw.line([(crop_width + 10, 0), (crop_width + 10, crop_height)], fill=(200, 200, 200), width=1)
-        
-        # Add labels
-        try:
-            font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = ImageFont.load_default()
-        
-        draw.text((10, crop_height + 5), "Cropped View", fill=(0, 0, 0), font=font)
-        draw.text((crop_width + 30, crop_height + 5), "Original Context", fill=(0, 0, 0), font=font)
-        
-        # Mark the bounding box in the original context view
-        if box:
-            # Scale the box coordinates to fit the resized original
-            scale_x = new_orig_width / orig_width
-            scale_y = new_orig_height / orig_height
-            
-            scaled_box = [
-                int(box[0] * scale_x),
-                int(box[1] * scale_y),
-                int(box[2] * scale_x),
-                int(box[3] * scale_y)
-            ]
-            
-            # Draw dashed rectangle
-            x0, y0, x1, y1 = scaled_box
-            dash_length = 6
-            dash_gap = 3
-            
-            # Adjust coordinates to the position in the composite image
-            x0 += crop_width + 20
-            x1 += crop_width + 20
-            
-            # Draw dashed lines
-            for x in range(int(x0), int(x1), dash_length + dash_gap):
-                end_x = min(x + dash_length, x1)
-                draw.line([(x, y0), (end_x, y0)], fill="red", width=2)
-                draw.line([(x, y1), (end_x, y1)], fill="red", width=2)
-            
-            for y in range(int(y0), int(y1), dash_length + dash_gap):
-                end_y = min(y + dash_length, y1)
-                draw.line([(x0, y), (x0, end_y)], fill="red", width=2)
-                draw.line([(x1, y), (x1, end_y)], fill="red", width=2)
-        
-        # Save the composite image
-        composite.save(output_path, quality=85)
-        return True
-    except Exception as e:
-        print(f"Error creating side-by-side image: {e}")
-        return False
+    # The context is scaled to the crop's height
+    if original is None:
+        return composite_engine.create_side_by_side_image(cropped_path, original_path, box, output_path,
+                                                          "crop-height", policy, encoding=encoding)
+    original_img, full_size = original
+    return composite_engine.create_side_by_side_image(cropped_path, original_img, box, output_path,
+                                                      "crop-height", policy, original_size=full_size,
+                                                      encoding=encoding)
 
 def main():
     """Main function to run the script."""
@@ -447,6 +1038,7 @@ def main():
     print(f"Queue file: {args.queue_file}")
     print(f"Preserve single/multi-box ratio: {args.preserve_ratio}")
     print(f"Balance towns: {args.balance_towns}")
+    print(f"Sampler: {args.sampler}" + (f" ({args.allocation} allocation)" if args.sampler == "joint" else ""))
     
     # Load classification queue
     queue_data = load_classification_queue(args.queue_file)
@@ -454,18 +1046,62 @@ def main():
         print("Failed to load classification queue. Exiting.")
         return
     
+    # When topping up, the published sample is kept and only new items are drawn
+    current_images = []
+    sample_size = args.sample_size
+    if args.top_up:
+        args.sync = True
+        current_images = published_items(args.output_dir)
+        sample_size = args.top_up
+        print(f"Topping up {len(current_images)} published images with {args.top_up} more")
+    
     # Select stratified sample
-    selected_images = select_stratified_sample(queue_data, args)
+    if args.sampler == "joint" or args.top_up:
+        images = queue_data.get("images", []) if isinstance(queue_data, dict) else queue_data
+        print(f"Found {len(images)} total images")
+        if current_images:
+            published = set(publish_target(img, args.output_dir)["source_path"] for img in current_images)
+            images = [img for img in images
+                      if publish_target(img, args.output_dir)["source_path"] not in published]
+            if not images:
+                print(f"Nothing new to top up: all queue items are already published ({len(current_images)} images)")
+                return
+        selected_images, report = select_joint_stratified_sample(
+            images, sample_size, args.allocation, args.seed)
+        selected_images = current_images + selected_images
+        print_stratum_report(report, args.debug)
+        
+        if args.stratum_report:
+            with open(args.stratum_report, 'w') as f:
+                json.dump({
+                    "sample_size": sample_size,
+                    "allocation": args.allocation,
+                    "seed": args.seed,
+                    "strata": report
+                }, f, indent=2)
+            print(f"\nStratum report saved to: {args.stratum_report}")
+    else:
+        if args.seed is not None:
+            random.seed(args.seed)
+        selected_images = select_stratified_sample(queue_data, args)
     if not selected_images:
         print("No images selected. Exiting.")
         return
     
     # Copy selected images
-    success = copy_selected_images(selected_images, args)
+    if args.sync:
+        success = sync_selected_images(selected_images, args)
+    else:
+        success = copy_selected_images(selected_images, args)
     if not success:
         print("Failed to copy images. Exiting.")
         return
     
+    if args.shards:
+        shard_dir = args.shard_dir or shard_archive.default_shard_dir(args.output_dir)
+        count, shard_paths = shard_archive.pack_directory(args.output_dir, shard_dir, args.shard_size)
+        print(f"\nPacked {count} files into {len(shard_paths)} shards: {shard_dir}")
+    
     print("\nNext steps:")
     print("1. Run the generate-image-list.js script to update the image list:")
     print("   node scripts/generate-image-list.js")
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Packed Shard Archives
+
+This script packs an output directory (cropped images, composites, context
+images, renditions and their manifests) into a few fixed-size tar shards,
+so the whole output set moves as a handful of sequential large-file copies
+instead of tens of thousands of small files.
+
+Shards are plain tar files (shard-000000.tar, shard-000001.tar, ...) whose
+members are named by their path relative to the packed directory
+(e.g. AAA/AAA_0_box0.jpg), so tar and WebDataset-style loaders read them as
+is. Next to them, index.json maps each member name to its shard, the offset
+of its data in the shard and its size; ShardReader uses it to read single
+members through mmap without extracting anything.
+
+A shard is closed before a member would take it past the shard size (tar's
+end-of-archive padding aside; a single member larger than the shard size
+gets a shard of its own). Shards
+are written to temporary files and only put in place, together with the
+index, once every member has been written.
+
+Index layout (index.json):
+    metadata  creation time, source directory, shard size, member count
+    shards    shard file names, in order
+    members   member name -> [shard number, data offset, size]
+
+Usage:
+    python scripts/shard_archive.py [options]
+
+Options:
+    --pack DIR               Pack every file under DIR into shards
+    --shard-dir DIR          Shard directory (default: data/shards/{name of DIR})
+    --shard-size MB          Maximum shard size in MB (default: 256)
+    --list                   List the members of the shard set in --shard-dir
+    --read NAME              Read one member by offset and write it to --output (or stdout)
+    --output FILE            Where --read writes the member (default: stdout)
+    --verify DIR             Compare every member with the file under DIR it was packed from
+"""
+
+import os
+import sys
+import json
+import argparse
+import mmap
+import tarfile
+import threading
+import time
+from datetime import datetime
+
+# Base directories
+BASE_DIR = "data"
+SHARD_ROOT = os.path.join(BASE_DIR, "shards")
+
+INDEX_NAME = "index.json"
+SHARD_PATTERN = "shard-{:06d}.tar"
+DEFAULT_SHARD_SIZE_MB = 256
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Pack output directories into tar shards with an offset index")
+
+    parser.add_argument("--pack", type=str, metavar="DIR",
+                        help="Pack every file under DIR into shards")
+    parser.add_argument("--shard-dir", type=str,
+                        help="Shard directory (default: data/shards/{name of DIR})")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE_MB,
+                        help=f"Maximum shard size in MB (default: {DEFAULT_SHARD_SIZE_MB})")
+    parser.add_argument("--list", action="store_true",
+                        help="List the members of the shard set in --shard-dir")
+    parser.add_argument("--read", type=str, metavar="NAME",
+                        help="Read one member by offset and write it to --output (or stdout)")
+    parser.add_argument("--output", type=str,
+                        help="Where --read writes the member (default: stdout)")
+    parser.add_argument("--verify", type=str, metavar="DIR",
+                        help="Compare every member with the file under DIR it was packed from")
+
+    return parser.parse_args()
+
+def default_shard_dir(directory):
+    """Shard directory for an output directory: data/shards/{its name}."""
+    return os.path.join(SHARD_ROOT, os.path.basename(os.path.normpath(directory)))
+
+def padded_size(size):
+    """Size of a member's data in a tar file, padded to whole blocks."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+class ShardWriter:
+    """
+    Write files into fixed-size tar shards and record where each member's data starts.
+
+    Use as a context manager: the shards and index are put in place when the
+    block completes, and the temporary files are removed if it raises.
+    """
+
+    def __init__(self, shard_dir, shard_size=DEFAULT_SHARD_SIZE_MB * 1024 * 1024, source_dir=None):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.source_dir = source_dir
+        self.shards = []
+        self.members = {}
+        self._tar = None
+        self._members_in_shard = 0
+
+    def __enter__(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+    def _temp_path(self, number):
+        return os.path.join(self.shard_dir, SHARD_PATTERN.format(number) + ".tmp")
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+
+    def _open_shard(self):
+        self._close_shard()
+        self.shards.append(SHARD_PATTERN.format(len(self.shards)))
+        self._tar = tarfile.open(self._temp_path(len(self.shards) - 1), "w", format=tarfile.GNU_FORMAT)
+        self._members_in_shard = 0
+
+    def add(self, path, name):
+        """Add a file as member name, starting a new shard if this one would grow past the shard size."""
+        stat = os.stat(path)
+        info = tarfile.TarInfo(name)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        # The header addfile() writes (more than one block for long names); the data follows it
+        header_size = len(info.tobuf(tarfile.GNU_FORMAT, tarfile.ENCODING, "surrogateescape"))
+
+        if (self._tar is None or
+                (self._members_in_shard and
+                 self._tar.offset + header_size + padded_size(info.size) > self.shard_size)):
+            self._open_shard()
+
+        data_offset = self._tar.offset + header_size
+        with open(path, 'rb') as f:
+            self._tar.addfile(info, f)
+
+        self.members[name] = [len(self.shards) - 1, data_offset, info.size]
+        self._members_in_shard += 1
+
+    def finish(self):
+        """Put the new shards in place, remove stale ones and write the index."""
+        self._close_shard()
+        for number, shard in enumerate(self.shards):
+            os.replace(self._temp_path(number), os.path.join(self.shard_dir, shard))
+
+        # Shards left over from an earlier, larger shard set
+        current = set(self.shards)
+        for name in os.listdir(self.shard_dir):
+            if name.startswith("shard-") and name.endswith(".tar") and name not in current:
+                os.remove(os.path.join(self.shard_dir, name))
+
+        index_path = os.path.join(self.shard_dir, INDEX_NAME)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "metadata": {
+                    "created": datetime.now().isoformat(),
+                    "source_dir": self.source_dir,
+                    "shard_size": self.shard_size,
+                    "member_count": len(self.members)
+                },
+                "shards": self.shards,
+                "members": self.members
+            }, f)
+        os.replace(tmp_path, index_path)
+
+    def abort(self):
+        """Discard the shards written so far."""
+        self._close_shard()
+        for number in range(len(self.shards)):
+            try:
+                os.remove(self._temp_path(number))
+            except OSError:
+                pass
+
+def iter_files(directory, exclude=None):
+    """Yield (member name, path) for every file under a directory, in sorted order."""
+    exclude = os.path.abspath(exclude) if exclude else None
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != exclude)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, directory).replace(os.sep, "/"), path
+
+def pack_directory(directory, shard_dir=None, shard_size_mb=DEFAULT_SHARD_SIZE_MB):
+    """
+    Pack every file under a directory into shards.
+
+    Returns:
+        (member count, list of shard paths)
+    """
+    shard_dir = shard_dir or default_shard_dir(directory)
+    with ShardWriter(shard_dir, shard_size_mb * 1024 * 1024, os.path.abspath(directory)) as writer:
+        for name, path in iter_files(directory, exclude=shard_dir):
+            writer.add(path, name)
+    return len(writer.members), [os.path.join(shard_dir, shard) for shard in writer.shards]
+
+class ShardReader:
+    """Read-only access to the members of a shard set by offset, through mmap."""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_NAME), 'r') as f:
+            index = json.load(f)
+        self.metadata = index["metadata"]
+        self.shards = index["shards"]
+        self.members = index["members"]
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def names(self):
+        return list(self.members)
+
+    def close(self):
+        with self._lock:
+            for shard_file, shard_map in self._maps.values():
+                shard_map.close()
+                shard_file.close()
+            self._maps.clear()
+
+    def _map(self, number):
+        with self._lock:
+            entry = self._maps.get(number)
+            if entry is None:
+                shard_file = open(os.path.join(self.shard_dir, self.shards[number]), 'rb')
+                entry = (shard_file, mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ))
+                self._maps[number] = entry
+            return entry[1]
+
+    def read(self, name):
+        """Bytes of one member, read in place from its shard."""
+        number, offset, size = self.members[name]
+        if size == 0:
+            return b""
+        return self._map(number)[offset:offset + size]
+
+def main():
+    """Main function to run the script."""
+    args = parse_arguments()
+
+    if args.pack:
+        shard_dir = args.shard_dir or default_shard_dir(args.pack)
+        start = time.perf_counter()
+        count, shard_paths = pack_directory(args.pack, shard_dir, args.shard_size)
+        total = sum(os.path.getsize(path) for path in shard_paths)
+        print(f"Packed {count} files into {len(shard_paths)} shards ({total / 1024 / 1024:.1f} MB) "
+              f"in {time.perf_counter() - start:.1f} seconds: {shard_dir}")
+        return
+
+    shard_dir = args.shard_dir or (default_shard_dir(args.verify) if args.verify else None)
+    if not shard_dir:
+        print("--list, --read and --verify need --shard-dir (or --pack DIR to create a shard set)")
+        return
+    reader = ShardReader(shard_dir)
+
+    if args.list:
+        for name, (number, offset, size) in reader.members.items():
+            print(f"{reader.shards[number]}  {offset:>12}  {size:>10}  {name}")
+        print(f"\n{len(reader)} members in {len(reader.shards)} shards")
+
+    if args.read:
+        if args.read not in reader:
+            print(f"No member named {args.read} in {shard_dir}")
+            return
+        data = reader.read(args.read)
+        if args.output:
+            with open(args.output, 'wb') as f:
+                f.write(data)
+            print(f"Wrote {len(data)} bytes to {args.output}")
+        else:
+            sys.stdout.buffer.write(data)
+
+    if args.verify:
+        mismatched = []
+        for name, path in iter_files(args.verify, exclude=shard_dir):
+            with open(path, 'rb') as f:
+                if name not in reader or reader.read(name) != f.read():
+                    mismatched.append(name)
+        print(f"Verified {len(reader)} members: {len(mismatched)} missing or different")
+        for name in mismatched[:20]:
+            print(f"  {name}")
+
+    reader.close()
+
+if __name__ == "__main__":
+    main()